@@ -1,5 +1,7 @@
 from pathlib import Path
 
+import django
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 OUTSIDE_DIR = BASE_DIR.parent / 'outside/QuizApe'
@@ -66,9 +68,35 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Writers wait up to 5s for the lock instead of failing with
+            # "database is locked"
+            'timeout': 5,
+        },
+        # The tests submit answers from several threads at once, SQLite's
+        # shared in-memory test database uses table locks that don't honour
+        # the timeout, so use a file
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# Take the write lock at the start of a transaction, a deferred transaction
+# that reads then writes fails without waiting if another connection wrote in
+# between. The option needs Django 5.1, on 5.0 transactions stay deferred.
+# WAL mode is turned on for each new connection by core.sqlite.
+if django.VERSION >= (5, 1):
+    DATABASES['default']['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+
+# Funnel answer and AnswerGroup writes through a single thread per server
+# process, committing the writes from many requests in one transaction.
+# Requests wait up to WRITE_COALESCER_WINDOW seconds for a batch to fill,
+# and for it to be committed before responding.
+WRITE_COALESCER = False
+WRITE_COALESCER_WINDOW = 0.005
+WRITE_COALESCER_MAX_BATCH = 100
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -114,6 +142,36 @@ MEDIA_ROOT = OUTSIDE_DIR / 'uploads'
 MEDIA_URL = '/media/'
 
 
+# Result graphs are drawn by either the built-in "svg" renderer or with
+# "matplotlib". Matplotlib renders happen in a pool of background processes,
+# this is the size of the pool in each server process. Set to 0 to render
+# inline.
+GRAPH_RENDERER = "svg"
+GRAPH_RENDER_WORKERS = 2
+
+# Render processes are replaced after this many graphs, and the pool is
+# replaced if any of them grows beyond this many bytes
+GRAPH_RENDER_MAX_TASKS = 500
+GRAPH_RENDER_MAX_RSS = 200 * 1024 * 1024
+
+# Total disk space rendered graphs may use across all surveys before the least
+# recently viewed ones are removed, and how often (in seconds) to check
+GRAPH_CACHE_MAX_BYTES = 50 * 1024 * 1024
+GRAPH_CACHE_EVICT_INTERVAL = 60
+
+# Serve the respondent pages (start, page and done) with async views. Only
+# worth turning on when running under an ASGI server such as uvicorn or
+# daphne, see the README
+ASYNC_RESPONDENT_VIEWS = False
+
+# Per view request timings and SQL statements are recorded in memory when
+# 'core.instrumentation.InstrumentationMiddleware' is added to the start of
+# MIDDLEWARE. Staff can see them at /admin/instrumentation/. This is how many
+# requests are kept, and how many of the slowest statements per request.
+INSTRUMENTATION_BUFFER_SIZE = 1000
+INSTRUMENTATION_SLOW_QUERIES = 5
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -5,21 +5,46 @@ from django.urls import path, include
 
 from core import views as core_views
 
+# Respondent views, the async versions need an ASGI server to be of any use
+if settings.ASYNC_RESPONDENT_VIEWS:
+    start_quiz = core_views.astart_quiz
+    page = core_views.apage
+    done = core_views.adone
+else:
+    start_quiz = core_views.start_quiz
+    page = core_views.page
+    done = core_views.done
+
 urlpatterns = [
+    path('admin/instrumentation/', core_views.instrumentation_page,
+        name="instrumentation"),
+    path('admin/instrumentation/json/', core_views.instrumentation_json,
+        name="instrumentation_json"),
     path('admin/', admin.site.urls),
     path('rankedmodel/', include('awl.rankedmodel.urls')),
 
     path('', core_views.home, name="home"),
-    path('<slug:slug>/', core_views.start_quiz, name="start_quiz"),
-    path('page/<int:survey_id>/<str:token>/<int:page_num>/', core_views.page,
+    path('<slug:slug>/', start_quiz, name="start_quiz"),
+    path('page/<int:survey_id>/<str:token>/<int:page_num>/', page,
         name="page"),
-    path('done/<int:survey_id>/<str:token>/', core_views.done, name="done"),
+    path('done/<int:survey_id>/<str:token>/', done, name="done"),
 
     path('duplicate/<int:survey_id>/', core_views.duplicate, name="duplicate"),
+    path('export/<int:survey_id>/<str:fmt>/', core_views.export,
+        name="export"),
     path('result_page/<int:survey_id>/<str:token>/',
         core_views.result_page, name="result_page"),
+    path('analytics/<int:survey_id>/<str:token>/', core_views.analytics,
+        name="analytics"),
     path('result_question/<int:q_id>/<str:token>/', core_views.result_question,
         name="result_question"),
+    path('result_text/<int:q_id>/<str:token>/', core_views.result_text,
+        name="result_text"),
+    path('issue_tokens/<int:survey_id>/', core_views.issue_tokens,
+        name="issue_tokens"),
+
+    # Last, as it matches any two part path
+    path('<slug:slug>/<str:token>/', start_quiz, name="start_token"),
 ]
 
 if settings.DEBUG:
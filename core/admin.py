@@ -1,42 +1,253 @@
-from django.contrib import admin
+import hashlib
+
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
 from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Count, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.shortcuts import redirect
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.text import Truncator
 
 from awl.admintools import admin_obj_link, fancy_modeladmin
-from awl.rankedmodel.admintools import admin_move_links
 
 from core.models import (Survey, Page, Question, QuestionTypes, AnswerGroup,
     Answer)
 
 # ===========================================================================
 
+# Seconds the row counts of the Answer and AnswerGroup changelists are kept
+COUNT_CACHE_TIMEOUT = 60
+
+# Query string parameters of a keyset paged changelist
+AFTER_VAR = "after"
+BEFORE_VAR = "before"
+
+# ===========================================================================
+
 admin.site.unregister(Group)
 
 # ===========================================================================
 
+def count_related(model, fk, ref="pk"):
+    """Annotation counting the ``model`` rows whose ``fk`` matches the row's
+    ``ref`` field. As a correlated subquery it is only run for the rows
+    shown, where a join and GROUP BY would count every row first."""
+    counts = model.objects.filter(**{fk: OuterRef(ref)}).order_by().values(
+        fk).annotate(count=Count("*")).values("count")
+    return Coalesce(Subquery(counts), 0)
+
+
+def count_all(model):
+    """Annotation with the number of rows in a model's table, counted once
+    per query"""
+    # Grouping by a constant leaves a single group of every row
+    counts = model.objects.order_by().annotate(group=Value(1)).values(
+        "group").annotate(count=Count("*")).values("count")
+    return Subquery(counts)
+
+
+def changelist_link(model, query, text):
+    url = reverse(f"admin:core_{model._meta.model_name}_changelist")
+    return format_html('<a href="{}?{}">{}</a>', url, query, text)
+
+
+def move_links(obj):
+    """Same links as awl's ``admin_move_links`` but uses the ``last_rank``
+    annotation instead of counting the object's group on every row"""
+    content_type = ContentType.objects.get_for_model(obj)
+
+    html = '<span style="width:2ex; display:inline-block">'
+    if obj.rank > 1:
+        link = reverse('awl-rankedmodel-move', args=(content_type.id, obj.id,
+            obj.rank - 1))
+        html += f'<a href="{link}">↑</a>'
+    else:
+        html += '&nbsp;'
+
+    html += '</span>&nbsp;<span style="width:2ex; display:inline-block">'
+    if obj.rank < obj.last_rank:
+        link = reverse('awl-rankedmodel-move', args=(content_type.id, obj.id,
+            obj.rank + 1))
+        html += f'<a href="{link}">↓</a>'
+
+    html += '</span>'
+    return mark_safe(html)
+
+# ===========================================================================
+
+class CachedCountPaginator(Paginator):
+    """Paginator that keeps its count in the cache for
+    ``COUNT_CACHE_TIMEOUT`` seconds, keyed by the query, so paging through
+    or refreshing a changelist doesn't count the whole table each time"""
+    @cached_property
+    def count(self):
+        sql, params = self.object_list.query.sql_with_params()
+        key = hashlib.md5(f"{sql}{params}".encode()).hexdigest()
+        return cache.get_or_set(f"admin-count-{key}", self.object_list.count,
+            COUNT_CACHE_TIMEOUT)
+
+
+def keyset_filter(ordering, values, forward=True):
+    """Returns a Q for the rows that come after ``values`` in ``ordering``,
+    or before them if not ``forward``.
+
+    :param ordering: field names, prefixed with "-" when descending
+    :param values: the values of those fields in the row to page from
+    """
+    names = [name.lstrip("-") for name in ordering]
+    query = Q()
+    for num, name in enumerate(names):
+        lookup = "lt" if ordering[num].startswith("-") == forward else "gt"
+        query |= Q(**dict(zip(names[:num], values[:num])),
+            **{f"{name}__{lookup}": values[num]})
+
+    return query
+
+
+class KeysetChangeList(ChangeList):
+    """Changelist paged from a row instead of by page number. A page is the
+    rows that follow the ``after`` row or precede the ``before`` row in the
+    changelist's ordering, given by the values of the ordering's fields, so
+    deep pages cost the same as the first where OFFSET would step over every
+    row in front of them. Sorting by a column falls back to numbered pages.
+    """
+    def get_queryset(self, request, exclude_parameters=None):
+        # The position isn't a filter, keep it out of the lookups and links
+        for name in (AFTER_VAR, BEFORE_VAR):
+            self.params.pop(name, None)
+            self.filter_params.pop(name, None)
+
+        return super().get_queryset(request, exclude_parameters)
+
+    def get_ordering(self, request, queryset):
+        # The admin's ordering is already on the queryset and gets repeated
+        return list(dict.fromkeys(super().get_ordering(request, queryset)))
+
+    def get_results(self, request):
+        ordering = self.queryset.query.order_by
+        self.keyset = ORDER_VAR not in self.params and all(
+            isinstance(name, str) for name in ordering)
+        if not self.keyset:
+            super().get_results(request)
+            return
+
+        after = request.GET.get(AFTER_VAR)
+        before = request.GET.get(BEFORE_VAR)
+        forward = before is None
+        cursor = after if forward else before
+        values = cursor.split(",") if cursor else []
+        if values and len(values) != len(ordering):
+            raise IncorrectLookupParameters
+
+        per_page = self.list_per_page
+        queryset = self.queryset if forward else self.queryset.reverse()
+        try:
+            if values:
+                queryset = queryset.filter(keyset_filter(ordering, values,
+                    forward))
+
+            rows = list(queryset[:per_page + 1])
+        except (ValueError, ValidationError):
+            raise IncorrectLookupParameters
+
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if forward:
+            has_previous, has_next = bool(values), more
+        else:
+            rows.reverse()
+            has_previous, has_next = more, bool(values)
+
+        self.first_url = self.previous_url = None
+        self.next_url = self.last_url = None
+        if has_previous and rows:
+            self.first_url = self.get_query_string()
+            self.previous_url = self.get_query_string({
+                BEFORE_VAR: self.cursor(rows[0], ordering)})
+        if has_next and rows:
+            self.next_url = self.get_query_string({
+                AFTER_VAR: self.cursor(rows[-1], ordering)})
+            self.last_url = self.get_query_string({BEFORE_VAR: ""})
+
+        self.paginator = self.model_admin.get_paginator(request,
+            self.queryset, per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_previous or has_next
+
+    def cursor(self, obj, ordering):
+        return ",".join(str(obj.serializable_value(name.lstrip("-"))) for
+            name in ordering)
+
+
+class KeysetPagingMixin:
+    """Pages a ModelAdmin's changelist with :class:`KeysetChangeList`,
+    newest first, and caches its counts. For tables with a row per
+    respondent."""
+    change_list_template = "admin/core/keyset_change_list.html"
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+    ordering = ["-id"]
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+# ===========================================================================
+
 base = fancy_modeladmin('id', 'name')
-base.add_fk_link('page_set', Page, 'survey', display='{{obj.count}} Pages')
-base.add_displays('show_questions', 'show_survey', 'show_results',
-    'show_duplicate')
+base.add_displays('show_pages', 'show_questions', 'show_survey',
+    'show_results', 'show_export', 'show_duplicate')
 
 @admin.register(Survey)
 class SurveyAdmin(base):
     prepopulated_fields = {"slug": ["name"]}
+    actions = ["issue_tokens"]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            page_count=count_related(Page, "survey"),
+            question_count=count_related(Question, "page__survey"))
+
+    @admin.action(description="Issue tokens for a panel")
+    def issue_tokens(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, "Select a single survey to issue "
+                "tokens for", messages.ERROR)
+            return None
+
+        return redirect("issue_tokens", survey_id=queryset.get().id)
+
+    def show_pages(self, obj):
+        if obj.page_count == 0:
+            return ""
+
+        return changelist_link(Page, f"survey__id__exact={obj.id}",
+            f"{obj.page_count} Pages")
+    show_pages.short_description = "Page"
+    show_pages.admin_order_field = "page_count"
 
     def show_questions(self, obj):
-        questions = Question.objects.filter(page__survey=obj)
-        count = questions.count()
+        count = obj.question_count
         plural = "s" if count > 1 else ""
 
         text = f"{count} question{plural}"
-
-        url = reverse('admin:core_question_changelist')
-        url += '?id__in=' + ','.join([str(q.id) for q in questions])
-
-        return format_html('<a href="{}">{}</a>', url, text)
+        return changelist_link(Question, f"page__survey__id__exact={obj.id}",
+            text)
     show_questions.short_description = "Questions"
+    show_questions.admin_order_field = "question_count"
 
     def show_survey(self, obj):
         url = reverse('start_quiz', args=(obj.slug, ))
@@ -50,6 +261,14 @@ class SurveyAdmin(base):
         return format_html('<a href="{}">View <i>{}</i></a>', url, obj.name)
     show_results.short_description = "Results"
 
+    def show_export(self, obj):
+        csv_url = reverse('export', args=(obj.id, 'csv'))
+        jsonl_url = reverse('export', args=(obj.id, 'jsonl'))
+
+        return format_html('<a href="{}">CSV</a> | <a href="{}">JSONL</a>',
+            csv_url, jsonl_url)
+    show_export.short_description = "Export"
+
     def show_duplicate(self, obj):
         url = reverse('duplicate', args=(obj.id, ))
 
@@ -60,37 +279,66 @@ class SurveyAdmin(base):
 
 base = fancy_modeladmin('id')
 base.add_link('survey', 'Survey', '{{obj.name}}')
-base.add_fk_link('question_set', Question, 'page',
-    display='{{obj.count}} Questions')
-base.add_displays('show_move_rank')
+base.add_displays('show_questions', 'show_move_rank')
 
 @admin.register(Page)
 class PageAdmin(base):
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            "survey").annotate(
+            question_count=count_related(Question, "page"),
+            last_rank=count_related(Page, "survey", "survey"))
+
+    def show_questions(self, obj):
+        if obj.question_count == 0:
+            return ""
+
+        return changelist_link(Question, f"page__id__exact={obj.id}",
+            f"{obj.question_count} Questions")
+    show_questions.short_description = "Question"
+    show_questions.admin_order_field = "question_count"
+
     def show_move_rank(self, obj):
-        return admin_move_links(obj)
+        return move_links(obj)
     show_move_rank.short_description = "Rank"
 
 
 base = fancy_modeladmin('id', 'question_type', 'short_text')
-base.add_link('page__survey', 'Survey', '{{obj.page.survey.name}}')
+base.add_link('page__survey', 'Survey', '{{obj.name}}')
 base.add_link('page', 'Page', 'Page #{{obj.rank}}')
-base.add_fk_link('answer_set', Answer, 'question',
-    display='{{obj.count}} Answers')
-base.add_displays('show_move_rank', 'show_graph')
+base.add_displays('show_answers', 'show_move_rank', 'show_graph')
 
 @admin.register(Question)
 class QuestionAdmin(base):
+    list_filter = ["page__survey"]
+
+    def get_queryset(self, request):
+        # Questions are ranked across all surveys, see
+        # RankedModel.grouped_filter()
+        return super().get_queryset(request).select_related(
+            "page__survey").annotate(
+            answer_count=count_related(Answer, "question"),
+            last_rank=count_all(Question))
+
+    def show_answers(self, obj):
+        if obj.answer_count == 0:
+            return ""
+
+        return changelist_link(Answer, f"question__id__exact={obj.id}",
+            f"{obj.answer_count} Answers")
+    show_answers.short_description = "Answer"
+    show_answers.admin_order_field = "answer_count"
 
     def show_move_rank(self, obj):
-        return admin_move_links(obj)
+        return move_links(obj)
     show_move_rank.short_description = "Rank"
 
     def show_graph(self, obj):
-        if obj.answer_set.count() == 0:
+        if obj.answer_count == 0:
             return format_html('<i> No answers </i>')
 
-        url = reverse('result_question', args=(obj.id, ))
+        url = reverse('result_question', args=(obj.id, obj.page.survey.token))
         return format_html('<a href="{}">Graph</a>', url)
 
 
@@ -100,8 +348,33 @@ base.add_link('page', 'Page', 'Page #{{obj.rank}}')
 base.add_displays('token')
 
 @admin.register(AnswerGroup)
-class AnswerGroupAdmin(base):
-    pass
+class AnswerGroupAdmin(KeysetPagingMixin, base):
+    list_filter = ["survey"]
+    list_select_related = ["survey", "page__survey"]
+
+
+class AnswerSurveyFilter(admin.SimpleListFilter):
+    """Filters answers by survey through a subquery of the survey's groups
+    rather than a join, so SQLite can walk the ``unique_answer`` index one
+    group at a time in the order :meth:`AnswerAdmin.get_ordering` asks for
+    instead of sorting all of the survey's answers"""
+    title = "survey"
+    parameter_name = "survey"
+
+    def lookups(self, request, model_admin):
+        return Survey.objects.values_list("id", "name")
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+
+        try:
+            survey_id = int(self.value())
+        except ValueError:
+            raise IncorrectLookupParameters
+
+        groups = AnswerGroup.objects.filter(survey_id=survey_id)
+        return queryset.filter(answer_group__in=groups.values("id"))
 
 
 base = fancy_modeladmin('id')
@@ -110,7 +383,16 @@ base.add_displays('show_type', 'show_answer')
 base.add_link('answer_group', 'AnswerGroup')
 
 @admin.register(Answer)
-class AnswerAdmin(base):
+class AnswerAdmin(KeysetPagingMixin, base):
+    list_filter = [AnswerSurveyFilter, "question"]
+    list_select_related = ["question", "answer_group"]
+
+    def get_ordering(self, request):
+        if AnswerSurveyFilter.parameter_name in request.GET:
+            # Newest group first, matching the unique_answer index
+            return ["-answer_group_id", "-question_id"]
+
+        return super().get_ordering(request)
 
     def show_answer(self, obj):
         if obj.question.question_type == QuestionTypes.TEXT:
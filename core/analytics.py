@@ -0,0 +1,216 @@
+"""Columnar analysis of survey answers. Answers are loaded into NumPy arrays
+with one slot per :class:`AnswerGroup` so that cross-tabulations and
+statistics are computed vectorized instead of row by row.
+
+NumPy is slow to import, only import this module where it is used.
+"""
+from itertools import compress
+
+import numpy as np
+
+from core.models import AnswerGroup, Answer, QuestionTypes, ANSWER_FIELDS
+
+# ===========================================================================
+
+# Rows fetched from the database per round trip while loading
+LOAD_CHUNK_SIZE = 5000
+
+# ===========================================================================
+
+class Column:
+    """A question's answers, one slot per respondent.
+
+    Every column has a categorical view: ``codes`` indexes into ``labels``
+    with -1 meaning the respondent gave no answer. BOOLEAN, NUM and STAR
+    columns also have ``values``, a float array with NaN for no answer.
+
+    :param question: the :class:`Question` the answers are for
+    :param codes: int32 array of category codes
+    :param labels: list of category labels
+    :param values: float64 array of numeric values or None
+    """
+    def __init__(self, question, codes, labels, values=None):
+        self.question = question
+        self.codes = codes
+        self.labels = labels
+        self.values = values
+
+    @property
+    def numeric(self):
+        return self.values is not None
+
+    def describe(self, percentiles=(25, 75)):
+        """Returns a dict of count, mean, median, std and the requested
+        percentiles (as "p25" and so on) for a numeric column"""
+        return _stats(self.values[~np.isnan(self.values)], percentiles)
+
+
+class SurveyColumns:
+    """Loads the answers to a survey's questions into :class:`Column`
+    objects in a single pass over the answer table.
+
+    :param survey: the :class:`Survey` to load
+    :param questions: iterable of the :class:`Question` objects to load, TEXT
+        questions are skipped
+    """
+    def __init__(self, survey, questions):
+        questions = {question.id: question for question in questions
+            if question.question_type != QuestionTypes.TEXT}
+
+        self.group_ids = np.fromiter(AnswerGroup.responded(survey).order_by(
+            "id").values_list("id", flat=True), dtype=np.int64)
+
+        fields = list(ANSWER_FIELDS.values())
+        positions = {q_id: 2 + fields.index(question.answer_field)
+            for q_id, question in questions.items()}
+
+        gathered = {q_id: ([], []) for q_id in questions}
+        rows = Answer.objects.filter(answer_group__survey=survey,
+            question_id__in=questions.keys()).values_list("answer_group_id",
+            "question_id", *fields).iterator(chunk_size=LOAD_CHUNK_SIZE)
+        for row in rows:
+            value = row[positions[row[1]]]
+            if value is not None and value != "":
+                group_ids, values = gathered[row[1]]
+                group_ids.append(row[0])
+                values.append(value)
+
+        self.columns = {}
+        for q_id, (group_ids, values) in gathered.items():
+            group_ids = np.array(group_ids, dtype=np.int64)
+            slots = np.searchsorted(self.group_ids, group_ids)
+
+            # Respondents who saved their first answers after the groups
+            # were loaded have no slot, leave their answers out
+            known = slots < len(self.group_ids)
+            known[known] = self.group_ids[slots[known]] == group_ids[known]
+            if not known.all():
+                slots = slots[known]
+                values = list(compress(values, known))
+
+            self.columns[q_id] = _build_column(questions[q_id],
+                len(self.group_ids), slots, values)
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def __getitem__(self, q_id):
+        return self.columns[q_id]
+
+
+def _build_column(question, size, slots, values):
+    codes = np.full(size, -1, dtype=np.int32)
+
+    if question.question_type == QuestionTypes.CHOICE:
+        keys = [choice[0] for choice in question.choices]
+        labels = [choice[1] for choice in question.choices]
+
+        # Map each distinct answer to its choice once, rather than per row;
+        # answers that are no longer a choice are treated as no answer
+        uniques, inverse = np.unique(np.array(values, dtype=str),
+            return_inverse=True)
+        lookup = np.array([keys.index(key) if key in keys else -1
+            for key in uniques], dtype=np.int32)
+        codes[slots] = lookup[inverse]
+        return Column(question, codes, labels)
+
+    numbers = np.full(size, np.nan)
+    numbers[slots] = np.array(values, dtype=np.float64)
+
+    if question.question_type == QuestionTypes.BOOLEAN:
+        labels = ["True", "False"]
+        codes[slots] = np.where(numbers[slots] == 1, 0, 1)
+        return Column(question, codes, labels, numbers)
+
+    if question.question_type == QuestionTypes.STAR:
+        # The validator lets 0 stars through, anything outside 1-5 is no
+        # answer as it is in the results graph
+        numbers[(numbers < 1) | (numbers > 5)] = np.nan
+        answered = ~np.isnan(numbers)
+
+        labels = [str(star) for star in range(5, 0, -1)]
+        codes[answered] = 5 - numbers[answered].astype(np.int32)
+        return Column(question, codes, labels, numbers)
+
+    # NUM categories cover the question's range, or the answers given if it
+    # is open ended
+    given = np.unique(numbers[slots]).astype(np.int64)
+    bottom = question.num_answer_min
+    if bottom is None:
+        bottom = int(given[0]) if len(given) else 0
+    top = question.num_answer_max
+    if top is None:
+        top = int(given[-1]) if len(given) else -1
+
+    categories = np.union1d(np.arange(bottom, top + 1), given)
+    labels = [str(category) for category in categories]
+    codes[slots] = np.searchsorted(categories, numbers[slots])
+
+    return Column(question, codes, labels, numbers)
+
+# ===========================================================================
+# Analysis
+# ===========================================================================
+
+def crosstab(rows, cols):
+    """Counts the respondents for each pair of categories in two columns.
+    Respondents who didn't answer either question are left out.
+
+    :param rows: :class:`Column` for the table's rows
+    :param cols: :class:`Column` for the table's columns
+    :returns: 2D int64 array of counts, indexed by the row and column codes
+    """
+    mask = (rows.codes >= 0) & (cols.codes >= 0)
+    width = len(cols.labels)
+    size = len(rows.labels) * width
+
+    cells = rows.codes[mask].astype(np.int64) * width + cols.codes[mask]
+    return np.bincount(cells, minlength=size).reshape(len(rows.labels),
+        width)
+
+
+def pivot(by, column, percentiles=(25, 75)):
+    """Statistics of a numeric column for each category of another.
+
+    :param by: :class:`Column` to group the respondents by
+    :param column: numeric :class:`Column` to summarize
+    :param percentiles: percentiles to compute in addition to the median
+    :returns: list of (label, stats) tuples, one per category of ``by``,
+        where stats is the dict returned by :meth:`Column.describe`
+    """
+    mask = (by.codes >= 0) & ~np.isnan(column.values)
+    codes = by.codes[mask]
+    values = column.values[mask]
+
+    # Sort by category so each one is a contiguous slice of the values
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    values = values[order]
+    bounds = np.searchsorted(codes, np.arange(len(by.labels) + 1))
+
+    return [(label, _stats(values[bounds[num]:bounds[num + 1]], percentiles))
+        for num, label in enumerate(by.labels)]
+
+
+def _stats(values, percentiles):
+    stats = {
+        "count": len(values),
+        "mean": None,
+        "median": None,
+        "std": None,
+    }
+    for percentile in percentiles:
+        stats[f"p{percentile}"] = None
+
+    if len(values) == 0:
+        return stats
+
+    stats["mean"] = float(values.mean())
+    stats["std"] = float(values.std())
+
+    points = np.percentile(values, [50, *percentiles])
+    stats["median"] = float(points[0])
+    for percentile, point in zip(percentiles, points[1:]):
+        stats[f"p{percentile}"] = float(point)
+
+    return stats
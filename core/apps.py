@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from core.sqlite import configure_connection
+        connection_created.connect(configure_connection,
+            dispatch_uid="core.sqlite.configure_connection")
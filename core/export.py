@@ -0,0 +1,171 @@
+import csv
+import json
+import zlib
+
+from django.urls import reverse
+
+from core.models import (Question, AnswerGroup, Answer, ANSWER_FIELDS)
+
+# ===========================================================================
+
+# Rows fetched from the database per round trip while exporting
+EXPORT_CHUNK_SIZE = 2000
+
+# Size of the text blocks handed to the response, rows are gathered into
+# blocks so that a million row export isn't a million tiny writes
+EXPORT_BLOCK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+# ===========================================================================
+
+def export_questions(survey):
+    """Returns the questions in a survey in the order they are asked, one
+    per export column"""
+    return list(Question.objects.filter(page__survey=survey).order_by(
+        "page__rank", "rank"))
+
+
+def survey_rows(survey, questions, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generator over the responses to a survey, see
+    :meth:`AnswerGroup.responded`, producing a tuple of (group id, created,
+    updated, {question id: value}).
+
+    Groups and answers are read with two streaming queries ordered by group
+    and merge-joined here, so memory use doesn't depend on the size of the
+    survey.
+
+    :param survey: :class:`Survey` to export
+    :param questions: the survey's questions, see :func:`export_questions`
+    :param chunk_size: rows fetched per database round trip
+    """
+    fields = list(ANSWER_FIELDS.values())
+
+    # Position of the value column in an answer row for each question
+    positions = {question.id: 2 + fields.index(question.answer_field)
+        for question in questions}
+
+    groups = AnswerGroup.responded(survey).order_by("id").values_list("id",
+        "created", "updated").iterator(chunk_size=chunk_size)
+    answers = Answer.objects.filter(answer_group__survey=survey).order_by(
+        "answer_group_id").values_list("answer_group_id", "question_id",
+        *fields).iterator(chunk_size=chunk_size)
+
+    answer = next(answers, None)
+    for group_id, created, updated in groups:
+        values = {}
+        while answer is not None and answer[0] <= group_id:
+            if answer[0] == group_id and answer[1] in positions:
+                values[answer[1]] = answer[positions[answer[1]]]
+
+            answer = next(answers, None)
+
+        yield group_id, created, updated, values
+
+
+def _blocks(lines):
+    # Gathers lines of text into blocks of about EXPORT_BLOCK_SIZE
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_BLOCK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+class _Echo:
+    # File-like object for csv.writer that hands back each line instead of
+    # storing it
+    def write(self, value):
+        return value
+
+
+def csv_lines(survey):
+    """Generator of CSV lines for the survey's responses, a header followed
+    by one line per :class:`AnswerGroup`"""
+    questions = export_questions(survey)
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(["group", "created", "updated"] +
+        [question.question_text for question in questions])
+
+    for group_id, created, updated, values in survey_rows(survey, questions):
+        row = [group_id, created.isoformat(), updated.isoformat()]
+        for question in questions:
+            value = values.get(question.id)
+            if isinstance(value, bool):
+                value = int(value)
+
+            row.append(value)
+
+        yield writer.writerow(row)
+
+
+def token_csv_lines(survey, batches, base_url=""):
+    """Generator of CSV lines with each issued token and the personalised
+    link that starts the survey with it.
+
+    :param survey: :class:`Survey` the tokens were issued for
+    :param batches: iterable of lists of tokens, as produced by
+        :meth:`AnswerGroup.issue_tokens`
+    :param base_url: scheme and host to put in front of the links
+    """
+    # Reversed once, the link is the survey's start URL with the token added
+    prefix = base_url + reverse("start_quiz", args=(survey.slug, ))
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(["token", "url"])
+    for tokens in batches:
+        for token in tokens:
+            yield writer.writerow([token, f"{prefix}{token}/"])
+
+
+def jsonl_lines(survey):
+    """Generator of JSON Lines for the survey's responses, one object per
+    :class:`AnswerGroup` with the answers keyed by question id"""
+    questions = export_questions(survey)
+
+    for group_id, created, updated, values in survey_rows(survey, questions):
+        content = {
+            "group": group_id,
+            "created": created.isoformat(),
+            "updated": updated.isoformat(),
+            "answers": {str(question.id): values.get(question.id)
+                for question in questions},
+        }
+        yield json.dumps(content) + "\n"
+
+
+def export_stream(survey, fmt, compress=False):
+    """Generator of the survey's responses as blocks of encoded bytes.
+
+    :param survey: :class:`Survey` to export
+    :param fmt: one of the keys in :data:`EXPORT_FORMATS`
+    :param compress: True to gzip the output as it is produced
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt}")
+
+    lines = csv_lines(survey) if fmt == "csv" else jsonl_lines(survey)
+    blocks = (block.encode("utf-8") for block in _blocks(lines))
+    if not compress:
+        yield from blocks
+        return
+
+    # wbits of 31 gives a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+
+    yield compressor.flush()
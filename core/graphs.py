@@ -0,0 +1,472 @@
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from html import escape
+from pathlib import Path
+
+from core.instrumentation import record_render
+
+# ===========================================================================
+
+logger = logging.getLogger(__name__)
+
+COLOURS = (
+    # Red        green      blue        purple     orange     yellow
+    "#de324c", "#95cf92", "#369acc",  "#9656a2", "#f4895f", "#f8e16f",
+)
+
+# A render marker older than this is assumed to belong to a dead worker
+RENDER_TIMEOUT = 60
+
+# ===========================================================================
+
+def _atomic_write(file, write):
+    # Calls write() with a temporary path that is then renamed to the given
+    # file, so readers in other processes never see a partial file
+    file = Path(file)
+    temp = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+    try:
+        write(temp)
+        os.replace(temp, file)
+    finally:
+        temp.unlink(missing_ok=True)
+
+    return file
+
+
+def current_rss():
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No /proc, settle for the peak size (kilobytes on Linux, bytes on
+        # macOS, this branch only runs on the latter)
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Each process draws every matplotlib graph on the same figure, clearing it
+# between renders. Figures are created directly rather than through pyplot,
+# which keeps a reference to every figure it makes until it is closed.
+_figure = None
+_figure_lock = threading.Lock()
+
+def render_bar_matplotlib(file, labels, data, colours):
+    """Draws a bar graph with matplotlib and saves it as an SVG file. This
+    runs inside the render pool's processes so it must not touch Django.
+
+    Matplotlib is only imported here, processes that never draw a graph
+    don't pay to load it.
+    """
+    global _figure
+    from matplotlib.figure import Figure
+
+    with _figure_lock:
+        if _figure is None:
+            _figure = Figure()
+
+        try:
+            axis = _figure.add_subplot()
+            axis.bar(labels, data, color=colours)
+            return _atomic_write(file,
+                lambda path: _figure.savefig(path, format="svg"))
+        finally:
+            _figure.clear()
+
+
+def pool_render(renderer, file, labels, data, colours):
+    # Entry point for renders in the pool's processes, reports back the
+    # worker's memory use so the pool can be recycled if it grows too large,
+    # along with how long the render took
+    start = time.perf_counter()
+    RENDERERS[renderer](file, labels, data, colours)
+    return current_rss(), time.perf_counter() - start
+
+# ---------------------------------------------------------------------------
+# Native SVG renderer
+
+SVG_WIDTH = 640
+SVG_HEIGHT = 480
+SVG_MARGINS = (20, 20, 50, 60)  # top, right, bottom, left
+SVG_MAX_TICKS = 8
+SVG_LABEL_WIDTH = 28
+
+SVG_STYLE = ("text{font-family:sans-serif;font-size:14px;fill:#333}"
+    ".y{text-anchor:end}.x{text-anchor:middle}"
+    ".grid{stroke:#ddd}.axis{stroke:#333}")
+
+
+def _tick_step(top):
+    # Step between y-axis ticks, 1, 2 or 5 times a power of ten so there are
+    # no more than SVG_MAX_TICKS; counts are whole so never less than 1
+    if top <= SVG_MAX_TICKS:
+        return 1
+
+    raw = top / SVG_MAX_TICKS
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for multiple in (1, 2, 5, 10):
+        step = multiple * magnitude
+        if step >= raw:
+            return step
+
+
+def build_bar_svg(labels, data, colours):
+    """Returns the text of an SVG bar graph. Only draws what the survey
+    results need: one coloured bar per label, a labelled y-axis and grid
+    lines."""
+    top_margin, right_margin, bottom_margin, left_margin = SVG_MARGINS
+    plot_width = SVG_WIDTH - left_margin - right_margin
+    plot_height = SVG_HEIGHT - top_margin - bottom_margin
+    bottom = top_margin + plot_height
+
+    step = _tick_step(max(data, default=0))
+    top = max(step, math.ceil(max(data, default=0) / step) * step)
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" '
+        f'height="{SVG_HEIGHT}" viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}">',
+        f'<style>{SVG_STYLE}</style>',
+    ]
+
+    for tick in range(0, top + 1, step):
+        y = bottom - tick / top * plot_height
+        parts.append(f'<line class="grid" x1="{left_margin}" y1="{y:.1f}" '
+            f'x2="{SVG_WIDTH - right_margin}" y2="{y:.1f}"/>')
+        parts.append(f'<text class="y" x="{left_margin - 8}" '
+            f'y="{y + 5:.1f}">{tick}</text>')
+
+    slot = plot_width / max(len(data), 1)
+    bar_width = slot * 0.8
+
+    # Thin out the x-axis labels when there are too many bars to fit them
+    label_every = math.ceil(SVG_LABEL_WIDTH / slot)
+    last = len(data) - 1
+    for index, (label, value) in enumerate(zip(labels, data)):
+        label = escape(str(label))
+        height = value / top * plot_height
+        x = left_margin + index * slot + (slot - bar_width) / 2
+        colour = colours[index % len(colours)]
+
+        parts.append(f'<rect x="{x:.1f}" y="{bottom - height:.1f}" '
+            f'width="{bar_width:.1f}" height="{height:.1f}" fill="{colour}">'
+            f'<title>{label}: {value}</title></rect>')
+        if index % label_every == 0 or index == last:
+            parts.append(f'<text class="x" x="{x + bar_width / 2:.1f}" '
+                f'y="{bottom + 22}">{label}</text>')
+
+    parts.append(f'<path class="axis" fill="none" d="M{left_margin} '
+        f'{top_margin}V{bottom}H{SVG_WIDTH - right_margin}"/>')
+    parts.append('</svg>')
+    return "".join(parts)
+
+
+def render_bar_svg(file, labels, data, colours):
+    """Saves a bar graph built by :func:`build_bar_svg` as an SVG file"""
+    content = build_bar_svg(labels, data, colours)
+    return _atomic_write(file, lambda path: path.write_text(content))
+
+
+RENDERERS = {
+    "svg": render_bar_svg,
+    "matplotlib": render_bar_matplotlib,
+}
+
+# ---------------------------------------------------------------------------
+
+def graph_key(renderer, question_id, labels, data, colours):
+    """Returns a hash of everything that goes into a question's graph, used
+    to name the cached SVG file"""
+    content = json.dumps([renderer, question_id, labels, data, colours])
+    return hashlib.sha1(content.encode()).hexdigest()[:20]
+
+# ---------------------------------------------------------------------------
+
+def _claim(marker):
+    # Atomically create the marker file holding a unique owner id, only one
+    # process across all the server's workers gets to render a given
+    # question at a time
+    owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+    temp = marker.with_name(f".{marker.name}.{owner}.tmp")
+    temp.write_text(owner)
+    try:
+        os.link(temp, marker)
+        return True
+    except FileExistsError:
+        pass
+    finally:
+        temp.unlink(missing_ok=True)
+
+    try:
+        stale = marker.read_text()
+    except FileNotFoundError:
+        # Finished in the meantime
+        return False
+
+    if is_rendering(marker):
+        return False
+
+    return _take_over(marker, stale, owner)
+
+
+def _take_over(marker, stale, owner):
+    # Replaces a marker left by a worker that died mid render. Several
+    # processes can find the same stale marker, the one that links it to a
+    # tombstone named after its owner takes it over. The link fails if the
+    # tombstone exists, and a tombstone holding anything else means the
+    # marker was already taken over and replaced.
+    tombstone = marker.with_name(f".{marker.name}.{stale}.stale")
+    try:
+        os.link(marker, tombstone)
+    except (FileExistsError, FileNotFoundError):
+        return False
+
+    try:
+        if tombstone.read_text() != stale:
+            return False
+
+        _atomic_write(marker, lambda path: path.write_text(owner))
+    finally:
+        tombstone.unlink(missing_ok=True)
+
+    try:
+        return marker.read_text() == owner
+    except FileNotFoundError:
+        return False
+
+
+def is_rendering(marker):
+    """Returns True if a render for the given marker file is in progress in
+    any process"""
+    try:
+        age = time.time() - marker.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+    return age < RENDER_TIMEOUT
+
+
+class RenderQueue:
+    """Feeds graph renders to a bounded pool of background processes so web
+    workers don't block on matplotlib. Renders are de-duplicated using a
+    marker file per question, so concurrent requests for the same graph, even
+    across server processes, result in a single render.
+
+    Pool processes are replaced after ``max_tasks`` renders, and the whole
+    pool is replaced if a process reports more than ``max_rss`` bytes
+    resident, putting an upper bound on the memory rendering can use. See
+    :attr:`stats` for render counts and memory use.
+
+    :param renderer: name of the renderer in :data:`RENDERERS` to use
+    :param workers: maximum number of render processes, 0 renders inline in
+        the calling thread. The native "svg" renderer is cheap enough that it
+        always renders inline.
+    :param max_tasks: renders a pool process does before being replaced
+    :param max_rss: resident size in bytes above which the pool is replaced
+    """
+    def __init__(self, renderer, workers, max_tasks=None, max_rss=None):
+        self.renderer = renderer
+        self.render = RENDERERS[renderer]
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.inline = workers == 0 or renderer == "svg"
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "renders": 0,
+            "failures": 0,
+            "recycles": 0,
+            "last_rss": 0,
+            "max_rss": 0,
+        }
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # spawn rather than fork, web servers are often multi-threaded
+            # and hold database connections
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=self.max_tasks)
+
+        return self._executor
+
+    def submit(self, marker, file, labels, data, colours):
+        """Queues a bar graph render.
+
+        :param marker: path of the marker file used to de-duplicate renders,
+            it exists for as long as the render is in progress
+        :param file: path of the SVG file to create
+        :returns: False if a render for this marker was already in progress
+        """
+        with self._lock:
+            if marker in self._pending or not _claim(marker):
+                return False
+
+            if self.inline:
+                try:
+                    start = time.perf_counter()
+                    self.render(file, labels, data, colours)
+                    record_render(self.renderer, file.name,
+                        time.perf_counter() - start)
+                    self._record(current_rss())
+                except Exception:
+                    self.stats["failures"] += 1
+                    raise
+                finally:
+                    marker.unlink(missing_ok=True)
+
+                return True
+
+            future = self.executor.submit(pool_render, self.renderer, file,
+                labels, data, colours)
+            self._pending[marker] = future
+
+        future.add_done_callback(partial(self._done, marker))
+        return True
+
+    def _record(self, rss):
+        self.stats["renders"] += 1
+        self.stats["last_rss"] = rss
+        self.stats["max_rss"] = max(self.stats["max_rss"], rss)
+
+    def _done(self, marker, future):
+        marker.unlink(missing_ok=True)
+
+        with self._lock:
+            self._pending.pop(marker, None)
+            if future.exception() is not None:
+                self.stats["failures"] += 1
+                logger.error("Graph render for %s failed", marker,
+                    exc_info=future.exception())
+                return
+
+            rss, duration = future.result()
+            record_render(self.renderer, marker.with_suffix(".svg").name,
+                duration)
+            self._record(rss)
+            if self.max_rss and rss > self.max_rss and self._executor:
+                # Let running renders finish, the next submit starts a fresh
+                # pool
+                logger.warning("Render process using %d bytes, recycling "
+                    "pool", rss)
+                self.stats["recycles"] += 1
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+class GraphCache:
+    """Content addressed cache of rendered graphs. Files are named by
+    :func:`graph_key` so finding a graph is a single ``stat`` and a change in
+    the answers results in a new name rather than overwriting a file another
+    worker may be serving. Old graphs are evicted least recently used first
+    once the total size of all the survey directories exceeds the budget.
+
+    :param root: directory containing the ``s{survey id}`` directories
+    :param max_bytes: disk budget for cached graphs
+    :param evict_interval: minimum seconds between eviction scans
+    """
+    PATTERN = "s*/q-*.svg"
+
+    def __init__(self, root, max_bytes, evict_interval):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self._last_evict = 0
+
+    def path(self, survey_id, question_id, key):
+        survey_dir = self.root / f"s{survey_id}"
+        survey_dir.mkdir(exist_ok=True)
+        return survey_dir / f"q-{question_id}-{key}.svg"
+
+    def url(self, path):
+        return path.relative_to(self.root).as_posix()
+
+    def get(self, path):
+        """Returns True if the graph is cached, marking it as recently
+        used"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def evict(self, force=False):
+        """Removes the least recently used graphs until the cache is within
+        its budget. Scans are throttled to one per ``evict_interval`` unless
+        ``force`` is set.
+
+        :returns: number of files removed
+        """
+        now = time.time()
+        if not force and now - self._last_evict < self.evict_interval:
+            return 0
+
+        self._last_evict = now
+        entries = []
+        total = 0
+        for path in self.root.glob(self.PATTERN):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+
+        return removed
+
+
+_queue = None
+_cache = None
+
+def get_render_queue():
+    """Returns this process's :class:`RenderQueue`, configured by the
+    ``GRAPH_RENDERER``, ``GRAPH_RENDER_WORKERS``,
+    ``GRAPH_RENDER_MAX_TASKS`` and ``GRAPH_RENDER_MAX_RSS`` settings"""
+    global _queue
+    if _queue is None:
+        from django.conf import settings
+        _queue = RenderQueue(settings.GRAPH_RENDERER,
+            settings.GRAPH_RENDER_WORKERS, settings.GRAPH_RENDER_MAX_TASKS,
+            settings.GRAPH_RENDER_MAX_RSS)
+
+    return _queue
+
+
+def get_graph_cache():
+    """Returns this process's :class:`GraphCache`, configured by the
+    ``MEDIA_ROOT``, ``GRAPH_CACHE_MAX_BYTES`` and
+    ``GRAPH_CACHE_EVICT_INTERVAL`` settings"""
+    global _cache
+    if _cache is None:
+        from django.conf import settings
+        _cache = GraphCache(settings.MEDIA_ROOT,
+            settings.GRAPH_CACHE_MAX_BYTES,
+            settings.GRAPH_CACHE_EVICT_INTERVAL)
+
+    return _cache
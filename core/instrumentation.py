@@ -0,0 +1,245 @@
+"""Optional per-request timing and SQL measurements, kept in a bounded
+in-memory buffer and shown to staff on the instrumentation page.
+
+Turn it on by adding ``core.instrumentation.InstrumentationMiddleware`` to
+the start of ``MIDDLEWARE``. When the middleware isn't installed nothing is
+recorded and the only cost is a check in the graph renderers.
+
+This module doesn't import Django at the top level, the graph code running
+in render processes uses it.
+"""
+import heapq
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# ===========================================================================
+
+class Recorder:
+    """Ring buffers of the most recent requests and graph renders.
+
+    :param size: number of requests, and separately renders, kept
+    :param slow_queries: number of slowest SQL statements kept per request
+    """
+    def __init__(self, size, slow_queries):
+        self.slow_queries = slow_queries
+        self.requests = deque(maxlen=size)
+        self.renders = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add_request(self, view, wall, queries, sql_time, slowest):
+        with self._lock:
+            self.requests.append((view, wall, queries, sql_time, slowest))
+
+    def add_render(self, renderer, name, duration):
+        with self._lock:
+            self.renders.append((renderer, name, duration))
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+            self.renders.clear()
+
+    def summary(self):
+        """Returns a dict summarizing the buffered requests per view and the
+        renders per renderer. Times are in milliseconds."""
+        with self._lock:
+            requests = list(self.requests)
+            renders = list(self.renders)
+
+        views = {}
+        for view, wall, queries, sql_time, slowest in requests:
+            entry = views.setdefault(view, {
+                "requests": 0,
+                "wall_total": 0,
+                "wall_max": 0,
+                "queries_total": 0,
+                "queries_max": 0,
+                "sql_total": 0,
+                "slowest": [],
+            })
+            entry["requests"] += 1
+            entry["wall_total"] += wall
+            entry["wall_max"] = max(entry["wall_max"], wall)
+            entry["queries_total"] += queries
+            entry["queries_max"] = max(entry["queries_max"], queries)
+            entry["sql_total"] += sql_time
+            entry["slowest"].extend(slowest)
+
+        for entry in views.values():
+            count = entry["requests"]
+            entry["wall_mean"] = entry["wall_total"] / count
+            entry["queries_mean"] = entry["queries_total"] / count
+            entry["sql_mean"] = entry["sql_total"] / count
+            entry["slowest"] = [{"ms": _ms(duration), "sql": sql} for
+                duration, sql in heapq.nlargest(self.slow_queries,
+                entry["slowest"])]
+            for key in ("wall_total", "wall_max", "wall_mean", "sql_total",
+                    "sql_mean"):
+                entry[key] = _ms(entry[key])
+
+            entry["queries_mean"] = round(entry["queries_mean"], 2)
+
+        graphs = {}
+        for renderer, name, duration in renders:
+            entry = graphs.setdefault(renderer, {
+                "renders": 0,
+                "total": 0,
+                "max": 0,
+                "slowest": None,
+            })
+            entry["renders"] += 1
+            entry["total"] += duration
+            if duration > entry["max"]:
+                entry["max"] = duration
+                entry["slowest"] = name
+
+        for entry in graphs.values():
+            entry["mean"] = _ms(entry["total"] / entry["renders"])
+            entry["total"] = _ms(entry["total"])
+            entry["max"] = _ms(entry["max"])
+
+        return {
+            "buffered_requests": len(requests),
+            "buffered_renders": len(renders),
+            "views": dict(sorted(views.items(),
+                key=lambda item: -item[1]["wall_total"])),
+            "graphs": graphs,
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+# This process's Recorder, created by the middleware. None means
+# instrumentation is off.
+recorder = None
+
+def record_render(renderer, name, duration):
+    """Records how long a graph render took, if instrumentation is on.
+
+    :param renderer: name of the renderer used
+    :param name: what was rendered, typically the file name
+    :param duration: render time in seconds
+    """
+    if recorder is not None:
+        recorder.add_render(renderer, name, duration)
+
+# ===========================================================================
+
+class QueryMeasurement:
+    """Counts and times the SQL statements run during a request, keeping the
+    slowest of them.
+
+    :param slow_queries: number of slowest statements kept
+    """
+    def __init__(self, slow_queries):
+        self.slow_queries = slow_queries
+        self.queries = 0
+        self.sql_time = 0
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.queries += 1
+            self.sql_time += duration
+
+            item = (duration, sql)
+            if len(self.slowest) < self.slow_queries:
+                heapq.heappush(self.slowest, item)
+            elif self.slowest and duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+
+# Measurement for the request being handled in the current context. Context
+# variables follow sync_to_async() into worker threads, which use their own
+# database connections, so every connection gets a wrapper that reads it.
+_measurement = ContextVar("instrumentation_measurement", default=None)
+
+def _execute_wrapper(execute, sql, params, many, context):
+    measurement = _measurement.get()
+    if measurement is None:
+        return execute(sql, params, many, context)
+
+    return measurement(execute, sql, params, many, context)
+
+
+def _install_wrapper(sender, connection, **kwargs):
+    # Connected to connection_created, wrappers outlive reconnects
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+class InstrumentationMiddleware:
+    """Records the wall time, SQL query count, SQL time and slowest
+    statements of every request, grouped by view name. Configured by the
+    ``INSTRUMENTATION_BUFFER_SIZE`` and ``INSTRUMENTATION_SLOW_QUERIES``
+    settings.
+
+    Works in both sync and async middleware chains, so the async respondent
+    views aren't pushed through a thread to be measured."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from django.conf import settings
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        global recorder
+        self.get_response = get_response
+        if recorder is None:
+            recorder = Recorder(settings.INSTRUMENTATION_BUFFER_SIZE,
+                settings.INSTRUMENTATION_SLOW_QUERIES)
+
+        connection_created.connect(_install_wrapper,
+            dispatch_uid="core.instrumentation")
+        for connection in connections.all(initialized_only=True):
+            _install_wrapper(None, connection)
+
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        measurement = QueryMeasurement(recorder.slow_queries)
+        token = _measurement.set(measurement)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _measurement.reset(token)
+
+        self.record(request, time.perf_counter() - start, measurement)
+        return response
+
+    async def __acall__(self, request):
+        measurement = QueryMeasurement(recorder.slow_queries)
+        token = _measurement.set(measurement)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _measurement.reset(token)
+
+        self.record(request, time.perf_counter() - start, measurement)
+        return response
+
+    def record(self, request, wall, measurement):
+        view = "<unresolved>"
+        if request.resolver_match is not None:
+            view = request.resolver_match.view_name
+
+        recorder.add_request(view, wall, measurement.queries,
+            measurement.sql_time, measurement.slowest)
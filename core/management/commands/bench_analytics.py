@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Times cross-tabs and pivots over synthetic columns to check "
+        "the analytics stay vectorized at large respondent counts.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--respondents", type=int, default=1_000_000,
+            help="Number of respondents to simulate, default 1,000,000")
+
+    def handle(self, *args, **options):
+        import numpy as np
+
+        from core.analytics import Column, crosstab, pivot
+
+        size = options["respondents"]
+        rand = np.random.default_rng(42)
+
+        # A CHOICE column with 6 choices and a STAR column, both with about
+        # 10% of respondents not answering
+        choice_codes = rand.integers(-1, 6, size, dtype=np.int32)
+        choice = Column(None, choice_codes, [f"c{num}" for num in range(6)])
+
+        stars = rand.integers(1, 6, size).astype(np.float64)
+        stars[rand.random(size) < 0.1] = np.nan
+        star_codes = np.where(np.isnan(stars), -1, 5 - np.nan_to_num(stars))
+        star = Column(None, star_codes.astype(np.int32),
+            ["5", "4", "3", "2", "1"], stars)
+
+        timings = [
+            ("crosstab", lambda: crosstab(choice, star)),
+            ("pivot", lambda: pivot(choice, star)),
+            ("describe", lambda: star.describe()),
+        ]
+
+        print(f"{size:,} respondents")
+        for name, call in timings:
+            start = time.perf_counter()
+            call()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>10}: {elapsed * 1000:.1f}ms")
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Compares the sync and async respondent views by running many "
+        "simulated respondents through a survey concurrently, using Django's "
+        "WSGI and ASGI request handlers in-process.")
+
+    # URLs have to be imported after the view mode is picked
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug", type=str,
+            help="Slug of the survey to fill in")
+        parser.add_argument("--respondents", type=int, default=200,
+            help="Number of respondents to simulate, default 200")
+        parser.add_argument("--concurrency", type=int, default=20,
+            help="Number of respondents in flight at once, default 20")
+        parser.add_argument("--mode", choices=("sync", "async"),
+            help=("Only run this mode in the current process and print the "
+                "result as JSON"))
+
+    def handle(self, *args, **options):
+        if options["mode"]:
+            result = self.run_mode(options)
+            print(json.dumps(result))
+            return
+
+        # Each mode runs in its own interpreter as the view mode is fixed
+        # once the URLs have been loaded
+        print(f"{'Mode':<8} {'Requests/s':>12} {'p50 (ms)':>10} "
+            f"{'p95 (ms)':>10} {'Errors':>8}")
+        for mode in ("sync", "async"):
+            args = [sys.executable, "manage.py", "bench_async",
+                options["slug"], "--mode", mode,
+                "--respondents", str(options["respondents"]),
+                "--concurrency", str(options["concurrency"])]
+            proc = subprocess.run(args, cwd=settings.BASE_DIR,
+                capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise CommandError(f"{mode} run failed:\n{proc.stderr}")
+
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"{mode:<8} {result['rate']:>12.1f} {result['p50']:>10.1f} "
+                f"{result['p95']:>10.1f} {result['errors']:>8}")
+
+    # -----------------------------------------------------------------------
+
+    def run_mode(self, options):
+        from django.test.utils import setup_test_environment
+
+        from core.models import Survey, CompiledSurvey
+        from core.simulate import delete_respondents
+
+        settings.ASYNC_RESPONDENT_VIEWS = options["mode"] == "async"
+        setup_test_environment()
+
+        try:
+            survey = Survey.objects.get(slug=options["slug"])
+        except Survey.DoesNotExist:
+            raise CommandError(f"No survey with slug {options['slug']}")
+
+        compiled = CompiledSurvey.get(survey)
+        self.tokens = []
+
+        start = time.perf_counter()
+        try:
+            if options["mode"] == "sync":
+                latencies, errors = self.run_sync(survey, compiled, options)
+            else:
+                latencies, errors = asyncio.run(self.run_async(survey,
+                    compiled, options))
+        finally:
+            elapsed = time.perf_counter() - start
+            delete_respondents(survey, self.tokens)
+
+        latencies.sort()
+        return {
+            "rate": len(latencies) / elapsed,
+            "p50": statistics.median(latencies) * 1000,
+            "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+            "errors": errors,
+        }
+
+    def run_sync(self, survey, compiled, options):
+        from django.test import Client
+
+        from core.simulate import respondent_flow
+
+        latencies = []
+        errors = 0
+
+        def respondent(num):
+            nonlocal errors
+            client = Client()
+            rand = random.Random(num)
+            try:
+                for _, method, url, data in respondent_flow(client, survey,
+                        compiled, rand):
+                    start = time.perf_counter()
+                    if data is not None:
+                        response = method(url, data)
+                    else:
+                        response = method(url)
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code >= 400:
+                        errors += 1
+            finally:
+                self.keep_token(client, survey)
+
+                # Each worker thread has its own database connection
+                connections.close_all()
+
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            list(pool.map(respondent, range(options["respondents"])))
+
+        return latencies, errors
+
+    async def run_async(self, survey, compiled, options):
+        from django.test import AsyncClient
+
+        from core.simulate import respondent_flow
+
+        latencies = []
+        errors = 0
+        limit = asyncio.Semaphore(options["concurrency"])
+
+        async def respondent(num):
+            nonlocal errors
+            async with limit:
+                client = AsyncClient()
+                rand = random.Random(num)
+                try:
+                    for _, method, url, data in respondent_flow(client,
+                            survey, compiled, rand):
+                        start = time.perf_counter()
+                        if data is not None:
+                            response = await method(url, data)
+                        else:
+                            response = await method(url)
+                        latencies.append(time.perf_counter() - start)
+                        if response.status_code >= 400:
+                            errors += 1
+                finally:
+                    self.keep_token(client, survey)
+
+        await asyncio.gather(*[respondent(num) for num in
+            range(options["respondents"])])
+
+        return latencies, errors
+
+    def keep_token(self, client, survey):
+        """Records the respondent's token so it can be deleted afterwards"""
+        from core.simulate import respondent_token
+
+        token = respondent_token(client, survey)
+        if token is not None:
+            self.tokens.append(token)
@@ -0,0 +1,257 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import (Survey, SurveyTally, Page, Question, QuestionTypes,
+    AnswerGroup)
+
+# ===========================================================================
+
+QUESTIONS_PER_PAGE = 5
+PAGES = 2
+
+# Indexes the schema had before the composite ones replaced them, recreated
+# when measuring the old plans
+OLD_INDEXES = [
+    'CREATE INDEX "bench_answer_group" ON "core_answer" ("answer_group_id")',
+    'CREATE INDEX "bench_question" ON "core_answer" ("question_id")',
+    'CREATE INDEX "bench_token" ON "core_answergroup" ("token")',
+]
+
+NEW_INDEXES = ["page_survey_rank"]
+
+# Unique constraints are part of their table's definition
+NEW_CONSTRAINTS = {
+    "core_answer": (', CONSTRAINT "unique_answer" UNIQUE ("answer_group_id", '
+        '"question_id")'),
+    "core_answergroup": (', CONSTRAINT "unique_survey_token" UNIQUE '
+        '("survey_id", "token")'),
+}
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Fills a scratch copy of the database with synthetic answers and "
+        "prints the EXPLAIN QUERY PLAN and timing of each hot query with and "
+        "without the composite indexes. SQLite only.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--answers", type=int, default=1_000_000,
+            help="Number of answers to create, default 1,000,000")
+        parser.add_argument("--repeat", type=int, default=200,
+            help="Times each query is run when timing, default 200")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("EXPLAIN QUERY PLAN is only supported on "
+                "SQLite")
+
+        # Run against a throwaway database built from the migrations
+        old_name = connection.creation.create_test_db(verbosity=0,
+            autoclobber=True, serialize=False)
+        try:
+            self.bench(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def bench(self, options):
+        rand = random.Random(42)
+        groups = options["answers"] // (QUESTIONS_PER_PAGE * PAGES)
+
+        print(f"Creating {groups * QUESTIONS_PER_PAGE * PAGES:,} answers...")
+        survey, questions = self.populate(groups, rand)
+
+        # Parameters for a sample of lookups spread across the data
+        samples = []
+        rows = list(AnswerGroup.objects.values_list("id", "token"))
+        for _ in range(options["repeat"]):
+            group_id, token = rand.choice(rows)
+            page = rand.randint(1, PAGES)
+            page_questions = [q.id for q in questions[page - 1]]
+            samples.append((group_id, token, page, page_questions))
+
+        self.samples = samples
+        queries = self.hot_queries(survey)
+
+        print("\n==== With composite indexes")
+        fast = self.measure(queries)
+
+        # SQLite DDL is transactional, drop the new indexes, put back the
+        # old ones and roll it all back once measured
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for table, constraint in NEW_CONSTRAINTS.items():
+                    self.drop_constraint(cursor, table, constraint)
+                for name in NEW_INDEXES:
+                    cursor.execute(f'DROP INDEX "{name}"')
+                for sql in OLD_INDEXES:
+                    cursor.execute(sql)
+                cursor.execute("ANALYZE")
+
+            print("\n==== With the previous single column indexes")
+            slow = self.measure(queries)
+            transaction.set_rollback(True)
+
+        print(f"\n{'Query':<28} {'Before (us)':>12} {'After (us)':>12} "
+            f"{'Speedup':>9}")
+        for name in queries:
+            speedup = slow[name] / fast[name] if fast[name] else 0
+            print(f"{name:<28} {slow[name]:>12.1f} {fast[name]:>12.1f} "
+                f"{speedup:>8.1f}x")
+
+    def drop_constraint(self, cursor, table, constraint):
+        # A unique constraint's index can't be dropped on its own, rebuild
+        # the table without it and put its other indexes back
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s",
+            [table])
+        sql = cursor.fetchone()[0]
+        if constraint not in sql:
+            raise CommandError(f"Unexpected {table} table definition")
+
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = %s AND sql IS NOT NULL", [table])
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        scratch = table.replace("core_", "bench_", 1)
+        sql = sql.replace(constraint, "").replace(f'"{table}"',
+            f'"{scratch}"', 1)
+        cursor.execute(sql)
+        cursor.execute(f'INSERT INTO "{scratch}" SELECT * FROM "{table}"')
+        cursor.execute(f'DROP TABLE "{table}"')
+        cursor.execute(f'ALTER TABLE "{scratch}" RENAME TO "{table}"')
+        for index in indexes:
+            cursor.execute(index)
+
+    def populate(self, groups, rand):
+        survey = Survey.objects.create(name="Index Benchmark",
+            slug="index-benchmark")
+
+        types = [QuestionTypes.BOOLEAN, QuestionTypes.STAR, QuestionTypes.NUM,
+            QuestionTypes.CHOICE, QuestionTypes.TEXT]
+        choices = [["R", "Red"], ["G", "Green"], ["B", "Blue"]]
+        questions = []
+        for _ in range(PAGES):
+            page = Page.objects.create(survey=survey)
+            page_questions = []
+            for question_type in types[:QUESTIONS_PER_PAGE]:
+                page_questions.append(Question.objects.create(page=page,
+                    question_type=question_type, question_text="?",
+                    choices=choices, num_answer_min=1, num_answer_max=10))
+            questions.append(page_questions)
+
+        now = timezone.now().isoformat()
+        alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
+        tokens = set()
+        while len(tokens) < groups:
+            tokens.add("".join(rand.choices(alphabet, k=18)))
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany('INSERT INTO "core_answergroup" ("created", '
+                '"updated", "survey_id", "token", "issued") VALUES (%s, %s, '
+                '%s, %s, %s)', [(now, now, survey.id, token, False)
+                for token in tokens])
+            SurveyTally.add(survey.id, groups)
+
+            group_ids = AnswerGroup.objects.values_list("id", flat=True)
+            answers = []
+            for group_id in group_ids.iterator():
+                for page_questions in questions:
+                    for question in page_questions:
+                        answers.append(answer_row(now, group_id, question,
+                            rand))
+
+                if len(answers) >= 50_000:
+                    self.insert_answers(cursor, answers)
+                    answers = []
+
+            self.insert_answers(cursor, answers)
+            cursor.execute("ANALYZE")
+
+        return survey, questions
+
+    def insert_answers(self, cursor, answers):
+        cursor.executemany('INSERT INTO "core_answer" ("created", "updated", '
+            '"answer_group_id", "question_id", "bool_answer", "num_answer", '
+            '"star_answer", "text_answer", "choices_answer") VALUES (%s, %s, '
+            '%s, %s, %s, %s, %s, %s, %s)', answers)
+
+    def hot_queries(self, survey):
+        """Returns a dict of name to a function that takes a sample and
+        returns the (sql, params) of the query"""
+        answer_columns = ('"id", "bool_answer", "num_answer", "star_answer", '
+            '"text_answer", "choices_answer"')
+
+        def page_answers(sample):
+            group_id, _, _, page_questions = sample
+            marks = ", ".join(["%s"] * len(page_questions))
+            return (f'SELECT {answer_columns} FROM "core_answer" WHERE '
+                f'"answer_group_id" = %s AND "question_id" IN ({marks})',
+                [group_id, *page_questions])
+
+        def one_answer(sample):
+            group_id, _, _, page_questions = sample
+            return (f'SELECT {answer_columns} FROM "core_answer" WHERE '
+                '"answer_group_id" = %s AND "question_id" = %s',
+                [group_id, page_questions[0]])
+
+        def group_by_token(sample):
+            _, token, _, _ = sample
+            return ('SELECT "id", "page_id" FROM "core_answergroup" WHERE '
+                '"survey_id" = %s AND "token" = %s', [survey.id, token])
+
+        def page_by_rank(sample):
+            _, _, rank, _ = sample
+            return ('SELECT "id" FROM "core_page" WHERE "survey_id" = %s AND '
+                '"rank" = %s', [survey.id, rank])
+
+        def group_answers(sample):
+            group_id, _, _, _ = sample
+            return ('SELECT "question_id", "num_answer" FROM "core_answer" '
+                'WHERE "answer_group_id" = %s', [group_id])
+
+        return {
+            "page answers (initial)": page_answers,
+            "answer by group+question": one_answer,
+            "group by survey+token": group_by_token,
+            "page by survey+rank": page_by_rank,
+            "all answers for a group": group_answers,
+        }
+
+    def measure(self, queries):
+        """Prints the plan for each query then times it, returns a dict of
+        name to mean time in microseconds"""
+        results = {}
+        with connection.cursor() as cursor:
+            for name, build in queries.items():
+                sql, params = build(self.samples[0])
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                plan = "; ".join(row[-1] for row in cursor.fetchall())
+                print(f"{name}:\n    {plan}")
+
+                start = time.perf_counter()
+                for sample in self.samples:
+                    cursor.execute(*build(sample))
+                    cursor.fetchall()
+                elapsed = time.perf_counter() - start
+                results[name] = elapsed / len(self.samples) * 1_000_000
+
+        return results
+
+
+def answer_row(now, group_id, question, rand):
+    values = [None] * 5
+    if question.question_type == QuestionTypes.BOOLEAN:
+        values[0] = rand.random() < 0.5
+    elif question.question_type == QuestionTypes.NUM:
+        values[1] = rand.randint(1, 10)
+    elif question.question_type == QuestionTypes.STAR:
+        values[2] = rand.randint(1, 5)
+    elif question.question_type == QuestionTypes.TEXT:
+        values[3] = "text"
+    elif question.question_type == QuestionTypes.CHOICE:
+        values[4] = rand.choice("RGB")
+
+    return (now, now, group_id, question.id, *values)
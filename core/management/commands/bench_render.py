@@ -0,0 +1,55 @@
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.graphs import COLOURS, RENDERERS, current_rss
+
+# ===========================================================================
+
+MB = 1024 * 1024
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Renders thousands of graphs in this process and checks that "
+        "memory use stays flat, exits with an error if it grows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=2000,
+            help="Number of graphs to render, default 2000")
+        parser.add_argument("--renderer", choices=RENDERERS.keys(),
+            default="matplotlib", help="Renderer to use, default matplotlib")
+        parser.add_argument("--tolerance", type=float, default=10,
+            help=("Allowed growth in MB after the warm up renders, "
+                "default 10"))
+
+    def handle(self, *args, **options):
+        render = RENDERERS[options["renderer"]]
+        count = options["count"]
+        warm_up = max(count // 10, 1)
+
+        labels = [str(num) for num in range(1, 11)] + ["None"]
+        rand = random.Random(42)
+
+        samples = []
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as temp:
+            for num in range(count):
+                data = [rand.randint(0, 100) for _ in labels]
+                render(Path(temp) / "graph.svg", labels, data, COLOURS)
+
+                if num + 1 == warm_up or (num + 1) % warm_up == 0:
+                    samples.append(current_rss())
+                    print(f"{num + 1:>8} renders, RSS {samples[-1] / MB:.1f}MB")
+
+        elapsed = time.perf_counter() - start
+        print(f"{count / elapsed:.0f} renders/second")
+
+        growth = (samples[-1] - samples[0]) / MB
+        print(f"RSS growth after warm up: {growth:.1f}MB")
+        if growth > options["tolerance"]:
+            raise CommandError(f"Memory grew by {growth:.1f}MB rendering "
+                f"{count} graphs")
@@ -0,0 +1,64 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# ===========================================================================
+
+# Code run in a fresh interpreter for each scenario
+SCENARIOS = {
+    "manage.py check": ("from django.core.management import "
+        "execute_from_command_line; "
+        "execute_from_command_line(['manage.py', 'check', '-v', '0'])"),
+    "cold WSGI worker": ("from QuizApe.wsgi import application; "
+        "from django.urls import get_resolver; get_resolver().url_patterns"),
+}
+
+# Prefix that loads the plotting stack up front the way core.models used to
+EAGER = ("import matplotlib; matplotlib.use('agg'); "
+    "import matplotlib.pyplot, numpy; ")
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Measures interpreter startup time and peak RSS for "
+        "'manage.py check' and a cold WSGI worker, with and without the "
+        "plotting stack loaded eagerly.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5,
+            help="Number of times to run each scenario, default 5")
+
+    def run_once(self, code):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-c", code],
+            cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Scenario failed: {code}")
+
+        # ru_maxrss is in kilobytes on Linux
+        return elapsed, usage.ru_maxrss / 1024
+
+    def handle(self, *args, **options):
+        runs = options["runs"]
+
+        print(f"{'Scenario':<40} {'Time (ms)':>10} {'RSS (MB)':>10}")
+        for name, code in SCENARIOS.items():
+            for label, prefix in (("lazy", ""), ("eager", EAGER)):
+                times = []
+                rss = []
+                for _ in range(runs):
+                    elapsed, peak = self.run_once(prefix + code)
+                    times.append(elapsed * 1000)
+                    rss.append(peak)
+
+                title = f"{name} ({label})"
+                print(f"{title:<40} {statistics.median(times):>10.1f} "
+                    f"{statistics.median(rss):>10.1f}")
@@ -1,11 +1,13 @@
-import json
+import random
+import time
 
 from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
-from django.db import models
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
 
 from core.models import (Survey, Page, Question, QuestionTypes, AnswerGroup,
-    Answer)
+    Answer, QuestionTally, SurveyTally, CompiledSurvey)
+from core.simulate import AnswerProfile, synthetic_respondent
 
 
 class ColourChoices(models.TextChoices):
@@ -14,10 +16,47 @@ class ColourChoices(models.TextChoices):
     GREEN = 'G'
 
 
+def new_answer(question, group, value=None):
+    # Unsaved answer, written with the others by bulk_create
+    answer = Answer(question=question, answer_group=group)
+    if value is not None:
+        answer.assign_value(value)
+
+    return answer
+
+
 class Command(BaseCommand):
-    help = "Creates sample test data."
+    help = ("Creates sample test data. With --respondents also fills a "
+        "survey with synthetic respondents for testing at scale.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--respondents", type=int, default=0,
+            help="Number of synthetic respondents to add")
+        parser.add_argument("--survey", type=str,
+            help="Slug of an existing survey to add the respondents to, the "
+            "sample data isn't created when given. Defaults to the sample "
+            "survey 'first1'")
+        parser.add_argument("--seed", type=int, default=0,
+            help="Seed for the synthetic answers, default 0")
+        parser.add_argument("--batch", type=int, default=5000,
+            help="Respondents written per transaction, default 5000")
 
     def handle(self, *args, **options):
+        slug = options["survey"]
+        if slug is None:
+            self.create_samples()
+            slug = "first1"
+
+        if options["respondents"]:
+            try:
+                survey = Survey.objects.get(slug=slug)
+            except Survey.DoesNotExist:
+                raise CommandError(f"No survey with slug {slug}")
+
+            self.create_respondents(survey, options["respondents"],
+                options["seed"], options["batch"])
+
+    def create_samples(self):
         # Admin Login
         User.objects.create_superuser("admin", password="admin")
 
@@ -83,39 +122,27 @@ class Command(BaseCommand):
             page=page)
 
         # Answers for Survey 2
+        answers = []
         for _ in range(5):
             ag = AnswerGroup.factory(survey.slug)
-            answer = Answer.objects.create(question=q1, answer_group=ag)
-            answer.set_value(True)
-            answer = Answer.objects.create(question=q2, answer_group=ag)
-            answer.set_value(3)
-            answer = Answer.objects.create(question=q3, answer_group=ag)
-            answer.set_value(8)
-            answer = Answer.objects.create(question=q4, answer_group=ag)
-            answer.set_value("text")
-            answer = Answer.objects.create(question=q5, answer_group=ag)
-            answer.set_value(ColourChoices.RED)
+            answers.append(new_answer(q1, ag, True))
+            answers.append(new_answer(q2, ag, 3))
+            answers.append(new_answer(q3, ag, 8))
+            answers.append(new_answer(q4, ag, "text"))
+            answers.append(new_answer(q5, ag, ColourChoices.RED))
 
         for _ in range(3):
             ag = AnswerGroup.factory(survey.slug)
-            answer = Answer.objects.create(question=q1, answer_group=ag)
-            answer.set_value(False)
-            answer = Answer.objects.create(question=q2, answer_group=ag)
-            answer.set_value(2)
-            answer = Answer.objects.create(question=q3, answer_group=ag)
-            answer.set_value(7)
-            answer = Answer.objects.create(question=q4, answer_group=ag)
-            answer.set_value("blah")
-            answer = Answer.objects.create(question=q5, answer_group=ag)
-            answer.set_value(ColourChoices.BLUE)
+            answers.append(new_answer(q1, ag, False))
+            answers.append(new_answer(q2, ag, 2))
+            answers.append(new_answer(q3, ag, 7))
+            answers.append(new_answer(q4, ag, "blah"))
+            answers.append(new_answer(q5, ag, ColourChoices.BLUE))
 
         # Empty Answers
         ag = AnswerGroup.factory(survey.slug)
-        Answer.objects.create(question=q1, answer_group=ag)
-        Answer.objects.create(question=q2, answer_group=ag)
-        Answer.objects.create(question=q3, answer_group=ag)
-        Answer.objects.create(question=q4, answer_group=ag)
-        Answer.objects.create(question=q5, answer_group=ag)
+        for question in (q1, q2, q3, q4, q5):
+            answers.append(new_answer(question, ag))
 
         # Empty AnswerGroup
         AnswerGroup.factory(survey.slug)
@@ -132,7 +159,48 @@ class Command(BaseCommand):
         for _ in range(1, 10):
             for num in range(2, 8):
                 ag = AnswerGroup.factory(survey.slug)
-                Answer.objects.create(question=q1, answer_group=ag,
-                    num_answer=num)
-                Answer.objects.create(question=q2, answer_group=ag,
-                    num_answer=num)
+                answers.append(new_answer(q1, ag, num))
+                answers.append(new_answer(q2, ag, num))
+
+        # bulk_create skips Answer.save(), count the tallies in one go
+        Answer.objects.bulk_create(answers)
+        QuestionTally.rebuild(Question.objects.all())
+
+    def create_respondents(self, survey, count, seed, batch_size):
+        rand = random.Random(seed)
+        compiled = CompiledSurvey.get(survey)
+        pages = [(page, [AnswerProfile(question, rand) for question in
+            page.questions]) for page in compiled.pages]
+
+        start = time.perf_counter()
+        rows = 0
+        remaining = count
+        while remaining > 0:
+            size = min(remaining, batch_size)
+            respondents = [synthetic_respondent(pages, rand) for _ in
+                range(size)]
+
+            with transaction.atomic():
+                groups = AnswerGroup.objects.bulk_create([AnswerGroup(
+                    survey_id=survey.id, page_id=page_id,
+                    token=AnswerGroup.new_token())
+                    for page_id, _ in respondents])
+
+                answers = []
+                for group, (_, values) in zip(groups, respondents):
+                    for question, field, value in values:
+                        answers.append(Answer(question_id=question.id,
+                            answer_group_id=group.id, **{field: value}))
+
+                Answer.objects.bulk_create(answers)
+                SurveyTally.add(survey.id, len(groups))
+
+            rows += len(groups) + len(answers)
+            remaining -= size
+            elapsed = time.perf_counter() - start
+            print(f"{count - remaining:,} respondents, {rows:,} rows, "
+                f"{rows / elapsed:,.0f} rows/s")
+
+        tally_start = time.perf_counter()
+        QuestionTally.rebuild(Question.objects.filter(page__survey=survey))
+        print(f"Rebuilt tallies in {time.perf_counter() - tally_start:.1f}s")
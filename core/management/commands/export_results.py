@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.export import EXPORT_FORMATS, export_stream
+from core.models import Survey
+
+
+class Command(BaseCommand):
+    help = ("Exports a survey's responses with one row per respondent and "
+        "one column per question.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug", type=str, help="Slug of the survey")
+        parser.add_argument("--format", choices=EXPORT_FORMATS.keys(),
+            default="csv", help="Output format, defaults to csv")
+        parser.add_argument("--gzip", action="store_true",
+            help="Compress the output with gzip")
+        parser.add_argument("--output", type=str,
+            help="File to write to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(slug=options["slug"])
+        except Survey.DoesNotExist:
+            raise CommandError(f"No survey with slug {options['slug']}")
+
+        stream = export_stream(survey, options["format"], options["gzip"])
+        if options["output"]:
+            with open(options["output"], "wb") as f:
+                for block in stream:
+                    f.write(block)
+        else:
+            for block in stream:
+                sys.stdout.buffer.write(block)
+
+            sys.stdout.buffer.flush()
@@ -0,0 +1,48 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.export import token_csv_lines
+from core.models import Survey, AnswerGroup, CompiledSurvey
+
+
+class Command(BaseCommand):
+    help = ("Creates AnswerGroups ahead of time for a panel survey and "
+        "writes a CSV of their tokens and personalised start links.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug", type=str, help="Slug of the survey")
+        parser.add_argument("count", type=int,
+            help="Number of tokens to issue")
+        parser.add_argument("--base-url", type=str, default="",
+            help="Scheme and host of the site, e.g. https://example.com, "
+            "defaults to relative links")
+        parser.add_argument("--batch", type=int, default=10_000,
+            help="Groups inserted per transaction, default 10,000")
+        parser.add_argument("--output", type=str,
+            help="File to write the CSV to, defaults to stdout")
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(slug=options["slug"])
+        except Survey.DoesNotExist:
+            raise CommandError(f"No survey with slug {options['slug']}")
+
+        if CompiledSurvey.get(survey).first_page is None:
+            raise CommandError(f"Survey {survey.slug} has no pages")
+
+        start = time.perf_counter()
+        batches = AnswerGroup.issue_tokens(survey, options["count"],
+            options["batch"])
+        lines = token_csv_lines(survey, batches,
+            options["base_url"].rstrip("/"))
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(lines)
+
+            elapsed = time.perf_counter() - start
+            print(f"Issued {options['count']} tokens in {elapsed:.1f}s")
+        else:
+            sys.stdout.writelines(lines)
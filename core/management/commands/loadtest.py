@@ -0,0 +1,203 @@
+import json
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+
+# ===========================================================================
+
+PERCENTILES = (50, 95, 99)
+
+# ===========================================================================
+
+class ViewStats:
+    """Measurements for the requests made to a single view"""
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.lock_errors = 0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        content = {
+            "requests": len(latencies) + self.errors + self.lock_errors,
+            "errors": self.errors,
+            "lock_errors": self.lock_errors,
+        }
+
+        for percentile in PERCENTILES:
+            value = None
+            if latencies:
+                index = min(len(latencies) * percentile // 100,
+                    len(latencies) - 1)
+                value = round(latencies[index] * 1000, 2)
+
+            content[f"p{percentile}_ms"] = value
+
+        if self.queries:
+            content["queries_mean"] = round(sum(self.queries) /
+                len(self.queries), 2)
+            content["queries_max"] = max(self.queries)
+        else:
+            content["queries_mean"] = None
+            content["queries_max"] = None
+
+        return content
+
+
+class Command(BaseCommand):
+    help = ("Load tests the respondent pages by sending concurrent simulated "
+        "respondents through a survey with random answers, then reports "
+        "throughput, latency, query counts and database lock errors per "
+        "view as JSON. The simulated respondents are deleted when it "
+        "finishes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug", type=str,
+            help="Slug of the survey to fill in")
+        parser.add_argument("--respondents", type=int, default=500,
+            help="Number of respondents to simulate, default 500")
+        parser.add_argument("--concurrency", type=int, default=20,
+            help="Number of respondents in flight at once, default 20")
+        parser.add_argument("--seed", type=int, default=0,
+            help="Seed for the random answers, default 0")
+        parser.add_argument("--output", type=str,
+            help="File to write the JSON results to, defaults to stdout")
+        parser.add_argument("--keep", action="store_true",
+            help="Leave the simulated respondents in the survey's results")
+
+    def handle(self, *args, **options):
+        from django.test.utils import setup_test_environment
+
+        from core.models import Survey, CompiledSurvey
+        from core.simulate import delete_respondents
+
+        try:
+            survey = Survey.objects.get(slug=options["slug"])
+        except Survey.DoesNotExist:
+            raise CommandError(f"No survey with slug {options['slug']}")
+
+        setup_test_environment()
+        compiled = CompiledSurvey.get(survey)
+
+        self.stats = {}
+        self.tokens = []
+        self.lock = threading.Lock()
+        seed = options["seed"]
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(options["concurrency"]) as pool:
+                list(pool.map(lambda num: self.respondent(survey, compiled,
+                    random.Random(seed + num)),
+                    range(options["respondents"])))
+        finally:
+            elapsed = time.perf_counter() - start
+            if not options["keep"]:
+                delete_respondents(survey, self.tokens)
+
+        requests = sum(len(stats.latencies) for stats in self.stats.values())
+        result = {
+            "commit": git_commit(),
+            "survey": survey.slug,
+            "respondents": options["respondents"],
+            "concurrency": options["concurrency"],
+            "seed": seed,
+            "async_views": settings.ASYNC_RESPONDENT_VIEWS,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(requests / elapsed, 2),
+            "respondents_per_s": round(options["respondents"] / elapsed, 2),
+            "views": {name: stats.summary() for name, stats in
+                self.stats.items()},
+        }
+
+        content = json.dumps(result, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(content + "\n")
+        else:
+            print(content)
+
+    def respondent(self, survey, compiled, rand):
+        from django.test import Client
+
+        from core.simulate import respondent_flow, respondent_token
+
+        client = Client()
+        try:
+            for name, method, url, data in respondent_flow(client, survey,
+                    compiled, rand):
+                latency, queries, failure = self.request(method, url, data)
+                with self.lock:
+                    stats = self.stats.setdefault(name, ViewStats())
+                    if failure == "lock":
+                        stats.lock_errors += 1
+                    elif failure:
+                        stats.errors += 1
+                    else:
+                        stats.latencies.append(latency)
+                        stats.queries.append(queries)
+
+                if failure:
+                    # Later requests depend on this one, abandon the survey
+                    break
+        finally:
+            token = respondent_token(client, survey)
+            if token is not None:
+                with self.lock:
+                    self.tokens.append(token)
+
+            # Each worker thread has its own database connection
+            connections.close_all()
+
+    def request(self, method, url, data):
+        """Makes a request, returning a tuple of (latency, query count,
+        failure) where failure is None, "lock" or "error" """
+        queries = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                if data is not None:
+                    response = method(url, data)
+                else:
+                    response = method(url)
+        except OperationalError as e:
+            if "locked" in str(e):
+                return None, queries, "lock"
+
+            return None, queries, "error"
+        except Exception:
+            return None, queries, "error"
+
+        latency = time.perf_counter() - start
+        if response.status_code >= 400:
+            return latency, queries, "error"
+
+        return latency, queries, None
+
+
+def git_commit():
+    """Returns the hash of the checked out commit, or None if it can't be
+    found"""
+    try:
+        proc = subprocess.run(["git", "rev-parse", "HEAD"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+
+    if proc.returncode != 0:
+        return None
+
+    return proc.stdout.strip()
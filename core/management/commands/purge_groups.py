@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from core.models import AnswerGroup, Answer
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Deletes AnswerGroups that have no answers and haven't been "
+        "touched in a while, left behind by visitors who never answered. "
+        "Tokens issued for a panel are kept. Deletes in small batches, each "
+        "in its own transaction, so respondents aren't locked out for long.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7,
+            help="Only purge groups not updated in this many days, default 7")
+        parser.add_argument("--batch", type=int, default=500,
+            help="Groups deleted per transaction, default 500")
+        parser.add_argument("--pause", type=float, default=0.1,
+            help="Seconds to wait between batches, default 0.1")
+        parser.add_argument("--survey", type=str,
+            help="Slug of the survey to purge, defaults to all")
+        parser.add_argument("--dry-run", action="store_true",
+            help="Only count the groups that would be purged")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        stale = AnswerGroup.objects.filter(updated__lt=cutoff,
+            issued=False).exclude(
+            Exists(Answer.objects.filter(answer_group=OuterRef("pk"))))
+        if options["survey"]:
+            stale = stale.filter(survey__slug=options["survey"])
+
+        if options["dry_run"]:
+            print(f"{stale.count()} empty groups would be purged")
+            return
+
+        purged = 0
+        last_id = 0
+        while True:
+            ids = list(stale.filter(id__gt=last_id).order_by("id").values_list(
+                "id", flat=True)[:options["batch"]])
+            if not ids:
+                break
+
+            last_id = ids[-1]
+            with transaction.atomic():
+                # Checked again as a respondent may have just answered
+                count, _ = stale.filter(id__in=ids).delete()
+                purged += count
+
+            time.sleep(options["pause"])
+
+        print(f"Purged {purged} empty groups")
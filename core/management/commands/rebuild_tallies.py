@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Survey, Question, QuestionTally, SurveyTally
+
+
+class Command(BaseCommand):
+    help = ("Recounts the QuestionTally and SurveyTally tables from the "
+        "Answer and AnswerGroup rows, repairing any drift.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("slugs", nargs="*", type=str,
+            help="Slugs of the surveys to rebuild, defaults to all")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        questions = Question.objects.all()
+        if options["slugs"]:
+            surveys = surveys.filter(slug__in=options["slugs"])
+            questions = questions.filter(page__survey__slug__in=options["slugs"])
+
+        drift = QuestionTally.rebuild(questions)
+        print(f"Rebuilt tallies for {questions.count()} questions, "
+            f"{drift} buckets were out of date")
+
+        drift = SurveyTally.rebuild(surveys)
+        print(f"Rebuilt respondent counts for {surveys.count()} surveys, "
+            f"{drift} were out of date")
@@ -0,0 +1,124 @@
+import random
+import tempfile
+import threading
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Count
+
+from core.models import (Survey, Page, Question, QuestionTypes, AnswerGroup,
+    Answer, QuestionTally, CompiledSurvey)
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    help = ("Stress tests concurrent submissions of the same page by the same "
+        "respondent, as from a double clicked button or two open tabs, then "
+        "checks there are no duplicate answers and the tallies are exact. "
+        "Runs against a scratch database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8,
+            help="Concurrent submissions per round, default 8")
+        parser.add_argument("--rounds", type=int, default=50,
+            help="Number of rounds, default 50")
+        parser.add_argument("--groups", type=int, default=4,
+            help="Respondents being submitted for, default 4")
+
+    def handle(self, *args, **options):
+        # SQLite's shared in-memory test database uses table locks that
+        # don't honour the busy timeout, use a file instead
+        with tempfile.TemporaryDirectory() as temp:
+            if connection.vendor == "sqlite":
+                connection.settings_dict["TEST"]["NAME"] = str(
+                    Path(temp) / "stress.sqlite3")
+
+            old_name = connection.creation.create_test_db(verbosity=0,
+                autoclobber=True, serialize=False)
+            try:
+                self.stress(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def stress(self, options):
+        from django.test import Client
+        from django.test.utils import setup_test_environment
+
+        from core.simulate import random_page_data
+
+        setup_test_environment()
+        survey = self.create_survey()
+        page = CompiledSurvey.get(survey).first_page
+
+        groups = [AnswerGroup.factory(survey.slug) for _ in
+            range(options["groups"])]
+
+        threads = options["threads"]
+        barrier = threading.Barrier(threads)
+        failures = {"lock": 0, "error": 0}
+        lock = threading.Lock()
+
+        def submit(group, data):
+            client = Client()
+            url = f"/page/{survey.id}/{group.token}/{page.rank}/"
+            try:
+                barrier.wait()
+                response = client.post(url, data)
+                if response.status_code != 302:
+                    with lock:
+                        failures["error"] += 1
+            except OperationalError as e:
+                with lock:
+                    failures["lock" if "locked" in str(e) else "error"] += 1
+            except Exception:
+                with lock:
+                    failures["error"] += 1
+            finally:
+                connections.close_all()
+
+        rand = random.Random(42)
+        for _ in range(options["rounds"]):
+            workers = []
+            for num in range(threads):
+                group = groups[num % len(groups)]
+                data = random_page_data(page, rand)
+                workers.append(threading.Thread(target=submit,
+                    args=(group, data)))
+
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        submissions = options["rounds"] * threads
+        duplicates = Answer.objects.values("answer_group",
+            "question").annotate(count=Count("id")).filter(
+            count__gt=1).count()
+        drift = QuestionTally.rebuild(Question.objects.filter(
+            page__survey=survey))
+
+        print(f"{submissions} submissions, {failures['lock']} lock errors, "
+            f"{failures['error']} other errors")
+        print(f"{Answer.objects.count()} answers, {duplicates} duplicated, "
+            f"{drift} tally buckets out of date")
+
+        if duplicates or drift:
+            raise CommandError("Concurrent submissions corrupted the answers")
+
+        if failures["error"]:
+            raise CommandError("Concurrent submissions failed")
+
+    def create_survey(self):
+        survey = Survey.objects.create(name="Stress", slug="stress")
+        page = Page.objects.create(survey=survey)
+
+        choices = [["R", "Red"], ["G", "Green"], ["B", "Blue"]]
+        for question_type in (QuestionTypes.BOOLEAN, QuestionTypes.STAR,
+                QuestionTypes.NUM, QuestionTypes.CHOICE, QuestionTypes.TEXT):
+            Question.objects.create(page=page, question_type=question_type,
+                question_text="?", choices=choices, num_answer_min=1,
+                num_answer_max=10)
+
+        # Reload so the survey's version matches its saved pages
+        return Survey.objects.get(id=survey.id)
@@ -0,0 +1,36 @@
+# Generated by Django 5.1 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from core.migrations._tallies import replace_tallies
+
+
+def populate_tallies(apps, schema_editor):
+    Answer = apps.get_model('core', 'Answer')
+    QuestionTally = apps.get_model('core', 'QuestionTally')
+
+    replace_tallies(QuestionTally.objects.all(), Answer.objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(blank=True, max_length=50, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.question')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('question', 'value'), name='unique_question_tally')],
+            },
+        ),
+        migrations.RunPython(populate_tallies, migrations.RunPython.noop),
+    ]
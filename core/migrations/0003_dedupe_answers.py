@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+from core.migrations._tallies import replace_tallies
+
+
+def dedupe_answers(apps, schema_editor):
+    # Before answers were unique per group and question, concurrent saves
+    # could create more than one. Keep the most recently updated of each and
+    # recount the tallies of the questions involved.
+    Answer = apps.get_model('core', 'Answer')
+    QuestionTally = apps.get_model('core', 'QuestionTally')
+
+    dupes = Answer.objects.values('answer_group_id', 'question_id').annotate(
+        count=models.Count('id')).filter(count__gt=1).order_by()
+
+    doomed = []
+    question_ids = set()
+    for dupe in dupes.iterator():
+        ids = Answer.objects.filter(answer_group_id=dupe['answer_group_id'],
+            question_id=dupe['question_id']).order_by('-updated',
+            '-id').values_list('id', flat=True)
+        doomed.extend(list(ids)[1:])
+        question_ids.add(dupe['question_id'])
+
+    if not doomed:
+        return
+
+    for start in range(0, len(doomed), 500):
+        Answer.objects.filter(id__in=doomed[start:start + 500]).delete()
+
+    replace_tallies(QuestionTally.objects.filter(
+        question_id__in=question_ids), Answer.objects.filter(
+        question_id__in=question_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_questiontally'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_answers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1 on 2026-10-18 12:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_dedupe_answers'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='answer',
+            constraint=models.UniqueConstraint(fields=('answer_group', 'question'), name='unique_answer'),
+        ),
+        migrations.AddIndex(
+            model_name='answergroup',
+            index=models.Index(fields=['survey', 'token'], name='answergroup_survey_token'),
+        ),
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(fields=['survey', 'rank'], name='page_survey_rank'),
+        ),
+        migrations.AlterField(
+            model_name='answer',
+            name='answer_group',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='core.answergroup'),
+        ),
+        migrations.AlterField(
+            model_name='answergroup',
+            name='token',
+            field=models.CharField(max_length=20),
+        ),
+    ]
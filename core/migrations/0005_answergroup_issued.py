@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_answer_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answergroup',
+            name='issued',
+            field=models.BooleanField(default=False),
+        ),
+    ]
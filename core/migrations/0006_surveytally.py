@@ -0,0 +1,38 @@
+# Generated by Django 5.1 on 2026-10-18 13:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_tallies(apps, schema_editor):
+    Survey = apps.get_model('core', 'Survey')
+    Answer = apps.get_model('core', 'Answer')
+    SurveyTally = apps.get_model('core', 'SurveyTally')
+
+    # Respondents are groups that weren't issued ahead of time, or that have
+    # been answered
+    answers = Answer.objects.filter(answer_group=models.OuterRef('pk'))
+    tallies = []
+    for survey in Survey.objects.all():
+        respondents = survey.answergroup_set.filter(models.Q(issued=False) |
+            models.Exists(answers)).count()
+        tallies.append(SurveyTally(survey=survey, respondents=respondents))
+
+    SurveyTally.objects.bulk_create(tallies)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_answergroup_issued'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyTally',
+            fields=[
+                ('survey', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='core.survey')),
+                ('respondents', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_tallies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.1 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+from core.migrations._tallies import replace_tallies
+
+
+def dedupe_groups(apps, schema_editor):
+    # Before tokens were unique per survey, concurrent first submissions on a
+    # database without SQLite's up front write lock could create more than
+    # one group. Keep the most recently updated of each and recount the
+    # tallies of the surveys involved.
+    AnswerGroup = apps.get_model('core', 'AnswerGroup')
+    Answer = apps.get_model('core', 'Answer')
+    QuestionTally = apps.get_model('core', 'QuestionTally')
+    SurveyTally = apps.get_model('core', 'SurveyTally')
+
+    dupes = AnswerGroup.objects.values('survey_id', 'token').annotate(
+        count=models.Count('id')).filter(count__gt=1).order_by()
+
+    doomed = []
+    survey_ids = set()
+    for dupe in dupes.iterator():
+        ids = AnswerGroup.objects.filter(survey_id=dupe['survey_id'],
+            token=dupe['token']).order_by('-updated', '-id').values_list('id',
+            flat=True)
+        doomed.extend(list(ids)[1:])
+        survey_ids.add(dupe['survey_id'])
+
+    if not doomed:
+        return
+
+    for start in range(0, len(doomed), 500):
+        AnswerGroup.objects.filter(id__in=doomed[start:start + 500]).delete()
+
+    replace_tallies(QuestionTally.objects.filter(
+        question__page__survey_id__in=survey_ids), Answer.objects.filter(
+        question__page__survey_id__in=survey_ids))
+
+    answers = Answer.objects.filter(answer_group=models.OuterRef('pk'))
+    for survey_id in survey_ids:
+        respondents = AnswerGroup.objects.filter(survey_id=survey_id).filter(
+            models.Q(issued=False) | models.Exists(answers)).count()
+        SurveyTally.objects.filter(survey_id=survey_id).update(
+            respondents=respondents)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_surveytally'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_groups, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='answergroup',
+            name='answergroup_survey_token',
+        ),
+        migrations.AddConstraint(
+            model_name='answergroup',
+            constraint=models.UniqueConstraint(fields=('survey', 'token'), name='unique_survey_token'),
+        ),
+    ]
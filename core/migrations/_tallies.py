@@ -0,0 +1,40 @@
+"""Tally counting shared by the data migrations. Works on the historical
+models passed in, so it doesn't change when core.models does. The loader
+skips modules starting with an underscore, this isn't a migration."""
+from django.db import models
+
+
+def bucket_counts(answers):
+    """Returns a dict mapping (question id, bucket value) to the number of
+    the given answers in that bucket. Text answers aren't tallied."""
+    buckets = {}
+    rows = answers.filter(text_answer=None).values_list('question_id',
+        'bool_answer', 'num_answer', 'star_answer', 'choices_answer'
+        ).annotate(models.Count('id')).order_by()
+    for q_id, boolean, num, star, choice, count in rows:
+        value = None
+        if boolean is not None:
+            value = '1' if boolean else '0'
+        else:
+            for item in (num, star, choice):
+                if item is not None:
+                    value = str(item)
+                    break
+
+        key = (q_id, value)
+        buckets[key] = buckets.get(key, 0) + count
+
+    return buckets
+
+
+def replace_tallies(tallies, answers):
+    """Deletes the ``tallies`` queryset's rows and creates them again from
+    the counts of ``answers``"""
+    counts = bucket_counts(answers)
+    QuestionTally = tallies.model
+
+    tallies.delete()
+    QuestionTally.objects.bulk_create([
+        QuestionTally(question_id=q_id, value=value, count=count)
+        for (q_id, value), count in counts.items()
+    ])
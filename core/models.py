@@ -1,26 +1,34 @@
 import string
 import secrets
-from datetime import datetime
 from functools import cached_property
 
+from asgiref.sync import sync_to_async
 from django import forms
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models.functions import Coalesce
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.text import Truncator
 
-import matplotlib
-import matplotlib.pyplot as plt
-
-import numpy as np
-
 from awl.absmodels import TimeTrackModel
 from awl.rankedmodel.models import RankedModel
 
+from core.sqlite import coalesced
+
+
 # ===========================================================================
 
 ALPHABET = string.ascii_letters + string.digits
-matplotlib.use('agg')  # force non-interactive backend
-#matplotlib.rcParams['figure.dpi'] = 200   # increase image DPI
+
+# Salt for the signed cookie, named after the survey's slug, that holds a
+# respondent's token
+TOKEN_COOKIE_SALT = "core.respondent"
+
+# Markers for QuestionTally bucket values: text answers aren't counted and
+# deferred fields mean the stored value isn't known
+NOT_TALLIED = object()
+DEFERRED = object()
 
 # ===========================================================================
 
@@ -44,12 +52,26 @@ class Survey(TimeTrackModel):
         if just_created:
             self.token = ''.join(secrets.choice(ALPHABET) for _ in range(18))
             self.save()
+            SurveyTally.objects.create(survey=self)
+
+
+def touch_survey(surveys):
+    # Changing a survey's pages or questions is a new version of the survey,
+    # which invalidates any CompiledSurvey built from it
+    surveys.update(updated=timezone.now())
 
 
 class Page(RankedModel, TimeTrackModel):
     survey = models.ForeignKey(Survey, on_delete=models.CASCADE)
     intro = models.TextField(blank=True)
 
+    class Meta(RankedModel.Meta):
+        # Not unique: RankedModel re-ranks by saving pages one at a time,
+        # which briefly gives two pages the same rank
+        indexes = [
+            models.Index(fields=["survey", "rank"], name="page_survey_rank"),
+        ]
+
     def grouped_filter(self):
         return Page.objects.filter(survey=self.survey)
 
@@ -70,6 +92,10 @@ class Page(RankedModel, TimeTrackModel):
     def __str__(self):
         return f"Page(id={self.id}, survey={self.survey.name}, #{self.rank})"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        touch_survey(Survey.objects.filter(id=self.survey_id))
+
 
 class QuestionTypes(models.TextChoices):
     BOOLEAN = "B"
@@ -79,6 +105,63 @@ class QuestionTypes(models.TextChoices):
     CHOICE = "C"
 
 
+# Answer column that holds the value for each type of question
+ANSWER_FIELDS = {
+    QuestionTypes.BOOLEAN: "bool_answer",
+    QuestionTypes.NUM: "num_answer",
+    QuestionTypes.STAR: "star_answer",
+    QuestionTypes.TEXT: "text_answer",
+    QuestionTypes.CHOICE: "choices_answer",
+}
+
+
+class Tally:
+    """Bucket counts for the answers to a single question within a survey.
+
+    :param counts: dict mapping each non-empty answer value to the number of
+        times it was given
+    :param total: number of :class:`AnswerGroup` objects in the survey
+    :param answered: number of :class:`Answer` rows for the question,
+        including those without a value
+    """
+    def __init__(self, counts, total, answered):
+        self.counts = counts
+        self.total = total
+        self.answered = answered
+
+    def __getitem__(self, value):
+        return self.counts.get(value, 0)
+
+    @classmethod
+    def from_buckets(cls, question_type, buckets, total):
+        """Creates a Tally from :class:`QuestionTally` rows.
+
+        :param question_type: :class:`QuestionTypes` of the question
+        :param buckets: iterable of (bucket value, count) pairs, where a
+            bucket value of None is an answer with no value
+        :param total: number of :class:`AnswerGroup` objects in the survey
+        """
+        counts = {}
+        answered = 0
+        for value, count in buckets:
+            answered += count
+            if value is None:
+                continue
+
+            if question_type == QuestionTypes.BOOLEAN:
+                value = value == "1"
+            elif question_type in (QuestionTypes.NUM, QuestionTypes.STAR):
+                value = int(value)
+
+            counts[value] = counts.get(value, 0) + count
+
+        return cls(counts, total, answered)
+
+    def __repr__(self):
+        return (f"Tally(counts={self.counts}, total={self.total}, "
+            f"answered={self.answered})")
+
+
 class Question(RankedModel, TimeTrackModel):
     question_type = models.CharField(max_length=1, choices=QuestionTypes)
     question_text = models.TextField()
@@ -91,14 +174,13 @@ class Question(RankedModel, TimeTrackModel):
     num_answer_min = models.IntegerField(blank=True, null=True)
     num_answer_max = models.IntegerField(blank=True, null=True)
 
-    COLOURS = (
-        # Red        green      blue        purple     orange     yellow
-        "#de324c", "#95cf92", "#369acc",  "#9656a2", "#f4895f", "#f8e16f",
-    )
-
     def __str__(self):
         return f"Question(id={self.id}, '{self.short_text}')"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        touch_survey(Survey.objects.filter(page=self.page_id))
+
     @property
     def short_text(self):
         return Truncator(self.question_text).words(5, truncate=' ...')
@@ -108,205 +190,442 @@ class Question(RankedModel, TimeTrackModel):
         return Answer.objects.filter(answer_group__survey=self.page.survey,
             question=self)
 
-    # --- Graph generating methods
-    def generate_graph(self, survey, survey_dir):
-        now = int(datetime.now().timestamp())
-        file = survey_dir / f"q-{self.id}-{now}.svg"
+    @property
+    def answer_field(self):
+        return ANSWER_FIELDS[self.question_type]
 
-        # Check that there are answers at all
-        if self.answer_set.count() == 0:
-            return None
+    def tally(self, survey):
+        """Reads the answer counts for this question from the
+        :class:`QuestionTally` table, cost is proportional to the number of
+        buckets not the number of responses.
 
-        if self.question_type == QuestionTypes.BOOLEAN:
-            return self._generate_boolean(survey, file)
-        elif self.question_type == QuestionTypes.NUM:
-            return self._generate_num(survey, file)
-        elif self.question_type == QuestionTypes.STAR:
-            return self._generate_star(survey, file)
-        elif self.question_type == QuestionTypes.CHOICE:
-            return self._generate_choice(survey, file)
+        :returns: :class:`Tally`
+        """
+        buckets = self.questiontally_set.values_list("value").annotate(
+            models.Sum("count")).order_by()
+        total = SurveyTally.total(survey)
+        return Tally.from_buckets(self.question_type, buckets, total)
 
-    def _generate_boolean(self, survey, file):
-        total = AnswerGroup.objects.filter(survey=survey).count()
-        total_true = Answer.objects.filter(answer_group__survey=survey,
-            question=self, bool_answer=True).count()
-        total_false = Answer.objects.filter(answer_group__survey=survey,
-            question=self, bool_answer=False).count()
 
-        dna = total - (total_true + total_false)
+# ---------------------------------------------------------------------------
 
-        data = (total_true, total_false, dna)
+class AnswerForm(forms.Form):
+    pass
+
+
+def build_form_class(questions):
+    """Returns a form class with a field for each of the given questions"""
+    fields = {}
+    for question in questions:
+        name = f"question-{question.id}"
+        kwargs = {
+            "label": question.question_text,
+            "required": question.required,
+        }
+
+        if question.question_type == QuestionTypes.BOOLEAN:
+            field = forms.ChoiceField(choices=(("1", "1"), ("0", "0")),
+                **kwargs)
+        elif question.question_type == QuestionTypes.NUM:
+            if question.num_answer_min is not None:
+                kwargs['min_value'] = question.num_answer_min
+            if question.num_answer_max is not None:
+                kwargs['max_value'] = question.num_answer_max
+
+            field = forms.IntegerField(**kwargs)
+        elif question.question_type == QuestionTypes.STAR:
+            field = forms.IntegerField(widget=forms.RadioSelect(), **kwargs)
+        elif question.question_type == QuestionTypes.TEXT:
+            field = forms.CharField(widget=forms.Textarea(), **kwargs)
+        elif question.question_type == QuestionTypes.CHOICE:
+            field = forms.ChoiceField(choices=question.choices, **kwargs)
+        else:
+            raise RuntimeError(f"{question} has invalid type")
+
+        fields[name] = field
+
+    return type("AGForm", (AnswerForm, ), fields)
+
+
+class CompiledPage:
+    """A page and its questions as they were when its :class:`CompiledSurvey`
+    was built, along with the form class for answering them."""
+    def __init__(self, page, questions, prev_rank, next_rank):
+        self.id = page.id
+        self.rank = page.rank
+        self.intro = page.intro
+        self.questions = tuple(questions)
+        self.prev_rank = prev_rank
+        self.next_rank = next_rank
+        self.form_class = build_form_class(self.questions)
+
+    def __repr__(self):
+        return f"CompiledPage(id={self.id}, #{self.rank})"
+
+
+# Per-process cache of CompiledSurvey objects keyed by survey id
+_compiled_surveys = {}
+
+class CompiledSurvey:
+    """Immutable definition of a survey's pages, questions, choices and
+    limits, used for navigation, form building and validation without any
+    structural queries. Built once per version of a survey and cached
+    in-process: the version is the survey's ``updated`` stamp, which is
+    bumped whenever the survey, one of its pages or one of its questions is
+    saved or deleted.
+
+    Use :meth:`CompiledSurvey.get` rather than constructing directly.
+    """
+    def __init__(self, survey):
+        self.id = survey.id
+        self.version = survey.updated
+
+        pages = list(Page.objects.filter(survey_id=survey.id).order_by(
+            "rank").prefetch_related("question_set"))
+        ranks = [page.rank for page in pages]
+        compiled = []
+        for index, page in enumerate(pages):
+            prev_rank = ranks[index - 1] if index > 0 else None
+            next_rank = ranks[index + 1] if index + 1 < len(ranks) else None
+            compiled.append(CompiledPage(page, page.question_set.all(),
+                prev_rank, next_rank))
+
+        self.pages = tuple(compiled)
+        self._by_rank = {page.rank: page for page in self.pages}
+        self._by_id = {page.id: page for page in self.pages}
+
+    def __repr__(self):
+        return f"CompiledSurvey(id={self.id}, version={self.version})"
 
-        fig, axis = plt.subplots()
-        axis.bar( ("True", "False", "None"), data, color=self.COLOURS)
-        fig.savefig(file, format="svg")
-        return file
+    @classmethod
+    def get(cls, survey):
+        """Returns the compiled definition of the given :class:`Survey`,
+        building it if the cached one is out of date"""
+        entry = _compiled_surveys.get(survey.id)
+        if entry is None or entry.version != survey.updated:
+            entry = cls(survey)
+            _compiled_surveys[survey.id] = entry
 
-    def _generate_num(self, survey, file):
-        total = AnswerGroup.objects.filter(survey=survey).count()
+        return entry
 
-        if self.num_answer_min is not None:
-            bottom = self.num_answer_min
-        else:
-            bottom = Answer.objects.filter(answer_group__survey=survey,
-                    question=self).exclude(num_answer=None).aggregate(
-                        num_answer=models.Min("num_answer"))["num_answer"]
+    @classmethod
+    async def aget(cls, survey):
+        """Async version of :meth:`CompiledSurvey.get`, a cached survey is
+        returned without leaving the event loop"""
+        entry = _compiled_surveys.get(survey.id)
+        if entry is None or entry.version != survey.updated:
+            entry = await sync_to_async(cls.get)(survey)
 
-        if self.num_answer_max is not None:
-            top = self.num_answer_max
-        else:
-            top = Answer.objects.filter(answer_group__survey=survey,
-                    question=self).exclude(num_answer=None).aggregate(
-                        num_answer=models.Max("num_answer"))["num_answer"]
-
-        data = []
-        labels = []
-        for num in range(bottom, top + 1):
-            value = Answer.objects.filter(answer_group__survey=survey,
-                question=self, num_answer=num).count()
-            data.append(value)
-            labels.append(str(num))
-
-        dna = total - sum(data)
-        data.append(dna)
-        labels.append("None")
-
-        fig, axis = plt.subplots()
-        axis.bar(labels, data, color=self.COLOURS)
-        fig.savefig(file, format="svg")
-
-        return file
-
-    def _generate_star(self, survey, file):
-        total = AnswerGroup.objects.filter(survey=survey).count()
-
-        data = []
-        labels = []
-        for num in range(5, 0, -1):
-            value = Answer.objects.filter(answer_group__survey=survey,
-                question=self, star_answer=num).count()
-            data.append(value)
-            labels.append(str(num))
-
-        dna = total - sum(data)
-        data.append(dna)
-        labels.append("None")
-
-        fig, axis = plt.subplots()
-        axis.bar(labels, data, color=self.COLOURS)
-        fig.savefig(file, format="svg")
-
-        return file
-
-    def _generate_choice(self, survey, file):
-        total = AnswerGroup.objects.filter(survey=survey).count()
-
-        labels = []
-        data = []
-        for choice in self.choices:
-            labels.append(choice[1])
-            value = Answer.objects.filter(answer_group__survey=survey,
-                question=self, choices_answer=choice[0]).count()
-            data.append(value)
-
-        labels.append("None")
-        dna = total - sum(data)
-        data.append(dna)
-
-        fig, axis = plt.subplots()
-        axis.bar( labels, data, color=self.COLOURS)
-        fig.savefig(file, format="svg")
-
-        return file
+        return entry
+
+    def page(self, rank):
+        """Returns the :class:`CompiledPage` with the given rank or None"""
+        return self._by_rank.get(rank)
+
+    def page_by_id(self, page_id):
+        return self._by_id.get(page_id)
+
+    @property
+    def first_page(self):
+        return self.pages[0] if self.pages else None
+
+    @property
+    def last_page(self):
+        return self.pages[-1] if self.pages else None
 
 # ---------------------------------------------------------------------------
 
+class AnswerGroupQuerySet(models.QuerySet):
+    def delete(self):
+        # Tallies are adjusted once for the whole queryset here rather than
+        # in a delete signal, which would be sent for every group cascaded
+        # from a Survey or Page
+        with transaction.atomic():
+            QuestionTally.remove(Answer.objects.filter(answer_group__in=self))
+            rows = AnswerGroup.responded().filter(id__in=self).values_list(
+                "survey_id").annotate(models.Count("id")).order_by()
+            for survey_id, count in rows:
+                SurveyTally.add(survey_id, -count)
+
+            return super().delete()
+
+
 class AnswerGroup(TimeTrackModel):
     survey = models.ForeignKey(Survey, on_delete=models.CASCADE)
     page = models.ForeignKey(Page, blank=True, null=True,
         on_delete=models.CASCADE)
-    token = models.CharField(max_length=20, db_index=True)
+    token = models.CharField(max_length=20)
+
+    # Created ahead of time for a panel invitation rather than by a visit
+    issued = models.BooleanField(default=False)
+
+    objects = AnswerGroupQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["survey", "token"],
+                name="unique_survey_token"),
+        ]
 
     def __str__(self):
         return f"AnswerGroup(id={self.id})"
 
     @classmethod
-    def factory(cls, slug):
-        survey = Survey.objects.get(slug=slug)
-        token = ''.join(secrets.choice(ALPHABET) for _ in range(18))
-        page = Page.objects.get(survey=survey, rank=1)
-        group = AnswerGroup.objects.create(survey=survey, page=page,
-            token=token)
+    def new_token(cls):
+        # 18 URL safe characters, drawn in one call rather than one call per
+        # character as issuing tokens in bulk makes many of them
+        return secrets.token_urlsafe(13)
 
-        return group
+    def save(self, *args, **kwargs):
+        if not self._state.adding or self.issued:
+            return super().save(*args, **kwargs)
 
-    def get_form(self, post=None):
-        class BaseForm(forms.Form):
-            pass
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            SurveyTally.add(self.survey_id, 1)
 
-        fields = {}
-        initial_values = {}
-        for question in self.page.question_set.all():
-            name = f"question-{question.id}"
-            try:
-                answer = Answer.objects.get(answer_group=self,
-                    question=question)
-                if answer.has_value():
-                    initial_values[name] = answer.get_form_value()
-            except Answer.DoesNotExist:
-                pass
-
-            kwargs = {
-                "label": question.question_text,
-                "required": question.required,
-            }
-
-            if question.question_type == QuestionTypes.BOOLEAN:
-                field = forms.ChoiceField(choices=(("1", "1"), ("0", "0")),
-                    **kwargs)
-            elif question.question_type == QuestionTypes.NUM:
-                if question.num_answer_min is not None:
-                    kwargs['min_value'] = question.num_answer_min
-                if question.num_answer_max is not None:
-                    kwargs['max_value'] = question.num_answer_max
-
-                field = forms.IntegerField(**kwargs)
-            elif question.question_type == QuestionTypes.STAR:
-                field = forms.IntegerField(widget=forms.RadioSelect(), **kwargs)
-            elif question.question_type == QuestionTypes.TEXT:
-                field = forms.CharField(widget=forms.Textarea(), **kwargs)
-            elif question.question_type == QuestionTypes.CHOICE:
-                field = forms.ChoiceField(choices=question.choices, **kwargs)
-            else:
-                raise RuntimeError(f"{question} has invalid type")
+    def delete(self, *args, **kwargs):
+        return AnswerGroup.objects.filter(id=self.id).delete()
 
-            fields[name] = field
+    @classmethod
+    def responded(cls, survey=None):
+        """Returns a queryset of the survey's groups that count as
+        respondents in its results, or those of every survey if None. Issued
+        tokens only count once they have been answered. The number of them is
+        kept in :class:`SurveyTally`."""
+        answers = Answer.objects.filter(answer_group=models.OuterRef("pk"))
+        groups = cls.objects.filter(models.Q(issued=False) |
+            models.Exists(answers))
+        if survey is None:
+            return groups
+
+        return groups.filter(survey=survey)
 
-        AGForm = type("AGForm", (BaseForm, ), fields)
-        if post is None:
-            return AGForm(initial=initial_values)
+    @classmethod
+    def issue_tokens(cls, survey, count, batch_size=10_000):
+        """Generator that creates ``count`` unanswered groups for the survey
+        ahead of time, for sending personalised links to a known list of
+        respondents. Each batch is inserted with a single statement in its
+        own transaction, and its tokens are yielded as a list once written.
+
+        :param survey: :class:`Survey` to issue tokens for
+        :param count: number of groups to create
+        :param batch_size: groups inserted per transaction
+        :raises ValueError: if the survey has no pages
+        """
+        page = CompiledSurvey.get(survey).first_page
+        if page is None:
+            raise ValueError(f"{survey} has no pages")
+
+        # Rows are inserted directly, building model instances for
+        # bulk_create costs far more than the insert itself at this scale
+        ops = connection.ops
+        columns = ", ".join(ops.quote_name(cls._meta.get_field(name).column)
+            for name in ("created", "updated", "survey", "page", "token",
+            "issued"))
+        sql = (f"INSERT INTO {ops.quote_name(cls._meta.db_table)} "
+            f"({columns}) VALUES (%s, %s, %s, %s, %s, %s)")
+        now = ops.adapt_datetimefield_value(timezone.now())
+
+        while count > 0:
+            size = min(count, batch_size)
+            # Sorted so the token index is filled in order
+            tokens = sorted(cls.new_token() for _ in range(size))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, [(now, now, survey.id, page.id,
+                    token, True) for token in tokens])
+
+            count -= size
+            yield tokens
 
-        return AGForm(post)
+    @classmethod
+    def factory(cls, slug):
+        survey = Survey.objects.get(slug=slug)
+        page = CompiledSurvey.get(survey).first_page
+        if page is None:
+            raise ValueError(f"{survey} has no pages")
 
-    def save_values(self, data):
-        for question in self.page.question_set.all():
-            name = f'question-{question.id}'
-            if name not in data:
-                continue
+        group = coalesced(AnswerGroup.objects.create, survey=survey,
+            page_id=page.id, token=cls.new_token())
 
-            try:
-                answer = Answer.objects.get(answer_group=self,
-                    question=question)
-            except Answer.DoesNotExist:
-                answer = Answer.objects.create(question=question,
-                    answer_group=self)
+        return group
+
+    @classmethod
+    def pending(cls, survey, token, compiled):
+        """Returns an unsaved group on the survey's first page for a
+        respondent who hasn't answered anything yet. It is saved along with
+        its first answers by :meth:`AnswerGroup.save_values`, so visitors
+        that never answer don't leave a row behind.
+
+        :param survey: :class:`Survey` being filled in
+        :param token: respondent's token, normally from their cookie
+        :param compiled: the survey's :class:`CompiledSurvey`
+        """
+        return cls(survey=survey, page_id=compiled.first_page.id, token=token)
+
+    def current_page(self, compiled):
+        """Returns the :class:`CompiledPage` for the group's current page.
+
+        :param compiled: the survey's :class:`CompiledSurvey`, from
+            :meth:`CompiledSurvey.get` or :meth:`CompiledSurvey.aget`
+        """
+        return compiled.page_by_id(self.page_id)
+
+    def page_answers(self, compiled):
+        """Returns a queryset of the answers already given on the current
+        page, for passing to :meth:`AnswerGroup.get_form`"""
+        if self.pk is None:
+            return Answer.objects.none()
+
+        return Answer.objects.filter(answer_group=self, question_id__in=[
+            question.id for question in self.current_page(compiled).questions])
+
+    def get_form(self, compiled, post=None, answers=()):
+        """Returns the form for the current page, bound to ``post`` if given
+        or otherwise filled in with the values of ``answers``.
+
+        :param compiled: the survey's :class:`CompiledSurvey`
+        :param post: submitted form data
+        :param answers: iterable of the :class:`Answer` objects from
+            :meth:`AnswerGroup.page_answers`, already fetched when called
+            from async code
+        """
+        page = self.current_page(compiled)
+        if post is not None:
+            return page.form_class(post)
+
+        questions = {question.id: question for question in page.questions}
 
-            answer.set_value(data[name])
+        initial_values = {}
+        for answer in answers:
+            answer.question = questions[answer.question_id]
+            if answer.has_value():
+                name = f"question-{answer.question_id}"
+                initial_values[name] = answer.get_form_value()
+
+        return page.form_class(initial=initial_values)
+
+    async def asave_values(self, compiled, data):
+        """Async version of :meth:`AnswerGroup.save_values`. The writes happen
+        in a single transaction, which Django only supports from synchronous
+        code, so the save is run in the request's worker thread."""
+        await sync_to_async(self.save_values)(compiled, data)
+
+    def set_page(self, page_id):
+        """Makes the given page the group's current one, only writing to the
+        database if it changed and the group has been saved"""
+        if self.page_id == page_id:
+            return
+
+        self.page_id = page_id
+        if self.pk is not None:
+            coalesced(self.save, update_fields=["page", "updated"])
+
+    async def aset_page(self, page_id):
+        if self.page_id != page_id:
+            await sync_to_async(self.set_page)(page_id)
+
+    def save_values(self, compiled, data):
+        """Saves the answers for the questions on the current page. Every
+        value is validated before anything is written, then the answers are
+        upserted on (answer_group, question) in a single transaction, so
+        concurrent submissions of the same page can't create duplicates. A
+        pending group is saved with its first non-blank answers.
+
+        :param compiled: the survey's :class:`CompiledSurvey`
+        :param data: dict of form field names to cleaned values
+        """
+        answers = []
+        for question in self.current_page(compiled).questions:
+            name = f'question-{question.id}'
+            if name in data:
+                answer = Answer(question=question, answer_group=self)
+                answer.assign_value(data[name])
+                answers.append(answer)
+
+        if self.pk is None and not any(answer.has_value() and
+                answer.get_value() != "" for answer in answers):
+            # Nothing worth saving the group for yet, blank text and choice
+            # fields post empty strings
+            return
+
+        if answers:
+            coalesced(self._write_answers, answers)
+
+    def _write_answers(self, answers):
+        fields = list(ANSWER_FIELDS.values())
+        with transaction.atomic():
+            if self.pk is None:
+                # A concurrent first submission may have saved the group
+                existing = AnswerGroup.objects.filter(
+                    survey_id=self.survey_id, token=self.token).values_list(
+                    "id", flat=True)
+                self.id = existing.first()
+                if self.id is None:
+                    try:
+                        with transaction.atomic():
+                            self.save()
+                    except IntegrityError:
+                        # It did so after the check, possible on databases
+                        # that don't take the write lock up front
+                        self.id = existing.get()
+                self._state.adding = False
+
+            # Writing to the group first takes its row lock, or the database
+            # write lock on SQLite, so concurrent saves for this group queue
+            # up here and the values read next are the ones being replaced
+            AnswerGroup.objects.filter(id=self.id).update(
+                updated=timezone.now())
+
+            if self.issued and not Answer.objects.filter(
+                    answer_group=self).exists():
+                # First answers for an issued token make it a respondent
+                SurveyTally.add(self.survey_id, 1)
+
+            old = {values[0]: answer_bucket(*values[1:]) for values in
+                Answer.objects.filter(answer_group=self,
+                    question_id__in=[answer.question_id for answer in answers]
+                ).values_list("question_id", *fields)}
+
+            deltas = {}
+            for answer in answers:
+                before = old.get(answer.question_id, NOT_TALLIED)
+                after = answer.tally_bucket
+                if before != after:
+                    if before is not NOT_TALLIED:
+                        key = (answer.question_id, before)
+                        deltas[key] = deltas.get(key, 0) - 1
+                    if after is not NOT_TALLIED:
+                        key = (answer.question_id, after)
+                        deltas[key] = deltas.get(key, 0) + 1
+
+            Answer.objects.bulk_create(answers, update_conflicts=True,
+                unique_fields=["answer_group", "question"],
+                update_fields=[*fields, "updated"])
+            QuestionTally.apply(deltas)
+
+
+class AnswerQuerySet(models.QuerySet):
+    def delete(self):
+        with transaction.atomic():
+            QuestionTally.remove(self)
+
+            # Issued tokens left without answers stop being respondents
+            survey_ids = set(self.filter(answer_group__issued=True
+                ).values_list("answer_group__survey_id", flat=True))
+            result = super().delete()
+            if survey_ids:
+                SurveyTally.recount(survey_ids)
+
+            return result
 
 
 class Answer(TimeTrackModel):
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
-    answer_group = models.ForeignKey(AnswerGroup, on_delete=models.CASCADE)
+
+    # Indexed by the unique constraint below
+    answer_group = models.ForeignKey(AnswerGroup, on_delete=models.CASCADE,
+        db_index=False)
 
     bool_answer = models.BooleanField(blank=True, null=True)
     num_answer = models.IntegerField(blank=True, null=True)
@@ -315,10 +634,61 @@ class Answer(TimeTrackModel):
     text_answer = models.TextField(blank=True, null=True)
     choices_answer = models.CharField(max_length=50, blank=True, null=True)
 
+    objects = AnswerQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["answer_group", "question"],
+                name="unique_answer"),
+        ]
+
     def __str__(self):
         return f"Answer(id={self.id}, q={self.question.id})"
 
+    # Bucket this answer was counted in when loaded, new objects haven't
+    # been counted anywhere yet
+    _bucket_at_load = NOT_TALLIED
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if instance.get_deferred_fields() & set(ANSWER_FIELDS.values()):
+            instance._bucket_at_load = DEFERRED
+        else:
+            instance._bucket_at_load = instance.tally_bucket
+
+        return instance
+
+    @property
+    def tally_bucket(self):
+        return answer_bucket(self.bool_answer, self.num_answer,
+            self.star_answer, self.text_answer, self.choices_answer)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self._bucket_at_load is DEFERRED:
+                values = Answer.objects.filter(id=self.id).values_list(
+                    "bool_answer", "num_answer", "star_answer", "text_answer",
+                    "choices_answer").first()
+                self._bucket_at_load = NOT_TALLIED
+                if values is not None:
+                    self._bucket_at_load = answer_bucket(*values)
+
+            super().save(*args, **kwargs)
+            bucket = self.tally_bucket
+            QuestionTally.move(self.question_id, self._bucket_at_load, bucket)
+
+        self._bucket_at_load = bucket
+
+    def delete(self, *args, **kwargs):
+        return Answer.objects.filter(id=self.id).delete()
+
     def set_value(self, value):
+        self.assign_value(value)
+        self.save()
+
+    def assign_value(self, value):
+        """Validates and sets the value of this answer without saving it"""
         try:
             if self.question.question_type == QuestionTypes.BOOLEAN:
                 if isinstance(value, str | int):
@@ -347,8 +717,6 @@ class Answer(TimeTrackModel):
         except:
             raise ValueError(f"Value *{value}* not valid for {self.question}")
 
-        self.save()
-
     def get_form_value(self):
         if self.question.question_type == QuestionTypes.BOOLEAN:
             return "1" if self.bool_answer else "0"
@@ -384,3 +752,269 @@ class Answer(TimeTrackModel):
             return self.choices_answer is not None
 
         raise RuntimeError(f"{question} has invalid type")
+
+
+@receiver(models.signals.pre_delete, sender=Page)
+def page_deleting(sender, instance, origin=None, **kwargs):
+    if getattr(origin, "model", type(origin)) is Survey:
+        # The survey's questions and their tallies are going with it
+        return
+
+    # Answers to the page's own questions go with their tallies, the page's
+    # groups can also hold answers to questions on other pages
+    QuestionTally.remove(Answer.objects.filter(answer_group__page=instance
+        ).exclude(question__page=instance))
+
+
+@receiver(models.signals.post_delete, sender=Page)
+def page_deleted(sender, instance, origin=None, **kwargs):
+    surveys = Survey.objects.filter(id=instance.survey_id)
+    touch_survey(surveys)
+    if getattr(origin, "model", type(origin)) is Page:
+        # The page's groups are gone and issued tokens that only answered its
+        # questions no longer count
+        SurveyTally.recount(surveys.values("id"))
+
+
+@receiver(models.signals.post_delete, sender=Question)
+def question_deleted(sender, instance, origin=None, **kwargs):
+    surveys = Survey.objects.filter(page=instance.page_id)
+    touch_survey(surveys)
+    if getattr(origin, "model", type(origin)) is Question:
+        # Issued tokens that only answered this question no longer count
+        SurveyTally.recount(surveys.values("id"))
+
+# ---------------------------------------------------------------------------
+
+def answer_bucket(bool_answer, num_answer, star_answer, text_answer,
+        choices_answer):
+    """Returns the :class:`QuestionTally` bucket value for an answer's value
+    columns. Only one column is ever populated for a given answer, so the
+    question's type isn't needed. Empty answers are in the None bucket and
+    text answers are not tallied at all."""
+    if text_answer is not None:
+        return NOT_TALLIED
+
+    if bool_answer is not None:
+        return "1" if bool_answer else "0"
+
+    for value in (num_answer, star_answer, choices_answer):
+        if value is not None:
+            return str(value)
+
+    return None
+
+
+def bucket_counts(answers):
+    """Returns a dict mapping (question id, bucket value) to the number of
+    the given answers in that bucket, counted in a single query.
+
+    :param answers: :class:`Answer` queryset to count
+    """
+    counts = {}
+    rows = answers.filter(text_answer=None).values_list("question_id",
+        "bool_answer", "num_answer", "star_answer", "choices_answer").annotate(
+        models.Count("id")).order_by()
+    for q_id, boolean, num, star, choice, count in rows:
+        key = (q_id, answer_bucket(boolean, num, star, None, choice))
+        counts[key] = counts.get(key, 0) + count
+
+    return counts
+
+
+class QuestionTally(models.Model):
+    """Materialized count of the answers to a question that have a given
+    value. Maintained as answers are saved and deleted, use the
+    ``rebuild_tallies`` management command to repair any drift."""
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    value = models.CharField(max_length=50, blank=True, null=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["question", "value"],
+                name="unique_question_tally"),
+        ]
+
+    def __str__(self):
+        return (f"QuestionTally(q={self.question_id}, value={self.value}, "
+            f"count={self.count})")
+
+    @classmethod
+    def move(cls, question_id, old, new):
+        """Moves a single answer from the ``old`` bucket to the ``new`` one,
+        either of which may be :data:`NOT_TALLIED`."""
+        if old == new:
+            return
+
+        deltas = {}
+        if old is not NOT_TALLIED:
+            deltas[(question_id, old)] = -1
+        if new is not NOT_TALLIED:
+            deltas[(question_id, new)] = 1
+
+        cls.apply(deltas)
+
+    @classmethod
+    def apply(cls, deltas):
+        """Adjusts the counts of multiple buckets using a fixed number of
+        queries.
+
+        :param deltas: dict mapping (question id, bucket value) to the amount
+            the count is to change by
+        """
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        with transaction.atomic():
+            buckets = {}
+            question_ids = {question_id for question_id, _ in deltas}
+            for tally in cls.objects.filter(question_id__in=question_ids):
+                buckets.setdefault((tally.question_id, tally.value), tally)
+
+            to_update = []
+            to_create = []
+            for (question_id, value), delta in deltas.items():
+                tally = buckets.get((question_id, value))
+                if tally is not None:
+                    tally.count = models.F("count") + delta
+                    to_update.append(tally)
+                elif delta > 0:
+                    # Negative with nothing to remove from means the question
+                    # is likely being deleted
+                    to_create.append(cls(question_id=question_id,
+                        value=value, count=delta))
+
+            if to_update:
+                cls.objects.bulk_update(to_update, ["count"])
+
+            if not to_create:
+                return
+
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(to_create)
+            except IntegrityError:
+                # Lost a race with another writer creating a bucket, fall
+                # back to doing them one at a time
+                for tally in to_create:
+                    cls._apply_one(tally.question_id, tally.value,
+                        tally.count)
+
+    @classmethod
+    def remove(cls, answers):
+        """Takes answers that are about to be deleted out of their buckets.
+
+        :param answers: :class:`Answer` queryset being deleted
+        """
+        cls.apply({key: -count for key, count in
+            bucket_counts(answers).items()})
+
+    @classmethod
+    def _apply_one(cls, question_id, value, delta):
+        buckets = cls.objects.filter(question_id=question_id, value=value)
+        if buckets.update(count=models.F("count") + delta):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(question_id=question_id, value=value,
+                    count=delta)
+        except IntegrityError:
+            buckets.update(count=models.F("count") + delta)
+
+    @classmethod
+    def rebuild(cls, questions):
+        """Recounts the buckets for the given questions from scratch.
+
+        :param questions: :class:`Question` queryset to rebuild
+        :returns: number of buckets whose count was wrong
+        """
+        with transaction.atomic():
+            counts = bucket_counts(Answer.objects.filter(
+                question__in=questions))
+
+            existing = {}
+            tallies = cls.objects.filter(question__in=questions)
+            for q_id, value, count in tallies.values_list("question_id",
+                    "value", "count"):
+                key = (q_id, value)
+                existing[key] = existing.get(key, 0) + count
+
+            drift = sum(1 for key in counts.keys() | existing.keys()
+                if counts.get(key, 0) != existing.get(key, 0))
+
+            tallies.delete()
+            cls.objects.bulk_create([
+                cls(question_id=q_id, value=value, count=count)
+                for (q_id, value), count in counts.items()
+            ])
+
+        return drift
+
+
+class SurveyTally(models.Model):
+    """Materialized count of a survey's respondents, as defined by
+    :meth:`AnswerGroup.responded`, so results don't recount them. Maintained
+    as groups are saved and deleted, use the ``rebuild_tallies`` management
+    command to repair any drift."""
+    survey = models.OneToOneField(Survey, on_delete=models.CASCADE,
+        primary_key=True)
+    respondents = models.IntegerField(default=0)
+
+    def __str__(self):
+        return (f"SurveyTally(survey={self.survey_id}, "
+            f"respondents={self.respondents})")
+
+    @classmethod
+    def total(cls, survey):
+        """Returns the number of respondents to the given survey"""
+        total = cls.objects.filter(survey=survey).values_list("respondents",
+            flat=True).first()
+        if total is None:
+            # Surveys loaded without Survey.save() have no row until rebuilt
+            total = AnswerGroup.responded(survey).count()
+
+        return total
+
+    @classmethod
+    def add(cls, survey_id, delta):
+        cls.objects.filter(survey_id=survey_id).update(
+            respondents=models.F("respondents") + delta)
+
+    @classmethod
+    def _counted(cls):
+        groups = AnswerGroup.responded(models.OuterRef("survey_id"))
+        return Coalesce(models.Subquery(groups.order_by(
+            ).values("survey").annotate(c=models.Count("pk")).values("c")), 0)
+
+    @classmethod
+    def recount(cls, survey_ids):
+        """Recounts the respondents of the given surveys in a single query,
+        surveys without a tally row are skipped.
+
+        :param survey_ids: survey ids or a queryset of them
+        """
+        cls.objects.filter(survey_id__in=survey_ids).update(
+            respondents=cls._counted())
+
+    @classmethod
+    def rebuild(cls, surveys):
+        """Recounts the respondents for the given surveys from scratch.
+
+        :param surveys: :class:`Survey` queryset to rebuild
+        :returns: number of surveys whose count was wrong
+        """
+        with transaction.atomic():
+            ids = set(surveys.values_list("id", flat=True))
+            ids -= set(cls.objects.filter(survey_id__in=ids).values_list(
+                "survey_id", flat=True))
+            cls.objects.bulk_create([cls(survey_id=id) for id in ids])
+
+            tallies = cls.objects.filter(survey__in=surveys)
+            drift = tallies.annotate(counted=cls._counted()).exclude(
+                respondents=models.F("counted")).count()
+            tallies.update(respondents=cls._counted())
+
+        return drift
@@ -0,0 +1,186 @@
+from django.db.models import Count, Sum
+
+from core.models import (Page, Question, QuestionTypes, Answer,
+    QuestionTally, SurveyTally, Tally)
+
+# ===========================================================================
+
+def text_answers(question_ids):
+    """Returns a queryset of the non-empty answers to the given TEXT
+    questions"""
+    return Answer.objects.filter(question_id__in=question_ids,
+        text_answer__isnull=False).exclude(text_answer="")
+
+# ===========================================================================
+
+class QuestionResult:
+    """Results for a single question inside of a :class:`SurveyResults`.
+
+    :param question: the :class:`Question` these results are for
+    :param tally: :class:`Tally` of the question's answers
+    :param text_count: number of non-empty answers if this is a TEXT
+        question, the answers themselves are served in chunks by the
+        ``result_text`` view
+    """
+    def __init__(self, question, tally, text_count=0):
+        self.question = question
+        self.tally = tally
+        self.text_count = text_count
+
+    @property
+    def responses(self):
+        """Number of answers to this question that have a value"""
+        if self.question.question_type == QuestionTypes.TEXT:
+            return self.text_count
+
+        return sum(self.tally.counts.values())
+
+    @property
+    def bars(self):
+        return graph_bars(self.question, self.tally)
+
+
+class SurveyResults:
+    """Snapshot of every answer in a survey, computed in a fixed number of
+    queries regardless of how many pages, questions or respondents the survey
+    has.
+
+    :param survey: the :class:`Survey` to report on
+    """
+    def __init__(self, survey):
+        self.survey = survey
+        self.pages = list(Page.objects.filter(survey=survey).prefetch_related(
+            "question_set"))
+        self.total = SurveyTally.total(survey)
+
+        questions = {}
+        for page in self.pages:
+            for question in page.question_set.all():
+                questions[question.id] = question
+
+        # Bucket counts for every question come from the tally table in one
+        # query
+        buckets = {q_id: [] for q_id in questions}
+        rows = QuestionTally.objects.filter(question_id__in=questions.keys()
+            ).values_list("question_id", "value").annotate(Sum("count")
+            ).order_by()
+        for q_id, value, count in rows:
+            buckets[q_id].append((value, count))
+
+        text_ids = [q_id for q_id, question in questions.items()
+            if question.question_type == QuestionTypes.TEXT]
+        text_counts = {}
+        if text_ids:
+            rows = text_answers(text_ids).values_list("question_id").annotate(
+                Count("id")).order_by()
+            text_counts = dict(rows)
+
+        self.questions = {}
+        for q_id, question in questions.items():
+            tally = Tally.from_buckets(question.question_type,
+                buckets[q_id], self.total)
+            self.questions[q_id] = QuestionResult(question, tally,
+                text_counts.get(q_id, 0))
+
+    def __getitem__(self, question):
+        """Returns the :class:`QuestionResult` for the given question or
+        question id"""
+        if isinstance(question, Question):
+            question = question.id
+
+        return self.questions[question]
+
+    def by_page(self):
+        """Generator of (page, [QuestionResult, ...]) in rank order"""
+        for page in self.pages:
+            yield page, [self.questions[q.id] for q in
+                page.question_set.all()]
+
+# ===========================================================================
+# Graph Data
+# ===========================================================================
+
+def graph_bars(question, tally):
+    """Returns a tuple of (labels, data) lists for the question's bar graph,
+    or None if there is nothing to graph.
+
+    :param question: :class:`Question` being graphed
+    :param tally: :class:`Tally` of the question's answers
+    """
+    if question.question_type == QuestionTypes.TEXT:
+        return None
+
+    # Check that there are answers at all
+    if tally.answered == 0:
+        return None
+
+    if question.question_type == QuestionTypes.BOOLEAN:
+        return _bars_boolean(question, tally)
+    elif question.question_type == QuestionTypes.NUM:
+        return _bars_num(question, tally)
+    elif question.question_type == QuestionTypes.STAR:
+        return _bars_star(question, tally)
+    elif question.question_type == QuestionTypes.CHOICE:
+        return _bars_choice(question, tally)
+
+
+def _bars_boolean(question, tally):
+    total_true = tally[True]
+    total_false = tally[False]
+
+    dna = tally.total - (total_true + total_false)
+
+    data = [total_true, total_false, dna]
+    return ["True", "False", "None"], data
+
+
+def _bars_num(question, tally):
+    if question.num_answer_min is not None:
+        bottom = question.num_answer_min
+    else:
+        bottom = min(tally.counts, default=0)
+
+    if question.num_answer_max is not None:
+        top = question.num_answer_max
+    else:
+        top = max(tally.counts, default=-1)
+
+    data = []
+    labels = []
+    for num in range(bottom, top + 1):
+        data.append(tally[num])
+        labels.append(str(num))
+
+    dna = tally.total - sum(data)
+    data.append(dna)
+    labels.append("None")
+
+    return labels, data
+
+
+def _bars_star(question, tally):
+    data = []
+    labels = []
+    for num in range(5, 0, -1):
+        data.append(tally[num])
+        labels.append(str(num))
+
+    dna = tally.total - sum(data)
+    data.append(dna)
+    labels.append("None")
+
+    return labels, data
+
+
+def _bars_choice(question, tally):
+    labels = []
+    data = []
+    for choice in question.choices:
+        labels.append(choice[1])
+        data.append(tally[choice[0]])
+
+    labels.append("None")
+    dna = tally.total - sum(data)
+    data.append(dna)
+
+    return labels, data
@@ -0,0 +1,183 @@
+"""Simulated respondents, used by the benchmarking, load testing and test
+data management commands."""
+from django.core import signing
+
+from core.models import AnswerGroup, QuestionTypes, TOKEN_COOKIE_SALT
+
+# ===========================================================================
+
+# Chance an optional question is left blank
+SKIP_CHANCE = 0.2
+
+# Range used for NUM questions that have no limits
+NUM_RANGE = (0, 100)
+
+# Simulated respondents deleted per query when cleaning up
+DELETE_BATCH = 500
+
+# Chance a synthetic respondent gives up part way through a survey
+DROP_OUT_CHANCE = 0.15
+
+# Words synthetic text answers are made from
+TEXT_WORDS = ("good", "bad", "great", "slow", "fast", "easy", "confusing",
+    "price", "service", "staff", "website", "delivery", "quality", "support",
+    "would", "recommend", "again", "never", "always", "more", "less")
+
+# ===========================================================================
+
+def random_page_data(page, rand):
+    """Returns POST data with a random valid answer for the questions on a
+    :class:`CompiledPage`.
+
+    :param page: the :class:`CompiledPage` being filled in
+    :param rand: :class:`random.Random` to draw the answers from
+    """
+    data = {}
+    for question in page.questions:
+        if not question.required and rand.random() < SKIP_CHANCE:
+            continue
+
+        name = f"question-{question.id}"
+        if question.question_type == QuestionTypes.BOOLEAN:
+            data[name] = rand.choice(("1", "0"))
+        elif question.question_type == QuestionTypes.NUM:
+            data[name] = rand.randint(*_num_range(question))
+        elif question.question_type == QuestionTypes.STAR:
+            data[name] = str(rand.randint(1, 5))
+        elif question.question_type == QuestionTypes.TEXT:
+            data[name] = rand.choice(("Yes", "No", "Maybe",
+                "Lorem ipsum dolor sit amet"))
+        elif question.question_type == QuestionTypes.CHOICE:
+            data[name] = rand.choice(question.choices)[0]
+
+    return data
+
+
+def respondent_flow(client, survey, compiled, rand):
+    """Generator of the requests one respondent makes as (view name, method,
+    url, data) tuples: the home page, starting the survey, viewing and
+    submitting each page, then the done page. Each request must be made
+    before the next is asked for, as later URLs need the token from the
+    cookie set when the survey is started.
+
+    :param client: Django test client, sync or async
+    :param survey: the :class:`Survey` being filled in
+    :param compiled: the survey's :class:`CompiledSurvey`
+    :param rand: :class:`random.Random` to draw the answers from
+    """
+    yield "home", client.get, "/", None
+    yield "home", client.post, "/", {"start-slug": survey.slug}
+    yield "start_quiz", client.get, f"/{survey.slug}/", None
+
+    token = respondent_token(client, survey)
+    for page in compiled.pages:
+        url = f"/page/{survey.id}/{token}/{page.rank}/"
+        yield "page", client.get, url, None
+        yield "page", client.post, url, random_page_data(page, rand)
+
+    yield "done", client.get, f"/done/{survey.id}/{token}/", None
+
+
+def respondent_token(client, survey):
+    """Returns the token from the survey's cookie in the client, or None if
+    the survey hasn't been started"""
+    cookie = client.cookies.get(survey.slug)
+    if cookie is None:
+        return None
+
+    return signing.get_cookie_signer(salt=survey.slug +
+        TOKEN_COOKIE_SALT).unsign(cookie.value)
+
+
+def delete_respondents(survey, tokens):
+    """Deletes simulated respondents and their answers from a survey.
+
+    :param survey: the :class:`Survey` they filled in
+    :param tokens: list of their tokens, see :func:`respondent_token`
+    """
+    for start in range(0, len(tokens), DELETE_BATCH):
+        AnswerGroup.objects.filter(survey=survey, token__in=tokens[
+            start:start + DELETE_BATCH]).delete()
+
+
+# ---------------------------------------------------------------------------
+
+def _num_range(question):
+    bottom = question.num_answer_min
+    if bottom is None:
+        bottom = NUM_RANGE[0]
+    top = question.num_answer_max
+    if top is None:
+        top = max(bottom, NUM_RANGE[1])
+
+    return bottom, top
+
+
+class AnswerProfile:
+    """Distribution of the answers to one question for synthetic data. The
+    shape is drawn from the random source once per question, so each
+    question gets its own skew rather than a flat spread, and the same seed
+    always gives the same data.
+
+    :param question: :class:`Question` being answered
+    :param rand: :class:`random.Random` to draw the shape from
+    """
+    def __init__(self, question, rand):
+        self.question = question
+        self.field = question.answer_field
+        self.blank_chance = 0 if question.required else rand.uniform(0.05,
+            0.3)
+
+        question_type = question.question_type
+        if question_type == QuestionTypes.BOOLEAN:
+            self.true_chance = rand.uniform(0.2, 0.8)
+        elif question_type == QuestionTypes.NUM:
+            self.low, self.high = _num_range(question)
+            self.mode = rand.uniform(self.low, self.high)
+        elif question_type == QuestionTypes.STAR:
+            self.values = [1, 2, 3, 4, 5]
+            self.weights = [rand.gammavariate(2, 1) for _ in self.values]
+        elif question_type == QuestionTypes.CHOICE:
+            self.values = [choice[0] for choice in question.choices]
+            self.weights = [rand.gammavariate(2, 1) for _ in self.values]
+
+    def draw(self, rand):
+        """Returns a random answer value, None for a blank answer"""
+        if self.blank_chance and rand.random() < self.blank_chance:
+            return None
+
+        question_type = self.question.question_type
+        if question_type == QuestionTypes.BOOLEAN:
+            return rand.random() < self.true_chance
+        elif question_type == QuestionTypes.NUM:
+            return round(rand.triangular(self.low, self.high, self.mode))
+        elif question_type == QuestionTypes.TEXT:
+            return " ".join(rand.choices(TEXT_WORDS, k=rand.randint(1, 12)))
+
+        return rand.choices(self.values, self.weights)[0]
+
+
+def synthetic_respondent(pages, rand):
+    """Returns a synthetic respondent's progress through a survey as a
+    tuple of (current page id, [(question, field name, value), ...]).
+
+    Most respondents answer every page and have a current page of None, the
+    rest give up after answering at least one page.
+
+    :param pages: list of (:class:`CompiledPage`, [:class:`AnswerProfile`,
+        ...]) for the survey in order
+    :param rand: :class:`random.Random` to draw the answers from
+    """
+    answered = len(pages)
+    page_id = None
+    if answered > 1 and rand.random() < DROP_OUT_CHANCE:
+        answered = rand.randrange(1, answered)
+        page_id = pages[answered][0].id
+
+    answers = []
+    for _, profiles in pages[:answered]:
+        for profile in profiles:
+            answers.append((profile.question, profile.field,
+                profile.draw(rand)))
+
+    return page_id, answers
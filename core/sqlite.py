@@ -0,0 +1,158 @@
+"""SQLite write throughput. SQLite allows a single writer at a time, this
+module provides an optional queue that funnels the writes from many requests
+through one thread and commits them in batches, along with the connection
+settings that let readers and writers coexist.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# ===========================================================================
+
+logger = logging.getLogger(__name__)
+
+# ===========================================================================
+
+def configure_connection(sender, connection, **kwargs):
+    """Connected to ``connection_created``. WAL mode lets pages be read while
+    an answer is being written, and NORMAL sync is safe in WAL mode. Set
+    here rather than with the ``init_command`` database option, which needs
+    Django 5.1. Like ``init_command`` they run on the underlying connection,
+    so they aren't counted as a request's queries."""
+    if connection.vendor != "sqlite":
+        return
+
+    connection.connection.execute("PRAGMA journal_mode = WAL")
+    connection.connection.execute("PRAGMA synchronous = NORMAL")
+
+# ===========================================================================
+
+class WriteCoalescer:
+    """Runs database writes from many requests in one background thread,
+    committing those that arrive within ``window`` seconds of each other in
+    a single transaction. With one writer there is no lock contention, and
+    the cost of each commit is shared by the whole batch.
+
+    Callers block until the batch containing their write has committed, so a
+    response is never sent for data that isn't on disk. Batches are
+    committed with ``synchronous=FULL`` on SQLite for the same reason.
+
+    :param window: seconds to wait for more writes after the first one
+    :param max_batch: most writes committed in one transaction
+    """
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "batches": 0,
+            "writes": 0,
+            "failures": 0,
+        }
+
+    def submit(self, func, *args, **kwargs):
+        """Runs ``func(*args, **kwargs)`` in the next batch and returns its
+        result once the batch has committed. Each write runs in its own
+        savepoint, if it raises only it is rolled back and the exception is
+        re-raised here."""
+        if threading.current_thread() is self._thread:
+            # Already inside a batch
+            return func(*args, **kwargs)
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="write-coalescer", daemon=True)
+                self._thread.start()
+
+        future = Future()
+        self._queue.put((func, args, kwargs, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        results = []
+        try:
+            if connection.vendor == "sqlite":
+                with connection.cursor() as cursor:
+                    cursor.execute("PRAGMA synchronous = FULL")
+
+            with transaction.atomic():
+                for func, args, kwargs, future in batch:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, func(*args, **kwargs),
+                                None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # Nothing in the batch was written
+            logger.exception("Write batch of %d failed", len(batch))
+            self.stats["failures"] += len(batch)
+            connection.close()
+            for _, _, _, future in batch:
+                future.set_exception(e)
+
+            return
+
+        self.stats["batches"] += 1
+        self.stats["writes"] += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                self.stats["failures"] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+def get_write_coalescer():
+    """Returns this process's :class:`WriteCoalescer`, or None if the
+    ``WRITE_COALESCER`` setting is off. Configured by the
+    ``WRITE_COALESCER_WINDOW`` and ``WRITE_COALESCER_MAX_BATCH`` settings."""
+    global _coalescer
+    if not settings.WRITE_COALESCER:
+        return None
+
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = WriteCoalescer(settings.WRITE_COALESCER_WINDOW,
+                settings.WRITE_COALESCER_MAX_BATCH)
+
+    return _coalescer
+
+
+def coalesced(func, *args, **kwargs):
+    """Runs a database write through the write coalescer if it is on,
+    otherwise runs it directly. Either way it has committed when this
+    returns."""
+    coalescer = get_write_coalescer()
+    if coalescer is None:
+        return func(*args, **kwargs)
+
+    return coalescer.submit(func, *args, **kwargs)
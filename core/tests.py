@@ -1,3 +1,1089 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections
+from django.db.models import Count, QuerySet
+from django.http import HttpResponse
+from django.test import (AsyncRequestFactory, Client, RequestFactory,
+    SimpleTestCase, TestCase, TransactionTestCase, tag)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core import graphs, instrumentation
+from core.graphs import (COLOURS, RENDER_TIMEOUT, GraphCache, RenderQueue,
+    build_bar_svg, render_bar_svg)
+from core.models import (Survey, Page, Question, QuestionTypes, AnswerGroup,
+    Answer, QuestionTally, SurveyTally, CompiledSurvey, TOKEN_COOKIE_SALT)
+from core.simulate import random_page_data
+
+# ===========================================================================
+
+MB = 1024 * 1024
+
+SVG = "{http://www.w3.org/2000/svg}"
+
+# ===========================================================================
+
+def create_survey(slug="test"):
+    """Returns a survey with one page holding a question of each type"""
+    survey = Survey.objects.create(name="Test", slug=slug)
+    page = Page.objects.create(survey=survey)
+
+    choices = [["R", "Red"], ["G", "Green"], ["B", "Blue"]]
+    for question_type in (QuestionTypes.BOOLEAN, QuestionTypes.STAR,
+            QuestionTypes.NUM, QuestionTypes.CHOICE, QuestionTypes.TEXT):
+        Question.objects.create(page=page, question_type=question_type,
+            question_text="?", choices=choices, num_answer_min=1,
+            num_answer_max=10)
+
+    # Reload so the survey's version matches its saved pages
+    return Survey.objects.get(id=survey.id)
+
+
+def tallies(survey):
+    """Returns a dict of (question id, bucket value) to count for the
+    survey's non-empty tally buckets"""
+    return {(q_id, value): count for q_id, value, count in
+        QuestionTally.objects.filter(question__page__survey=survey,
+        count__gt=0).values_list("question_id", "value", "count")}
+
+
+class TallyTestMixin:
+    def assertTalliesExact(self, survey):
+        # Rebuilding from the answers finds nothing to fix
+        questions = Question.objects.filter(page__survey=survey)
+        self.assertEqual(QuestionTally.rebuild(questions), 0)
+        self.assertEqual(SurveyTally.rebuild(Survey.objects.filter(
+            id=survey.id)), 0)
+
+# ===========================================================================
+
+@tag("slow")
+class RenderMemoryTest(SimpleTestCase):
+    # Graphs rendered, the first tenth of them warm matplotlib up and the
+    # process may only grow by TOLERANCE over the rest. Over the second half
+    # it has to have levelled off, growing by less than SETTLED, which
+    # catches a leak too slow to reach TOLERANCE
+    RENDERS = 2000
+    TOLERANCE = 10 * MB
+    SETTLED = 2 * MB
+
+    def test_rss_stays_flat(self):
+        # No workers renders in this process, through render_bar_matplotlib
+        queue = RenderQueue("matplotlib", workers=0)
+        warm_up = self.RENDERS // 10
+        halfway = self.RENDERS // 2
+
+        labels = [str(num) for num in range(1, 11)] + ["None"]
+        rand = random.Random(42)
+
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            for num in range(self.RENDERS):
+                data = [rand.randint(0, 100) for _ in labels]
+                queue.submit(temp / "graph.marker", temp / "graph.svg",
+                    labels, data, COLOURS)
+
+                if num + 1 == warm_up:
+                    baseline = queue.stats["last_rss"]
+                elif num + 1 == halfway:
+                    middle = queue.stats["last_rss"]
+
+        self.assertEqual(queue.stats["renders"], self.RENDERS)
+        self.assertEqual(queue.stats["failures"], 0)
+
+        growth = queue.stats["last_rss"] - baseline
+        self.assertLess(growth, self.TOLERANCE, f"Memory grew by "
+            f"{growth / MB:.1f}MB rendering {self.RENDERS} graphs")
+
+        growth = queue.stats["last_rss"] - middle
+        self.assertLess(growth, self.SETTLED, f"Memory was still growing, by "
+            f"{growth / MB:.1f}MB over the last {self.RENDERS - halfway} "
+            "graphs")
+
+
+class GraphCacheTest(SimpleTestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.root = Path(temp.name)
+
+    def make_stale(self, marker):
+        old = time.time() - RENDER_TIMEOUT - 1
+        os.utime(marker, (old, old))
+
+    def test_render_deduplicated(self):
+        queue = RenderQueue("svg", workers=0)
+        marker = self.root / "q-1.rendering"
+        file = self.root / "q-1.svg"
+
+        self.assertTrue(graphs._claim(marker))
+        self.assertFalse(graphs._claim(marker))
+        self.assertFalse(queue.submit(marker, file, ["a"], [1], COLOURS))
+        self.assertFalse(file.exists())
+
+        # Once the marker is gone the graph renders, removing its marker
+        marker.unlink()
+        self.assertTrue(queue.submit(marker, file, ["a"], [1], COLOURS))
+        self.assertTrue(file.exists())
+        self.assertFalse(marker.exists())
+        self.assertEqual(queue.stats["renders"], 1)
+
+    def test_stale_marker_taken_over(self):
+        marker = self.root / "q-1.rendering"
+        self.assertTrue(graphs._claim(marker))
+        self.make_stale(marker)
+
+        self.assertTrue(graphs._claim(marker))
+        self.assertFalse(graphs._claim(marker))
+        self.assertEqual([path.name for path in self.root.iterdir()],
+            [marker.name])
+
+    def test_stale_marker_taken_over_once(self):
+        # Two processes that both found the same stale marker, only the
+        # first to take it over gets to render
+        marker = self.root / "q-1.rendering"
+        self.assertTrue(graphs._claim(marker))
+        self.make_stale(marker)
+        stale = marker.read_text()
+
+        self.assertTrue(graphs._take_over(marker, stale, "first"))
+        self.assertFalse(graphs._take_over(marker, stale, "second"))
+        self.assertEqual(marker.read_text(), "first")
+        self.assertEqual([path.name for path in self.root.iterdir()],
+            [marker.name])
+
+    def test_evict_least_recently_used(self):
+        cache = GraphCache(self.root, max_bytes=250, evict_interval=60)
+
+        now = time.time()
+        paths = []
+        for num in range(4):
+            path = cache.path(1, num, "key")
+            path.write_text("x" * 100)
+            os.utime(path, (now - 100 + num, now - 100 + num))
+            paths.append(path)
+
+        # Viewing the oldest graph makes it the most recently used
+        self.assertTrue(cache.get(paths[0]))
+        self.assertFalse(cache.get(cache.path(1, 9, "key")))
+
+        self.assertEqual(cache.evict(), 2)
+        self.assertEqual([path.exists() for path in paths], [True, False,
+            False, True])
+
+        # Scans are throttled unless forced
+        paths[1].write_text("x" * 100)
+        self.assertEqual(cache.evict(), 0)
+        self.assertEqual(cache.evict(force=True), 1)
+        self.assertEqual([path.exists() for path in paths], [True, True,
+            False, False])
+
+
+class BarSvgTest(SimpleTestCase):
+    def parse(self, labels, data):
+        root = ElementTree.fromstring(build_bar_svg(labels, data, COLOURS))
+        self.assertEqual(root.tag, f"{SVG}svg")
+        return root
+
+    def test_bars(self):
+        labels = [str(num) for num in range(1, 9)]
+        data = [3, 0, 7, 1, 2, 9, 4, 5]
+        root = self.parse(labels, data)
+
+        rects = root.findall(f"{SVG}rect")
+        self.assertEqual(len(rects), len(data))
+        self.assertEqual([rect.find(f"{SVG}title").text for rect in rects],
+            [f"{label}: {value}" for label, value in zip(labels, data)])
+
+        # Colours repeat and the tallest bar is the tallest drawn
+        self.assertEqual(rects[6].get("fill"), COLOURS[0])
+        heights = [float(rect.get("height")) for rect in rects]
+        self.assertEqual(heights.index(max(heights)), 5)
+        self.assertEqual(heights[1], 0)
+
+    def test_labels_escaped(self):
+        labels = ["<b>Tom & Jerry</b>", 'Say "hi"']
+        content = build_bar_svg(labels, [1, 2], COLOURS)
+        self.assertNotIn("<b>", content)
+
+        root = self.parse(labels, [1, 2])
+        texts = [text.text for text in root.findall(f"{SVG}text[@class='x']")]
+        self.assertEqual(texts, labels)
+
+    def test_empty(self):
+        root = self.parse([], [])
+        self.assertEqual(root.findall(f"{SVG}rect"), [])
+        self.assertEqual([text.text for text in root.findall(
+            f"{SVG}text[@class='y']")], ["0", "1"])
+
+        root = self.parse(["a", "b"], [0, 0])
+        self.assertEqual([rect.get("height") for rect in root.findall(
+            f"{SVG}rect")], ["0.0", "0.0"])
+
+    def test_render(self):
+        with tempfile.TemporaryDirectory() as temp:
+            file = render_bar_svg(Path(temp) / "graph.svg", ["a"], [1],
+                COLOURS)
+            self.assertEqual(file.read_text(), build_bar_svg(["a"], [1],
+                COLOURS))
+            self.assertEqual(os.listdir(temp), ["graph.svg"])
+
+
+class SaveValuesTest(TallyTestMixin, TestCase):
+    def setUp(self):
+        self.survey = create_survey()
+        self.compiled = CompiledSurvey.get(self.survey)
+        self.boolean, self.star, self.num, self.choice, self.text = \
+            self.compiled.first_page.questions
+
+    def data(self, **values):
+        return {f"question-{getattr(self, name).id}": value for name, value in
+            values.items()}
+
+    def test_pending_group_saved_with_first_answers(self):
+        group = AnswerGroup.pending(self.survey, "token", self.compiled)
+        group.save_values(self.compiled, self.data(choice="", text=""))
+        self.assertIsNone(group.pk)
+        self.assertFalse(AnswerGroup.objects.exists())
+        self.assertEqual(SurveyTally.total(self.survey), 0)
+
+        group.save_values(self.compiled, self.data(boolean="1", num=3,
+            text="words"))
+        self.assertIsNotNone(group.pk)
+        self.assertEqual(group.answer_set.count(), 3)
+        self.assertEqual(SurveyTally.total(self.survey), 1)
+        self.assertEqual(tallies(self.survey), {
+            (self.boolean.id, "1"): 1,
+            (self.num.id, "3"): 1,
+        })
+        self.assertTalliesExact(self.survey)
+
+    def test_upsert_moves_tallies(self):
+        group = AnswerGroup.factory(self.survey.slug)
+        group.save_values(self.compiled, self.data(boolean="1", star=5,
+            choice="R"))
+        ids = set(group.answer_set.values_list("id", flat=True))
+
+        group.save_values(self.compiled, self.data(boolean="0", star=5,
+            choice=None))
+
+        # Same rows updated in place, with the counts moved between buckets
+        self.assertEqual(set(group.answer_set.values_list("id", flat=True)),
+            ids)
+        self.assertEqual(tallies(self.survey), {
+            (self.boolean.id, "0"): 1,
+            (self.star.id, "5"): 1,
+            (self.choice.id, None): 1,
+        })
+        self.assertEqual(SurveyTally.total(self.survey), 1)
+        self.assertTalliesExact(self.survey)
+
+    def test_token_unique_per_survey(self):
+        group = AnswerGroup.pending(self.survey, "token", self.compiled)
+        group.save_values(self.compiled, self.data(boolean="1"))
+
+        # A second first submission for the token joins the saved group
+        twin = AnswerGroup.pending(self.survey, "token", self.compiled)
+        twin.save_values(self.compiled, self.data(boolean="0"))
+        self.assertEqual(twin.pk, group.pk)
+        self.assertEqual(SurveyTally.total(self.survey), 1)
+        self.assertTalliesExact(self.survey)
+
+        with self.assertRaises(IntegrityError):
+            AnswerGroup.objects.create(survey=self.survey, token="token")
+
+    def test_lost_first_save_race(self):
+        group = AnswerGroup.pending(self.survey, "token", self.compiled)
+        group.save_values(self.compiled, self.data(boolean="1"))
+
+        # The other group is saved between the twin's check and its save
+        twin = AnswerGroup.pending(self.survey, "token", self.compiled)
+        with mock.patch.object(QuerySet, "first", return_value=None):
+            twin.save_values(self.compiled, self.data(boolean="0"))
+
+        self.assertEqual(twin.pk, group.pk)
+        self.assertEqual(AnswerGroup.objects.count(), 1)
+        self.assertTalliesExact(self.survey)
+
+    def test_issued_counts_once_answered(self):
+        tokens = next(AnswerGroup.issue_tokens(self.survey, 2))
+        self.assertEqual(SurveyTally.total(self.survey), 0)
+
+        group = AnswerGroup.objects.get(token=tokens[0])
+        group.save_values(self.compiled, self.data(num=4))
+        group.save_values(self.compiled, self.data(num=5))
+        self.assertEqual(SurveyTally.total(self.survey), 1)
+        self.assertTalliesExact(self.survey)
+
+
+class CompiledSurveyTest(TestCase):
+    def setUp(self):
+        self.survey = create_survey()
+        self.page = Page.objects.get(survey=self.survey)
+
+    def compiled(self):
+        # The views load the survey for every request
+        return CompiledSurvey.get(Survey.objects.get(id=self.survey.id))
+
+    def submit(self, compiled, data):
+        # As the page view does, a stale form drops fields it doesn't have
+        group = AnswerGroup.factory(self.survey.slug)
+        form = group.get_form(compiled, data)
+        form.is_valid()
+        group.save_values(compiled, form.cleaned_data)
+        return group
+
+    def test_cached(self):
+        compiled = self.compiled()
+        survey = Survey.objects.get(id=self.survey.id)
+        with self.assertNumQueries(0):
+            self.assertIs(CompiledSurvey.get(survey), compiled)
+
+    def test_question_added(self):
+        before = self.compiled()
+        question = Question.objects.create(page=self.page,
+            question_type=QuestionTypes.BOOLEAN, question_text="New?")
+
+        compiled = self.compiled()
+        self.assertIsNot(compiled, before)
+        self.assertIn(question.id, [q.id for q in
+            compiled.first_page.questions])
+
+        group = self.submit(compiled, {f"question-{question.id}": "1"})
+        self.assertTrue(group.answer_set.filter(question=question,
+            bool_answer=True).exists())
+
+    def test_question_changed(self):
+        question = Question.objects.get(page=self.page,
+            question_type=QuestionTypes.CHOICE)
+        self.compiled()
+
+        question.choices = question.choices + [["Y", "Yellow"]]
+        question.save()
+
+        group = self.submit(self.compiled(), {f"question-{question.id}":
+            "Y"})
+        self.assertTrue(group.answer_set.filter(question=question,
+            choices_answer="Y").exists())
+
+    def test_question_deleted(self):
+        question = Question.objects.get(page=self.page,
+            question_type=QuestionTypes.TEXT)
+        question_id = question.id
+        self.compiled()
+
+        question.delete()
+        self.assertNotIn(question_id, [q.id for q in
+            self.compiled().first_page.questions])
+
+    def test_page_changed(self):
+        self.compiled()
+
+        self.page.intro = "Welcome"
+        self.page.save()
+        self.assertEqual(self.compiled().first_page.intro, "Welcome")
+
+        second = Page.objects.create(survey=self.survey)
+        compiled = self.compiled()
+        self.assertEqual(compiled.first_page.next_rank, second.rank)
+        self.assertEqual(compiled.last_page.id, second.id)
+
+        second.delete()
+        self.assertEqual(len(self.compiled().pages), 1)
+
+
+class TallyConsistencyTest(TallyTestMixin, TestCase):
+    def setUp(self):
+        self.survey = create_survey()
+        self.compiled = CompiledSurvey.get(self.survey)
+        self.questions = self.compiled.first_page.questions
+        self.boolean, self.star = self.questions[:2]
+
+        rand = random.Random(42)
+        for _ in range(10):
+            group = AnswerGroup.factory(self.survey.slug)
+            group.save_values(self.compiled, {
+                f"question-{self.boolean.id}": rand.choice(("1", "0")),
+                f"question-{self.star.id}": rand.randint(1, 5),
+            })
+
+    def test_set_value(self):
+        answer = Answer.objects.filter(question=self.star).first()
+        answer.set_value(2)
+        answer.set_value(4)
+        self.assertTalliesExact(self.survey)
+
+        # Deferred value columns are read back before moving the count
+        answer = Answer.objects.only("id", "question").get(id=answer.id)
+        answer.set_value(1)
+        self.assertTalliesExact(self.survey)
+
+    def test_delete_answers(self):
+        Answer.objects.filter(question=self.star).first().delete()
+        self.assertTalliesExact(self.survey)
+
+        Answer.objects.filter(question=self.boolean, bool_answer=True
+            ).delete()
+        self.assertTalliesExact(self.survey)
+
+    def test_delete_groups(self):
+        groups = AnswerGroup.objects.order_by("id")
+        groups.first().delete()
+        self.assertTalliesExact(self.survey)
+
+        AnswerGroup.objects.filter(id__in=groups[:4].values("id")).delete()
+        self.assertTalliesExact(self.survey)
+        self.assertEqual(SurveyTally.total(self.survey), 5)
+
+    def test_delete_question(self):
+        tokens = next(AnswerGroup.issue_tokens(self.survey, 1))
+        group = AnswerGroup.objects.get(token=tokens[0])
+        group.save_values(self.compiled, {f"question-{self.star.id}": 3})
+        self.assertEqual(SurveyTally.total(self.survey), 11)
+
+        # The issued group's only answer goes with the question
+        Question.objects.get(id=self.star.id).delete()
+        self.assertTalliesExact(self.survey)
+        self.assertEqual(SurveyTally.total(self.survey), 10)
+
+    def add_page(self, groups):
+        """Adds a page with a question answered by the given groups, which
+        are moved on to it"""
+        page = Page.objects.create(survey=self.survey)
+        question = Question.objects.create(page=page,
+            question_type=QuestionTypes.BOOLEAN, question_text="?")
+        for group in groups:
+            Answer.objects.create(answer_group=group, question=question,
+                bool_answer=True)
+
+        AnswerGroup.objects.filter(id__in=[group.id for group in groups]
+            ).update(page=page)
+        return page
+
+    def test_delete_page(self):
+        groups = list(AnswerGroup.objects.order_by("id"))
+        page = self.add_page(groups[:3])
+
+        # A group still on the first page also answered the new page
+        Answer.objects.create(answer_group=groups[5],
+            question=page.question_set.get(), bool_answer=False)
+        self.assertTalliesExact(self.survey)
+
+        # The moved groups take their first page answers with them
+        Page.objects.get(id=page.id).delete()
+        self.assertTalliesExact(self.survey)
+        self.assertEqual(SurveyTally.total(self.survey), 7)
+
+    def test_delete_page_queries(self):
+        groups = list(AnswerGroup.objects.order_by("id"))
+        second = self.add_page(groups[2:])
+        third = self.add_page(groups[:2])
+
+        # Both are the last page when deleted, so nothing is re-ranked
+        with CaptureQueriesContext(connection) as few:
+            Page.objects.get(id=third.id).delete()
+        with CaptureQueriesContext(connection) as many:
+            Page.objects.get(id=second.id).delete()
+
+        self.assertEqual(len(many.captured_queries),
+            len(few.captured_queries))
+        self.assertTalliesExact(self.survey)
+        self.assertEqual(SurveyTally.total(self.survey), 0)
+
+    def test_delete_survey_queries(self):
+        other = create_survey("other")
+        compiled = CompiledSurvey.get(other)
+        boolean = compiled.first_page.questions[0]
+        for _ in range(2):
+            group = AnswerGroup.factory(other.slug)
+            group.save_values(compiled, {f"question-{boolean.id}": "1"})
+
+        with CaptureQueriesContext(connection) as few:
+            Survey.objects.get(id=other.id).delete()
+        with CaptureQueriesContext(connection) as many:
+            Survey.objects.get(id=self.survey.id).delete()
+
+        self.assertEqual(len(many.captured_queries),
+            len(few.captured_queries))
+        self.assertFalse(QuestionTally.objects.exists())
+        self.assertFalse(SurveyTally.objects.exists())
+
+    def test_rebuild_repairs_drift(self):
+        QuestionTally.objects.filter(question=self.boolean).update(count=0)
+        SurveyTally.objects.filter(survey=self.survey).update(respondents=0)
+
+        questions = Question.objects.filter(page__survey=self.survey)
+        self.assertGreater(QuestionTally.rebuild(questions), 0)
+        self.assertEqual(SurveyTally.rebuild(Survey.objects.all()), 1)
+        self.assertTalliesExact(self.survey)
+        self.assertEqual(SurveyTally.total(self.survey), 10)
+
+
+class IssueTokensTest(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Empty", slug="empty")
+
+    def test_command_needs_pages(self):
+        with self.assertRaisesMessage(CommandError, "has no pages"):
+            call_command("issue_tokens", self.survey.slug, 10)
+
+        self.assertFalse(AnswerGroup.objects.exists())
+
+    def test_admin_needs_pages(self):
+        user = User.objects.create_superuser("admin", "a@example.com", "pw")
+        self.client.force_login(user)
+
+        url = reverse("issue_tokens", args=(self.survey.id, ))
+        response = self.client.post(url, {"count": 10})
+        self.assertContains(response, "Add a page to the survey")
+        self.assertFalse(AnswerGroup.objects.exists())
+
+
+class AnalyticsTest(TestCase):
+    def setUp(self):
+        self.survey = create_survey()
+        compiled = CompiledSurvey.get(self.survey)
+        self.questions = compiled.first_page.questions
+        self.boolean, self.star, self.num, self.choice, _ = [
+            Question.objects.get(id=question.id) for question in
+            self.questions]
+
+        self.groups = []
+        for boolean, star, number, choice in [
+                ("1", 5, 2, "R"),
+                ("1", 3, 4, "G"),
+                ("0", 4, 6, "R"),
+                (None, None, None, "B")]:
+            values = zip(self.questions, (boolean, star, number, choice))
+            group = AnswerGroup.factory(self.survey.slug)
+            group.save_values(compiled, {f"question-{question.id}": value
+                for question, value in values if value is not None})
+            self.groups.append(group)
+
+    def columns(self):
+        from core.analytics import SurveyColumns
+        return SurveyColumns(self.survey, [self.boolean, self.star, self.num,
+            self.choice])
+
+    def test_crosstab(self):
+        from core.analytics import crosstab
+
+        columns = self.columns()
+        self.assertEqual(len(columns), 4)
+
+        rows = columns[self.boolean.id]
+        cols = columns[self.choice.id]
+        self.assertEqual(rows.labels, ["True", "False"])
+        self.assertEqual(cols.labels, ["Red", "Green", "Blue"])
+        self.assertEqual(crosstab(rows, cols).tolist(), [[1, 1, 0],
+            [1, 0, 0]])
+
+    def test_pivot(self):
+        from core.analytics import pivot
+
+        columns = self.columns()
+        result = dict(pivot(columns[self.boolean.id], columns[self.num.id]))
+        self.assertEqual(result["True"], {"count": 2, "mean": 3.0,
+            "median": 3.0, "std": 1.0, "p25": 2.5, "p75": 3.5})
+        self.assertEqual(result["False"]["count"], 1)
+        self.assertEqual(result["False"]["mean"], 6.0)
+
+        # A category nobody picked has a count but no statistics
+        result = dict(pivot(columns[self.choice.id], columns[self.star.id]))
+        self.assertEqual(result["Red"]["median"], 4.5)
+        self.assertEqual(result["Blue"], {"count": 0, "mean": None,
+            "median": None, "std": None, "p25": None, "p75": None})
+
+    def test_describe(self):
+        stats = self.columns()[self.num.id].describe()
+        self.assertEqual(stats["count"], 3)
+        self.assertEqual(stats["mean"], 4.0)
+        self.assertEqual(stats["median"], 4.0)
+        self.assertEqual((stats["p25"], stats["p75"]), (3.0, 5.0))
+        self.assertAlmostEqual(stats["std"], (8 / 3) ** 0.5)
+
+    def test_star_outside_range(self):
+        from core.analytics import crosstab
+
+        Answer.objects.filter(answer_group=self.groups[0],
+            question=self.star).update(star_answer=0)
+
+        columns = self.columns()
+        stars = columns[self.star.id]
+        self.assertEqual(stars.codes.tolist(), [-1, 2, 1, -1])
+        self.assertEqual(stars.describe()["count"], 2)
+        self.assertEqual(crosstab(stars, columns[self.choice.id]).sum(), 2)
+
+    def test_answers_saved_after_groups_loaded(self):
+        # Stands in for a respondent whose first answers are saved between
+        # loading the groups and loading the answers
+        late = self.groups[-1]
+        responded = AnswerGroup.responded
+
+        def earlier(survey=None):
+            return responded(survey).exclude(id=late.id)
+
+        with mock.patch.object(AnswerGroup, "responded", earlier):
+            columns = self.columns()
+
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(columns[self.choice.id].codes.tolist(), [0, 1, 0])
+
+    def test_view_stats_rows(self):
+        url = reverse("analytics", args=[self.survey.id, self.survey.token])
+
+        response = self.client.get(url, {"rows": self.boolean.id,
+            "cols": self.num.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([label for label, _ in response.context["pivot"]],
+            ["True", "False"])
+        self.assertEqual(response.context["overall"]["count"], 3)
+        self.assertContains(response, "<td>3.00</td>")
+
+        # With nothing picked the numeric questions are summarized
+        response = self.client.get(url)
+        self.assertEqual([question.id for question, _ in
+            response.context["summary"]], [self.boolean.id, self.star.id,
+            self.num.id])
+
+
+class ResultTextTest(TestCase):
+    ANSWERS = 120
+
+    def setUp(self):
+        self.survey = create_survey()
+        self.text = Question.objects.get(page__survey=self.survey,
+            question_type=QuestionTypes.TEXT)
+        boolean = Question.objects.get(page__survey=self.survey,
+            question_type=QuestionTypes.BOOLEAN)
+
+        groups = AnswerGroup.objects.bulk_create([AnswerGroup(
+            survey=self.survey, token=f"t{num}") for num in
+            range(self.ANSWERS + 10)])
+
+        # Empty answers and answers to other questions are left out
+        answers = []
+        for num, group in enumerate(groups):
+            text = f"answer {num}" if num < self.ANSWERS else ""
+            answers.append(Answer(answer_group=group, question=self.text,
+                text_answer=text))
+            answers.append(Answer(answer_group=group, question=boolean,
+                bool_answer=True))
+        Answer.objects.bulk_create(answers)
+
+        self.expected = [f"answer {num}" for num in range(self.ANSWERS)]
+
+    def test_chunks(self):
+        from core.views import TEXT_ANSWERS_PER_CHUNK
+
+        url = reverse("result_text", args=[self.text.id, self.survey.token])
+        seen = []
+        sizes = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            chunk = [text for _, text in response.context["answers"]]
+            seen.extend(chunk)
+            sizes.append(len(chunk))
+
+            # Follow the link the page would load next
+            link = re.search(r'hx-get="([^"]+)"', response.content.decode())
+            url = link.group(1) if link else None
+
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(sizes, [TEXT_ANSWERS_PER_CHUNK,
+            TEXT_ANSWERS_PER_CHUNK, self.ANSWERS - 2 * TEXT_ANSWERS_PER_CHUNK])
+
+    def test_exact_chunk(self):
+        from core.views import TEXT_ANSWERS_PER_CHUNK
+
+        # No link to a further, empty, chunk when the answers run out on a
+        # chunk boundary
+        last = Answer.objects.filter(question=self.text).order_by("id")[
+            self.ANSWERS - TEXT_ANSWERS_PER_CHUNK - 1]
+        response = self.client.get(reverse("result_text", args=[self.text.id,
+            self.survey.token]), {"after": last.id})
+        self.assertEqual(len(response.context["answers"]),
+            TEXT_ANSWERS_PER_CHUNK)
+        self.assertIsNone(response.context["next_after"])
+
+    def test_bad_requests(self):
+        url = reverse("result_text", args=[self.text.id, self.survey.token])
+        self.assertEqual(self.client.get(url, {"after": "x"}).status_code,
+            404)
+        self.assertEqual(self.client.get(reverse("result_text", args=[
+            self.text.id, "wrong"])).status_code, 404)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.survey = create_survey()
+        self.compiled = CompiledSurvey.get(self.survey)
+        self.boolean, _, self.num, _, self.text = \
+            self.compiled.first_page.questions
+
+        # An answered group, one saved without answers, an issued token
+        # nobody used, an issued token that was answered, then another
+        # answered group so the empty ones sit between groups with answers
+        self.first = self.answered(AnswerGroup.factory(self.survey.slug),
+            boolean=True, text="first")
+        self.empty = AnswerGroup.objects.create(survey=self.survey,
+            token="empty")
+        unused, used = list(AnswerGroup.issue_tokens(self.survey, 2))[0]
+        self.used = self.answered(AnswerGroup.objects.get(
+            survey=self.survey, token=used), num=7)
+        self.last = self.answered(AnswerGroup.factory(self.survey.slug),
+            boolean=False)
+
+        # Answers to another survey are left out
+        other = create_survey("other")
+        other_compiled = CompiledSurvey.get(other)
+        AnswerGroup.factory(other.slug).save_values(other_compiled, {
+            f"question-{other_compiled.first_page.questions[0].id}": "1"})
+
+    def answered(self, group, **values):
+        names = {"boolean": self.boolean, "num": self.num, "text": self.text}
+        group.save_values(self.compiled, {f"question-{names[name].id}": value
+            for name, value in values.items()})
+        return group
+
+    def test_rows(self):
+        from core.export import export_questions, survey_rows
+
+        questions = export_questions(self.survey)
+
+        # A chunk size of one makes every row its own round trip
+        rows = [(group_id, values) for group_id, _, _, values in
+            survey_rows(self.survey, questions, chunk_size=1)]
+        self.assertEqual(rows, [
+            (self.first.id, {self.boolean.id: True, self.text.id: "first"}),
+            (self.empty.id, {}),
+            (self.used.id, {self.num.id: 7}),
+            (self.last.id, {self.boolean.id: False}),
+        ])
+
+    def test_csv(self):
+        from core.export import csv_lines
+
+        lines = list(csv.reader("".join(csv_lines(self.survey)).splitlines()))
+        self.assertEqual(lines[0], ["group", "created", "updated", "?", "?",
+            "?", "?", "?"])
+        self.assertEqual([line[0] for line in lines[1:]], [str(group.id) for
+            group in (self.first, self.empty, self.used, self.last)])
+        self.assertEqual(lines[1][3:], ["1", "", "", "", "first"])
+        self.assertEqual(lines[2][3:], ["", "", "", "", ""])
+
+    def test_jsonl(self):
+        from core.export import jsonl_lines
+
+        rows = [json.loads(line) for line in jsonl_lines(self.survey)]
+        self.assertEqual([row["group"] for row in rows], [self.first.id,
+            self.empty.id, self.used.id, self.last.id])
+        self.assertEqual(rows[2]["answers"][str(self.num.id)], 7)
+        self.assertIsNone(rows[2]["answers"][str(self.boolean.id)])
+
+    def test_gzip(self):
+        from core.export import csv_lines, export_stream
+
+        expected = "".join(csv_lines(self.survey)).encode("utf-8")
+        self.assertEqual(b"".join(export_stream(self.survey, "csv")),
+            expected)
+
+        data = b"".join(export_stream(self.survey, "csv", compress=True))
+        self.assertEqual(data[:2], b"\x1f\x8b")
+        self.assertEqual(gzip.decompress(data), expected)
+
+    def test_view(self):
+        staff = User.objects.create_user("staff", password="pass",
+            is_staff=True)
+        self.client.force_login(staff)
+
+        response = self.client.get(reverse("export", args=[self.survey.id,
+            "csv"]), {"gzip": "1"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('filename="test.csv.gz"',
+            response["Content-Disposition"])
+        self.assertEqual(gzip.decompress(b"".join(
+            response.streaming_content)).decode("utf-8").count("\n"), 5)
+
+
+class AdminChangelistTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        admin = User.objects.create_superuser("admin", password="pass")
+        self.client.force_login(admin)
+
+        self.survey = create_survey()
+        self.second = Page.objects.create(survey=self.survey)
+        Question.objects.create(page=self.second,
+            question_type=QuestionTypes.TEXT, question_text="More?")
+
+    def changelist(self, model, query=""):
+        url = reverse(f"admin:core_{model._meta.model_name}_changelist")
+        response = self.client.get(url + query)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def queries(self, model):
+        with CaptureQueriesContext(connection) as context:
+            self.changelist(model)
+
+        return len(context.captured_queries)
+
+    def add_groups(self, count, survey=None):
+        groups = AnswerGroup.objects.bulk_create([AnswerGroup(
+            survey=survey or self.survey, token=f"g{num}")
+            for num in range(count)])
+        return sorted(group.id for group in groups)
+
+    def test_survey(self):
+        other = create_survey("other")
+        cl = self.changelist(Survey).context["cl"]
+        counts = {survey.id: (survey.page_count, survey.question_count)
+            for survey in cl.result_list}
+        self.assertEqual(counts, {self.survey.id: (2, 6), other.id: (1, 5)})
+
+        # More surveys, same number of queries
+        before = self.queries(Survey)
+        create_survey("third")
+        self.assertEqual(self.queries(Survey), before)
+
+    def test_page(self):
+        cl = self.changelist(Page).context["cl"]
+        counts = {page.id: (page.question_count, page.last_rank)
+            for page in cl.result_list}
+        first = Page.objects.get(survey=self.survey, rank=1)
+        self.assertEqual(counts, {first.id: (5, 2), self.second.id: (1, 2)})
+
+        before = self.queries(Page)
+        Page.objects.create(survey=create_survey("other"))
+        self.assertEqual(self.queries(Page), before)
+
+    def test_question(self):
+        group = AnswerGroup.factory(self.survey.slug)
+        boolean = Question.objects.get(page__survey=self.survey,
+            question_type=QuestionTypes.BOOLEAN)
+        group.save_values(CompiledSurvey.get(Survey.objects.get(
+            id=self.survey.id)), {f"question-{boolean.id}": "1"})
+
+        cl = self.changelist(Question).context["cl"]
+        self.assertEqual({question.id: question.answer_count for question in
+            cl.result_list if question.answer_count}, {boolean.id: 1})
+        self.assertEqual({question.last_rank for question in
+            cl.result_list}, {Question.objects.count()})
+
+        before = self.queries(Question)
+        create_survey("other")
+        self.assertEqual(self.queries(Question), before)
+
+    def test_answer_group_keyset(self):
+        ids = self.add_groups(250)
+        ids.reverse()
+
+        pages = []
+        query = ""
+        while query is not None:
+            cl = self.changelist(AnswerGroup, query).context["cl"]
+            self.assertTrue(cl.keyset)
+            self.assertEqual(cl.result_count, 250)
+            pages.append(cl)
+            query = cl.next_url
+
+        # Newest first, every group once
+        self.assertEqual([len(cl.result_list) for cl in pages],
+            [100, 100, 50])
+        self.assertEqual([group.id for cl in pages for group in
+            cl.result_list], ids)
+        self.assertIsNone(pages[0].previous_url)
+        self.assertIsNone(pages[-1].last_url)
+
+        # Previous from the last page is the middle page, and Last is the
+        # oldest groups
+        cl = self.changelist(AnswerGroup, pages[-1].previous_url).context[
+            "cl"]
+        self.assertEqual([group.id for group in cl.result_list], ids[100:200])
+        self.assertIsNotNone(cl.next_url)
+
+        cl = self.changelist(AnswerGroup, pages[0].last_url).context["cl"]
+        self.assertEqual([group.id for group in cl.result_list], ids[150:])
+        self.assertIsNone(cl.next_url)
+        self.assertEqual(self.changelist(AnswerGroup, cl.first_url).context[
+            "cl"].result_list[0].id, ids[0])
+
+        response = self.changelist(AnswerGroup)
+        self.assertContains(response, "Next ›")
+        self.assertNotContains(response, "‹ Previous")
+
+    def test_answer_group_count_cached(self):
+        self.add_groups(5)
+        self.assertEqual(self.changelist(AnswerGroup).context[
+            "cl"].result_count, 5)
+
+        # Counts lag behind new rows until the cache expires
+        AnswerGroup.objects.create(survey=self.survey, token="late")
+        cl = self.changelist(AnswerGroup).context["cl"]
+        self.assertEqual(cl.result_count, 5)
+        self.assertEqual(len(cl.result_list), 6)
+
+    def test_answer_group_sorted(self):
+        # Sorting by a column falls back to numbered pages
+        self.add_groups(150)
+        cl = self.changelist(AnswerGroup, "?o=1").context["cl"]
+        self.assertFalse(cl.keyset)
+        self.assertTrue(cl.multi_page)
+
+    def test_answer_group_bad_cursor(self):
+        response = self.client.get(reverse(
+            "admin:core_answergroup_changelist") + "?after=x")
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("e=1", response.url)
+
+    def test_answer_by_survey_keyset(self):
+        other = create_survey("other")
+        questions = list(Question.objects.filter(page__survey=self.survey))
+        answers = []
+        for group_id in self.add_groups(30):
+            answers.extend(Answer(answer_group_id=group_id, question=question,
+                text_answer="x") for question in questions)
+        Answer.objects.bulk_create(answers)
+        self.add_groups(3, other)
+
+        query = f"?survey={self.survey.id}"
+        seen = []
+        while query is not None:
+            cl = self.changelist(Answer, query).context["cl"]
+            self.assertTrue(cl.keyset)
+            seen.extend((answer.answer_group_id, answer.question_id)
+                for answer in cl.result_list)
+            query = cl.next_url
+            if query is not None:
+                self.assertIn(f"survey={self.survey.id}", query)
+
+        # Two part cursors, newest group first, each answer once
+        self.assertEqual(len(seen), 180)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+
+class InstrumentationTest(TransactionTestCase):
+    def setUp(self):
+        self.addCleanup(setattr, instrumentation, "recorder", None)
+
+    def test_async_chain(self):
+        async def view(request):
+            await Survey.objects.acount()
+
+            # In a worker thread with its own database connection
+            await sync_to_async(Survey.objects.count,
+                thread_sensitive=False)()
+            return HttpResponse()
+
+        middleware = instrumentation.InstrumentationMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        async_to_sync(middleware)(AsyncRequestFactory().get("/"))
+        summary = instrumentation.recorder.summary()
+        self.assertEqual(summary["views"]["<unresolved>"]["queries_total"],
+            2)
+
+    def test_sync_chain(self):
+        def view(request):
+            Survey.objects.count()
+            return HttpResponse()
+
+        middleware = instrumentation.InstrumentationMiddleware(view)
+        self.assertFalse(iscoroutinefunction(middleware))
+
+        middleware(RequestFactory().get("/"))
+        summary = instrumentation.recorder.summary()
+        self.assertEqual(summary["views"]["<unresolved>"]["queries_total"],
+            1)
+
+
+class ConcurrentSubmitTest(TallyTestMixin, TransactionTestCase):
+    # Same page submitted at once for each group, as from a double clicked
+    # button or two open tabs
+    THREADS = 8
+    ROUNDS = 5
+    GROUPS = 2
+
+    def setUp(self):
+        self.survey = create_survey()
+        self.page = CompiledSurvey.get(self.survey).first_page
+        self.statuses = []
+
+    def submit_together(self, submissions):
+        # Posts each (token, data, cookies) at the same moment from its own
+        # thread
+        barrier = threading.Barrier(len(submissions))
+        url = f"/page/{self.survey.id}/{{}}/{self.page.rank}/"
+
+        def submit(token, data, cookies):
+            try:
+                client = Client()
+                for name, value in cookies.items():
+                    client.cookies[name] = value
+                barrier.wait()
+                response = client.post(url.format(token), data)
+                self.statuses.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=submit, args=args) for args in
+            submissions]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def assertNoDuplicates(self):
+        duplicates = Answer.objects.values("answer_group", "question"
+            ).annotate(count=Count("id")).filter(count__gt=1)
+        self.assertFalse(duplicates.exists())
+        self.assertTalliesExact(self.survey)
+
+    def test_same_page_submitted_concurrently(self):
+        groups = [AnswerGroup.factory(self.survey.slug) for _ in
+            range(self.GROUPS)]
+
+        rand = random.Random(42)
+        for _ in range(self.ROUNDS):
+            self.submit_together([(groups[num % self.GROUPS].token,
+                random_page_data(self.page, rand), {})
+                for num in range(self.THREADS)])
+
+        self.assertEqual(self.statuses, [302] * self.THREADS * self.ROUNDS)
+        self.assertLessEqual(Answer.objects.count(),
+            self.GROUPS * len(self.page.questions))
+        self.assertNoDuplicates()
+
+    def test_first_submission_concurrently(self):
+        # Pending group's first answers, only one group may be created
+        token = AnswerGroup.new_token()
+        cookies = {self.survey.slug: signing.get_cookie_signer(
+            salt=self.survey.slug + TOKEN_COOKIE_SALT).sign(token)}
+        data = random_page_data(self.page, random.Random(42))
+
+        self.submit_together([(token, data, cookies)] * self.THREADS)
+
+        self.assertEqual(self.statuses, [302] * self.THREADS)
+        self.assertEqual(AnswerGroup.objects.filter(token=token).count(), 1)
+        self.assertEqual(SurveyTally.total(self.survey), 1)
+        self.assertNoDuplicates()
@@ -1,19 +1,29 @@
-import re
-from pathlib import Path
-
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Min, Max
-from django.shortcuts import render, get_object_or_404, redirect
+from django.http import (Http404, HttpResponse, JsonResponse,
+    StreamingHttpResponse)
+from django.shortcuts import (render, get_object_or_404, aget_object_or_404,
+    redirect)
 from django.urls import reverse
 
-from core.models import (Survey, Page, AnswerGroup, Answer, QuestionTypes,
-    Question)
+from core import instrumentation
+from core.export import EXPORT_FORMATS, export_stream, token_csv_lines
+from core.graphs import (COLOURS, get_render_queue, get_graph_cache,
+    graph_key)
+from core.models import (Survey, Page, AnswerGroup, QuestionTypes,
+    Question, CompiledSurvey, TOKEN_COOKIE_SALT)
+from core.results import SurveyResults, graph_bars, text_answers
 
 # ===========================================================================
 
-EPOCH_PART = re.compile(r"q-\d+-(\d+)\.svg")
+# Number of text answers the results page loads at a time
+TEXT_ANSWERS_PER_CHUNK = 50
+
+# Most tokens that can be issued from the admin in one go, larger panels
+# should use the issue_tokens management command
+MAX_ADMIN_TOKENS = 100_000
 
 # ===========================================================================
 
@@ -24,34 +34,74 @@ def home(request):
     return render(request, "home.html")
 
 
-def start_quiz(request, slug):
+def start_quiz(request, slug, token=None):
+    if token is not None:
+        # Personalised link with a pre-issued token
+        group = get_object_or_404(AnswerGroup.objects.select_related(
+            "survey"), survey__slug=slug, token=token)
+        return issued_response(request, group,
+            CompiledSurvey.get(group.survey))
+
     # check for a cookie to see if they've done this survey before
-    token = request.COOKIES.get(slug, '')
-    broken = False
+    token, signed = cookie_token(request, slug)
+    group = None
     if token:
         try:
-            group = AnswerGroup.objects.get(survey__slug=slug, token=token)
+            group = AnswerGroup.objects.select_related("survey").get(
+                survey__slug=slug, token=token)
         except AnswerGroup.DoesNotExist:
-            broken = True
+            pass
 
-    if not token or broken:
-        # Starting a new survey
-        group = AnswerGroup.factory(slug)
-        data = {
-            "group": group,
-            "start_page": reverse("page", args=(group.survey.id, group.token,
-                group.page.rank)),
-        }
-        response = render(request, "start.html", data)
-        response.set_cookie(slug, group.token)
-        return response
-
-    # Existing survey
-    if group.page:
+    if group is None:
+        # Starting a new survey, the group isn't saved until it has answers
+        survey = get_object_or_404(Survey, slug=slug)
+        if not signed:
+            token = AnswerGroup.new_token()
+
+        compiled = CompiledSurvey.get(survey)
+        return start_response(request,
+            AnswerGroup.pending(survey, token, compiled), compiled)
+
+    return resume_response(group, CompiledSurvey.get(group.survey))
+
+
+def cookie_token(request, slug):
+    """Returns a tuple of (token, signed) for the respondent's token from the
+    survey's cookie. Cookies set before tokens were signed hold the bare
+    token."""
+    signed = request.get_signed_cookie(slug, '', salt=TOKEN_COOKIE_SALT)
+    return signed or request.COOKIES.get(slug, ''), bool(signed)
+
+
+def issued_response(request, group, compiled):
+    """Starts or resumes a respondent arriving by a personalised link"""
+    if group.page_id == compiled.first_page.id:
+        return start_response(request, group, compiled)
+
+    return resume_response(group, compiled)
+
+
+def start_response(request, group, compiled):
+    """Renders the survey's start page and sets the respondent's cookie"""
+    data = {
+        "group": group,
+        "start_page": reverse("page", args=(group.survey.id, group.token,
+            group.current_page(compiled).rank)),
+    }
+    response = render(request, "start.html", data)
+    response.set_signed_cookie(group.survey.slug, group.token,
+        salt=TOKEN_COOKIE_SALT)
+    return response
+
+
+def resume_response(group, compiled):
+    """Redirects a returning respondent to where they left off"""
+    if group.page_id:
         # Survey is in progress
         response = redirect("page", survey_id=group.survey.id,
-            token=group.token, page_num=group.page.rank)
-        response.set_cookie(slug, token)
+            token=group.token, page_num=group.current_page(compiled).rank)
+        response.set_signed_cookie(group.survey.slug, group.token,
+            salt=TOKEN_COOKIE_SALT)
     else:
         # Survey is done
         response = redirect("done", survey_id=group.survey.id,
@@ -60,42 +110,60 @@ def start_quiz(request, slug):
     return response
 
 
-def page(request, survey_id, token, page_num):
-    group = get_object_or_404(AnswerGroup, survey__id=survey_id, token=token)
-    page = get_object_or_404(Page, survey__id=survey_id, rank=page_num)
+def respondent_group(request, survey_id, token):
+    """Returns the :class:`AnswerGroup` with the given token, or a pending
+    one if the respondent hasn't answered anything yet. Pending tokens are
+    only accepted from the survey's signed cookie."""
+    try:
+        return AnswerGroup.objects.select_related("survey").get(
+            survey__id=survey_id, token=token)
+    except AnswerGroup.DoesNotExist:
+        pass
 
-    # Update the group so the given page is the current one
-    group.page = page
-    group.save()
+    survey = get_object_or_404(Survey, id=survey_id)
+    check_pending(request, survey, token)
+    return AnswerGroup.pending(survey, token, CompiledSurvey.get(survey))
 
-    questions = {}
-    for question in group.page.question_set.all():
-        questions[f"question-{question.id}"] = question
 
-    if request.method == 'POST':
-        form = group.get_form(request.POST)
+def check_pending(request, survey, token):
+    if request.get_signed_cookie(survey.slug, '',
+            salt=TOKEN_COOKIE_SALT) != token:
+        raise Http404("No such response")
 
-        passed = form.is_valid()
-        group.save_values(form.cleaned_data)
 
-        if passed:
-            if page.next_page:
-                return redirect("page", survey_id=survey_id, token=token,
-                    page_num=page.next_page.rank)
-
-            # No next page
-            group.page = None
-            group.save()
-            return redirect("done", survey_id=survey_id, token=token)
-    else: # GET
-        form = group.get_form()
+def compiled_page(compiled, page_num):
+    """Returns the survey's :class:`CompiledPage` with the given rank, or
+    raises a 404"""
+    page = compiled.page(page_num)
+    if page is None:
+        raise Http404("No such page")
+
+    return page
+
+
+def next_redirect(page, survey_id, token):
+    """Redirects to the page after the one just completed, or to the done
+    page after the last one"""
+    if page.next_rank:
+        return redirect("page", survey_id=survey_id, token=token,
+            page_num=page.next_rank)
+
+    return redirect("done", survey_id=survey_id, token=token)
+
+
+def page_response(request, group, page, form):
+    questions = {}
+    for question in page.questions:
+        questions[f"question-{question.id}"] = question
 
     prev_url = ""
-    if page.prev_page:
-        prev_url = reverse("page", args=(survey_id, token, page.prev_page.rank))
+    if page.prev_rank:
+        prev_url = reverse("page", args=(group.survey.id, group.token,
+            page.prev_rank))
 
     data = {
         "group": group,
+        "page": page,
         "questions": questions,
         "form": form,
         "QuestionTypes": QuestionTypes,
@@ -105,11 +173,9 @@ def page(request, survey_id, token, page_num):
     return render(request, "fill_quiz.html", data)
 
 
-def done(request, survey_id, token):
-    group = get_object_or_404(AnswerGroup, survey__id=survey_id, token=token)
-
-    page = Page.objects.filter(survey=group.survey).last()
-    prev_url = reverse("page", args=(survey_id, token, page.rank))
+def done_response(request, group, compiled):
+    prev_url = reverse("page", args=(group.survey.id, group.token,
+        compiled.last_page.rank))
 
     data = {
         "group": group,
@@ -119,6 +185,117 @@ def done(request, survey_id, token):
     return render(request, "done.html", data)
 
 
+def page(request, survey_id, token, page_num):
+    group = respondent_group(request, survey_id, token)
+    compiled = CompiledSurvey.get(group.survey)
+    page = compiled_page(compiled, page_num)
+
+    # Update the group so the given page is the current one
+    group.set_page(page.id)
+
+    if request.method == 'POST':
+        form = group.get_form(compiled, request.POST)
+
+        passed = form.is_valid()
+        group.save_values(compiled, form.cleaned_data)
+
+        if passed:
+            if not page.next_rank:
+                group.set_page(None)
+
+            return next_redirect(page, survey_id, token)
+    else: # GET
+        form = group.get_form(compiled,
+            answers=group.page_answers(compiled))
+
+    return page_response(request, group, page, form)
+
+
+def done(request, survey_id, token):
+    group = respondent_group(request, survey_id, token)
+    return done_response(request, group, CompiledSurvey.get(group.survey))
+
+
+# ---------------------------------------------------------------------------
+# Async versions of the respondent views, used instead of the ones above when
+# settings.ASYNC_RESPONDENT_VIEWS is True and the site is served over ASGI.
+# Only the database access differs, the compiled survey is fetched once with
+# CompiledSurvey.aget() and passed to everything else
+
+async def astart_quiz(request, slug, token=None):
+    if token is not None:
+        group = await aget_object_or_404(AnswerGroup.objects.select_related(
+            "survey"), survey__slug=slug, token=token)
+        return issued_response(request, group,
+            await CompiledSurvey.aget(group.survey))
+
+    token, signed = cookie_token(request, slug)
+    group = None
+    if token:
+        try:
+            group = await AnswerGroup.objects.select_related("survey").aget(
+                survey__slug=slug, token=token)
+        except AnswerGroup.DoesNotExist:
+            pass
+
+    if group is None:
+        # Starting a new survey
+        survey = await aget_object_or_404(Survey, slug=slug)
+        if not signed:
+            token = AnswerGroup.new_token()
+
+        compiled = await CompiledSurvey.aget(survey)
+        return start_response(request,
+            AnswerGroup.pending(survey, token, compiled), compiled)
+
+    return resume_response(group, await CompiledSurvey.aget(group.survey))
+
+
+async def arespondent_group(request, survey_id, token):
+    try:
+        return await AnswerGroup.objects.select_related("survey").aget(
+            survey__id=survey_id, token=token)
+    except AnswerGroup.DoesNotExist:
+        pass
+
+    survey = await aget_object_or_404(Survey, id=survey_id)
+    check_pending(request, survey, token)
+    return AnswerGroup.pending(survey, token,
+        await CompiledSurvey.aget(survey))
+
+
+async def apage(request, survey_id, token, page_num):
+    group = await arespondent_group(request, survey_id, token)
+    compiled = await CompiledSurvey.aget(group.survey)
+    page = compiled_page(compiled, page_num)
+
+    # Update the group so the given page is the current one
+    await group.aset_page(page.id)
+
+    if request.method == 'POST':
+        form = group.get_form(compiled, request.POST)
+
+        passed = form.is_valid()
+        await group.asave_values(compiled, form.cleaned_data)
+
+        if passed:
+            if not page.next_rank:
+                await group.aset_page(None)
+
+            return next_redirect(page, survey_id, token)
+    else: # GET
+        answers = [answer async for answer in group.page_answers(compiled)]
+        form = group.get_form(compiled, answers=answers)
+
+    return page_response(request, group, page, form)
+
+
+async def adone(request, survey_id, token):
+    group = await arespondent_group(request, survey_id, token)
+    return done_response(request, group,
+        await CompiledSurvey.aget(group.survey))
+
+
 @staff_member_required
 def duplicate(request, survey_id):
     survey = get_object_or_404(Survey, id=survey_id)
@@ -145,6 +322,82 @@ def duplicate(request, survey_id):
     return redirect('admin:core_survey_changelist')
 
 
+@staff_member_required
+def export(request, survey_id, fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise Http404("Unknown export format")
+
+    survey = get_object_or_404(Survey, id=survey_id)
+    compress = bool(request.GET.get("gzip"))
+
+    filename = f"{survey.slug}.{fmt}"
+    content_type = EXPORT_FORMATS[fmt]
+    if compress:
+        filename += ".gz"
+        content_type = "application/gzip"
+
+    response = StreamingHttpResponse(export_stream(survey, fmt, compress),
+        content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@staff_member_required
+def issue_tokens(request, survey_id):
+    survey = get_object_or_404(Survey, id=survey_id)
+    if request.method == "POST":
+        try:
+            count = int(request.POST.get("count", ""))
+        except ValueError:
+            count = 0
+
+        if CompiledSurvey.get(survey).first_page is None:
+            messages.add_message(request, messages.ERROR,
+                "Add a page to the survey before issuing tokens")
+        elif 0 < count <= MAX_ADMIN_TOKENS:
+            batches = AnswerGroup.issue_tokens(survey, count)
+            base_url = request.build_absolute_uri("/").rstrip("/")
+            response = HttpResponse("".join(token_csv_lines(survey, batches,
+                base_url)), content_type="text/csv")
+            response["Content-Disposition"] = \
+                f'attachment; filename="{survey.slug}-tokens.csv"'
+            return response
+        else:
+            messages.add_message(request, messages.ERROR,
+                f"Number of tokens must be between 1 and "
+                f"{MAX_ADMIN_TOKENS:,}")
+
+    data = {
+        "title": f"Issue tokens for {survey.name}",
+        "survey": survey,
+        "max_tokens": MAX_ADMIN_TOKENS,
+    }
+    return render(request, "issue_tokens.html", data)
+
+
+@staff_member_required
+def instrumentation_page(request):
+    recorder = instrumentation.recorder
+    if recorder is not None and request.method == "POST":
+        recorder.clear()
+        return redirect("instrumentation")
+
+    data = {
+        "title": "Instrumentation",
+        "summary": recorder.summary() if recorder is not None else None,
+    }
+    return render(request, "instrumentation.html", data)
+
+
+@staff_member_required
+def instrumentation_json(request):
+    recorder = instrumentation.recorder
+    if recorder is None:
+        return JsonResponse({"enabled": False})
+
+    return JsonResponse({"enabled": True, **recorder.summary()})
+
+
 def result_page(request, survey_id, token):
     if not token:
         raise Http404("Corrupted survey token")
@@ -153,10 +406,60 @@ def result_page(request, survey_id, token):
 
     data = {
         "survey": survey,
+        "results": SurveyResults(survey),
     }
     return render(request, "result.html", data)
 
 
+def analytics(request, survey_id, token):
+    if not token:
+        raise Http404("Corrupted survey token")
+
+    survey = get_object_or_404(Survey, id=survey_id, token=token)
+
+    # NumPy is only needed here, import it on first use rather than at
+    # startup
+    from core.analytics import SurveyColumns, crosstab, pivot
+
+    questions = list(Question.objects.filter(page__survey=survey).exclude(
+        question_type=QuestionTypes.TEXT).order_by("page__rank", "rank"))
+    by_id = {question.id: question for question in questions}
+
+    try:
+        row_id = int(request.GET.get("rows", 0))
+        col_id = int(request.GET.get("cols", 0))
+    except ValueError:
+        raise Http404("Bad question")
+
+    data = {
+        "survey": survey,
+        "questions": questions,
+        "row_id": row_id,
+        "col_id": col_id,
+    }
+
+    if row_id in by_id and col_id in by_id:
+        columns = SurveyColumns(survey, [by_id[row_id], by_id[col_id]])
+        rows = columns[row_id]
+        cols = columns[col_id]
+
+        counts = crosstab(rows, cols)
+        data["col_labels"] = cols.labels
+        data["table"] = list(zip(rows.labels, counts.tolist()))
+        if cols.numeric:
+            data["pivot"] = pivot(rows, cols)
+            data["overall"] = cols.describe()
+    else:
+        # Nothing picked yet, summarize the numeric questions
+        numeric = [question for question in questions
+            if question.question_type != QuestionTypes.CHOICE]
+        columns = SurveyColumns(survey, numeric)
+        data["summary"] = [(question, columns[question.id].describe())
+            for question in numeric]
+
+    return render(request, "analytics.html", data)
+
+
 def result_question(request, q_id, token):
     if not token:
         raise Http404("Corrupted survey token")
@@ -164,39 +467,64 @@ def result_question(request, q_id, token):
     question = get_object_or_404(Question, id=q_id, page__survey__token=token)
     survey = question.page.survey
 
-    survey_dir = Path(settings.MEDIA_ROOT) / f"s{survey.id}"
-    survey_dir.mkdir(exist_ok=True)
-
-    # graphs have a file name format of "q-Q_ID-EPOCH.svg", search for
-    # anything that corresponds to this question
-    files = list(survey_dir.glob(f'q-{question.id}-*.svg'))
-    if len(files) >= 1:
-        file = files[0]
-        cached_url = settings.MEDIA_URL + f"s{survey.id}/{file.name}"
-
-        # Check if graph is up to date
-        latest = Answer.objects.filter(question=question
-            ).order_by("-updated").first()
-
-        if latest is None:
-            # No Answers, but have a graph, must be a graph showing that there
-            # are no answers, just show it
-            return render(request, "snippets/graph.html", {"url":cached_url})
-
-        # Have answers, check if they're more recent than the graph
-        file_date = int(EPOCH_PART.match(file.name)[1])
-        if latest.updated.timestamp() < file_date:
-            # File was generated after most recent Answer
-            return render(request, "snippets/graph.html", {"url":cached_url})
-
-        # else: files are out of date, erase them before generating a new one
-        for path in files:
-            path.unlink()
-
-    # Generate a new graph
-    result = question.generate_graph(survey, survey_dir)
-    url = None
-    if result:
-        url = settings.MEDIA_URL + f"s{survey.id}/{result.name}"
-
-    return render(request, "snippets/graph.html", {"url":url})
+    bars = graph_bars(question, question.tally(survey))
+    if bars is None:
+        return render(request, "snippets/graph.html", {"url":None})
+
+    # Graphs are named by a hash of what is drawn in them, if the answers
+    # haven't changed since the last render the file is already there
+    cache = get_graph_cache()
+    queue = get_render_queue()
+    key = graph_key(queue.renderer, question.id, *bars, COLOURS)
+    file = cache.path(survey.id, question.id, key)
+    url = settings.MEDIA_URL + cache.url(file)
+    if cache.get(file):
+        return render(request, "snippets/graph.html", {"url":url})
+
+    # Queue a new graph, if one is already being rendered by any worker this
+    # does nothing, either way the snippet polls until the file is ready
+    marker = file.with_suffix(".rendering")
+    if queue.submit(marker, file, *bars, COLOURS):
+        cache.evict()
+
+    if file.exists():
+        # Rendered inline
+        return render(request, "snippets/graph.html", {"url":url})
+
+    data = {
+        "rendering": True,
+        "q_id": question.id,
+        "token": token,
+    }
+    return render(request, "snippets/graph.html", data)
+
+
+def result_text(request, q_id, token):
+    if not token:
+        raise Http404("Corrupted survey token")
+
+    question = get_object_or_404(Question, id=q_id, page__survey__token=token,
+        question_type=QuestionTypes.TEXT)
+
+    # Keyset pagination on the answer id so that deep chunks cost the same as
+    # the first one
+    try:
+        after = int(request.GET.get("after", 0))
+    except ValueError:
+        raise Http404("Bad position")
+
+    answers = list(text_answers([question.id]).filter(id__gt=after).order_by(
+        "id").values_list("id", "text_answer")[:TEXT_ANSWERS_PER_CHUNK + 1])
+
+    next_after = None
+    if len(answers) > TEXT_ANSWERS_PER_CHUNK:
+        answers = answers[:TEXT_ANSWERS_PER_CHUNK]
+        next_after = answers[-1][0]
+
+    data = {
+        "question": question,
+        "token": token,
+        "answers": answers,
+        "next_after": next_after,
+    }
+    return render(request, "snippets/text_answers.html", data)